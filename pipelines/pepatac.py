@@ -70,6 +70,24 @@ def parse_arguments():
                         help="Space-delimited list of reference genomes to "
                              "align to before primary alignment.")
 
+    parser.add_argument("--sparse-tracks", action='store_true',
+                        dest="sparse_tracks",
+                        help="Write only bases with signal to the exact and "
+                             "smoothed tracks, which are smaller and faster "
+                             "to write; bases without cuts then read as no "
+                             "data instead of 0")
+
+    parser.add_argument("--enrichment-sites", dest="enrichment_sites",
+                        default=[], type=str, nargs="+", metavar="NAME=BED",
+                        help="Space-delimited list of further named site "
+                             "sets (e.g. CTCF=ctcf_motifs.bed) whose "
+                             "enrichment is profiled in the TSS pass.")
+
+    parser.add_argument("--profile", action='store_true',
+                        dest="profile",
+                        help="Sample the call stacks of the Python tools into "
+                             "flame graph files in a 'profile' folder")
+
     parser.add_argument("-V", "--version", action="version",
                         version="%(prog)s {v}".format(v=__version__))
 
@@ -469,6 +487,15 @@ def main():
 
     param.outfolder = outfolder
 
+    def profile_option(tool):
+        # Collapsed call stacks of one tool, for flamegraph.pl or speedscope.
+        if not args.profile:
+            return ""
+        profile_folder = os.path.join(param.outfolder, "profile")
+        ngstk.make_dir(profile_folder)
+        return " --profile " + os.path.join(
+            profile_folder, "{}_{}.folded".format(args.sample_name, tool))
+
     print("Local input file: " + args.input[0])
     if args.input2:
         print("Local input file: " + args.input2[0])
@@ -726,6 +753,16 @@ def main():
     cmd += " -i " + mapping_genome_bam
     cmd += " -c " + str(pm.cores)
     cmd += " -o " + bamQC
+    # The state can be merged with other runs' (e.g. resequenced lanes)
+    # by bamQC.py --merge, without reading the BAMs again.
+    cmd += " -s " + os.path.join(QC_folder, args.sample_name + "_bamQC.qcstate")
+    # Distinct fragments expected at deeper sequencing, from the same pass.
+    cmd += " -x " + os.path.join(QC_folder,
+                                 args.sample_name + "_complexity.tsv")
+    # If the run is killed, a rerun only processes the unfinished chroms.
+    cmd += " --checkpoint " + os.path.join(QC_folder,
+                                           args.sample_name + "_bamQC_checkpoint")
+    cmd += profile_option("bamQC")
 
     def report_bam_qc(bamqc_log):
         # Reported BAM QC metrics via the bamQC metrics file
@@ -748,9 +785,15 @@ def main():
             pbc1 = 0
             pbc2 = 0
 
-        pm.report_result("NRF", round(float(nrf),2))
-        pm.report_result("PBC1", round(float(pbc1),2))
-        pm.report_result("PBC2", round(float(pbc2), 2))
+        # Reports from bamQC.py --sketch-error give NA for these, as a
+        # sketch cannot count the fragments seen once; pass NA through.
+        def metric(value):
+            return "NA" if str(value).strip() == "NA" \
+                else round(float(value), 2)
+
+        pm.report_result("NRF", metric(nrf))
+        pm.report_result("PBC1", metric(pbc1))
+        pm.report_result("PBC2", metric(pbc2))
 
     pm.run(cmd, bamQC, follow=lambda: report_bam_qc(bamQC),
            container=pm.container)
@@ -825,12 +868,28 @@ def main():
            follow=lambda: post_dup_aligned_reads(metrics_file),
            container=pm.container)
 
+    # Decode the deduplicated pairs once into a compact, indexed fragment
+    # file that downstream analyses can read instead of the BAM.
+    if args.paired_end:
+        pm.timestamp("### Write indexed fragment file")
+
+        fragments_file = os.path.join(
+            map_genome_folder, args.sample_name + "_fragments.tsv.gz")
+        cmd = tool_path("bamToFragments.py")
+        cmd += " -i " + rmdup_bam
+        cmd += " -o " + fragments_file
+        cmd += " -c " + str(pm.cores)
+        cmd += profile_option("bamToFragments")
+        pm.run(cmd, fragments_file, container=pm.container)
+
     # "Exact cuts" are what I call nucleotide-resolution tracks of exact bases
     # where the transposition (or DNAse cut) happened;
     # In the past I used wigToBigWig on a combined wig file, but this ends up
     # using a boatload of memory (more than 32GB); in contrast, running the
     # wig -> bw conversion on each chrom and then combining them with bigWigCat
     # requires much less memory. This was a memory bottleneck in the pipeline.
+    # bamSitesToWig.py now streams each chrom's counts to a single bigwig
+    # writer instead, which keeps memory low without the bigWigCat step.
     pm.timestamp("### Produce smoothed and nucleotide-resolution tracks")
 
     exact_folder = os.path.join(map_genome_folder + "_exact")
@@ -859,7 +918,11 @@ def main():
     cmd += " -b " + shift_bed # request bed output
     cmd += " -o " + exact_target
     cmd += " -w " + smooth_target
-    cmd += " -p " + str(max(1, int(pm.cores) * 2/3))
+    cmd += " -p " + str(pm.cores)
+    if args.sparse_tracks:
+        cmd += " --sparse"
+    cmd += " --checkpoint " + os.path.join(temp_exact_folder, "checkpoint")
+    cmd += profile_option("bamSitesToWig")
     cmd2 = "touch " + temp_target
     pm.run([cmd, cmd2], temp_target, container=pm.container)
     pm.clean_add(temp_target)
@@ -878,6 +941,13 @@ def main():
         cmd += " -a " + rmdup_bam + " -b " + res.TSS_file + " -p ends"
         cmd += " -c " + str(pm.cores)
         cmd += " -e 2000 -u -v -s 4 -o " + Tss_enrich
+        # Other site sets are profiled in the same pass over the reads.
+        for site_set in args.enrichment_sites:
+            cmd += " --sites " + site_set
+        Tss_scores = os.path.join(QC_folder, args.sample_name +
+                                  "_TssEnrichment_scores.tsv")
+        cmd += " --scores " + Tss_scores
+        cmd += profile_option("pyTssEnrichment")
         pm.run(cmd, Tss_enrich, nofail=True, container=pm.container)
 
         # Call Rscript to plot TSS Enrichment
@@ -890,18 +960,16 @@ def main():
 
         # Always plot strand specific TSS enrichment.
         # added by Ryan 2/10/17 to calculate TSS score as numeric and to
-        # include in summary stats. This could be done in prettier ways which
-        # I'm open to. Just adding for the idea.
-        with open(Tss_enrich) as f:
-            floats = map(float, f)
-        try:
-            # If the TSS enrichment is 0, don't report
-            Tss_score = ((sum(floats[1950:2050]) / 100) /
-                         (sum(floats[1:200]) / 200))
-            pm.report_result("TSS_Score", Tss_score)
-        except ZeroDivisionError:
-            #print("ZeroDivisionError: {0}".format(err))
-            pass        
+        # include in summary stats. The score (mean insertions at bases
+        # 1950-2050 over bases 1-200) is now computed by pyTssEnrichment.py,
+        # for the TSSs and every other site set.
+        if os.path.isfile(Tss_scores):
+            with open(Tss_scores) as f:
+                for line in f:
+                    name, score = line.split()
+                    # If the TSS enrichment is 0, don't report
+                    if score != "NA":
+                        pm.report_result(name + "_Score", float(score))
         try:
             # Just wrapping this in a try temporarily so that old versions of
             # pypiper will work. v0.6 release of pypiper adds this function           
@@ -0,0 +1,97 @@
+""" Shared fixtures for the tests of the tools. """
+
+import os
+import random
+import sys
+
+import pytest
+
+TEST_PATH = os.path.dirname(__file__)
+TOOLS_PATH = os.path.join(TEST_PATH, "..", "tools")
+sys.path.append(TOOLS_PATH)
+
+# Reference names and lengths of the test BAM.
+CHROM_SIZES = [("chr1", 20000), ("chr2", 8000)]
+READ_LENGTH = 50
+N_PAIRS = 1500
+N_SINGLES = 300
+# CIGARs of the unpaired reads, which the decoders must turn into ends.
+CIGARS = ["50M", "10S40M", "20M5D30M", "20M5I25M", "5H45M", "20M100N30M",
+          "30M2D10M3I7M10S"]
+
+
+def _read(pysam, name, tid, pos, flag, mapq, mate_tid, mate_pos, tlen,
+          cigar="{}M".format(READ_LENGTH)):
+    read = pysam.AlignedSegment()
+    read.query_name = name
+    read.cigarstring = cigar
+    length = read.infer_query_length()
+    read.query_sequence = "A" * length
+    read.query_qualities = pysam.qualitystring_to_array("I" * length)
+    read.flag = flag
+    read.reference_id = tid
+    read.reference_start = pos
+    read.mapping_quality = mapq
+    read.next_reference_id = mate_tid
+    read.next_reference_start = mate_pos
+    read.template_length = tlen
+    return read
+
+
+def write_bam(filename, seed=1, chrom_sizes=CHROM_SIZES, n_pairs=N_PAIRS,
+              n_singles=N_SINGLES):
+    """
+    Write a small sorted, indexed BAM file of properly paired fragments in
+    both orientations, with some duplicates, unpaired reads on either
+    strand with assorted CIGARs and reads of low mapping quality.
+
+    :param str filename: BAM file to write; its index is written next to it
+    :param int seed: seed of the random layout
+    :param list[(str, int)] chrom_sizes: reference names and lengths
+    :param int n_pairs: number of fragments, before duplication
+    :param int n_singles: number of unpaired reads
+    """
+    pysam = pytest.importorskip("pysam")
+    rng = random.Random(seed)
+    header = {"HD": {"VN": "1.0", "SO": "unsorted"},
+              "SQ": [{"SN": c, "LN": size} for c, size in chrom_sizes]}
+    unsorted = filename + ".unsorted.bam"
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as out:
+        for i in range(n_pairs):
+            tid = rng.randrange(len(chrom_sizes))
+            size = chrom_sizes[tid][1]
+            tlen = rng.randint(READ_LENGTH, 700)
+            left = rng.randrange(0, size - tlen)
+            right = left + tlen - READ_LENGTH
+            mapq = rng.choice([0, 10, 30, 42, 60, 60])
+            first, second = rng.choice([(99, 147), (163, 83)])
+            copies = 2 if rng.random() < 0.1 else 1
+            for copy in range(copies):
+                name = "pair{}_{}".format(i, copy)
+                out.write(_read(pysam, name, tid, left, first, mapq,
+                                tid, right, tlen))
+                out.write(_read(pysam, name, tid, right, second, mapq,
+                                tid, left, -tlen))
+        for i in range(n_singles):
+            tid = rng.randrange(len(chrom_sizes))
+            pos = rng.randrange(0, chrom_sizes[tid][1] - 2 * READ_LENGTH)
+            out.write(_read(pysam, "single{}".format(i), tid, pos,
+                            rng.choice([0, 16]), rng.choice([10, 60]),
+                            -1, -1, 0, rng.choice(CIGARS)))
+    pysam.sort("-o", filename, unsorted)
+    pysam.index(filename)
+    os.remove(unsorted)
+
+
+@pytest.fixture(scope="session")
+def bam_file(tmpdir_factory):
+    """ Path to the small test BAM file. """
+    filename = str(tmpdir_factory.mktemp("bam").join("reads.bam"))
+    write_bam(filename)
+    return filename
+
+
+@pytest.fixture(scope="session")
+def chrom_sizes():
+    """ Reference names and lengths of the test BAM file. """
+    return list(CHROM_SIZES)
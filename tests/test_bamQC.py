@@ -0,0 +1,202 @@
+""" Tests for bamQC's streamed duplicate counting. """
+
+import array
+from collections import Counter
+import json
+import logging
+import os
+import random
+
+import numpy as np
+import pytest
+
+from conftest import READ_LENGTH, _read
+import bamcolumns
+import bamQC
+from bamQC import DuplicateCounter, duplicate_stats
+from qcstate import QCState
+from tiling import MANIFEST
+
+pysam = pytest.importorskip("pysam")
+
+CHROM_SIZES = [("chr1", 5000), ("chr2", 5000)]
+BATCH_SIZES = [1, 2, 5]
+
+
+def write_reads(filename, reads):
+    """ Write reads to a sorted, indexed BAM file over CHROM_SIZES. """
+    header = {"HD": {"VN": "1.0", "SO": "unsorted"},
+              "SQ": [{"SN": c, "LN": size} for c, size in CHROM_SIZES]}
+    unsorted = filename + ".unsorted.bam"
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as out:
+        for read in reads:
+            out.write(read)
+    pysam.sort("-o", filename, unsorted)
+    pysam.index(filename)
+    os.remove(unsorted)
+
+
+def pileup_reads(seed=3):
+    """
+    Pairs every few bases along chr1, with up to eight copies of
+    each fragment and several template lengths per position.
+
+    :return (list[pysam.AlignedSegment], Counter): the reads, and how many
+        copies of each (position, template length, mate position) key
+    """
+    rng = random.Random(seed)
+    reads, keys = [], Counter()
+    for i, left in enumerate(range(100, 4500, 7)):
+        for tlen in rng.sample(range(READ_LENGTH, 400), rng.randint(1, 3)):
+            right = left + tlen - READ_LENGTH
+            copies = rng.choice([1, 1, 2, 2, 3, 8])
+            keys[(left, tlen, right)] += copies
+            for copy in range(copies):
+                name = "pair{}_{}_{}".format(i, tlen, copy)
+                reads.append(_read(pysam, name, 0, left, 99, 60, 0, right,
+                                   tlen))
+                reads.append(_read(pysam, name, 0, right, 147, 60, 0, left,
+                                   -tlen))
+    return reads, keys
+
+
+@pytest.fixture
+def run_qc(tmpdir, monkeypatch):
+    """
+    Run bamQC in this process, as bamQC.py would.
+
+    :return callable: takes the BAM file and bamQC settings, and returns
+        the merged QC state
+    """
+    # The script sets up its logger when run from the command line.
+    monkeypatch.setattr(bamQC, "_LOGGER", logging.getLogger("bamQC"),
+                        raising=False)
+
+    def run(bam_file, **settings):
+        state_file = str(tmpdir.join("qc.state"))
+        qc = bamQC.bamQC(bam_file, 1, str(tmpdir.join("qc.tsv")), None,
+                         state_file=state_file, **settings)
+        qc.register_files()
+        qc.combine(qc.run())
+        return QCState.load(state_file)
+    return run
+
+
+class TestDuplicateCounter:
+    """ Counting in position-aligned batches matches counting at once. """
+
+    @pytest.mark.parametrize("batch_size", BATCH_SIZES)
+    def test_batches(self, batch_size):
+        """ Same histogram and M2, whatever the batch size. """
+        rng = np.random.RandomState(0)
+        pos = np.sort(rng.randint(0, 30, 400))
+        tlen = rng.randint(0, 3, 400)
+        whole = DuplicateCounter(2, 1)
+        whole.add(pos, tlen)
+        whole.flush()
+        batched = DuplicateCounter(2, 1, batch_size)
+        for start in range(0, len(pos), 3):
+            batched.add(pos[start:start + 3], tlen[start:start + 3])
+        batched.flush()
+        assert np.array_equal(batched.state.histogram, whole.state.histogram)
+        assert batched.state["M2"] == whole.state["M2"]
+        assert batched.state["dup_reads"] == whole.state["dup_reads"]
+
+    def test_histogram(self):
+        """ Element k counts the keys seen k times. """
+        keys = [array.array("l", values) for values in
+                ([1, 1, 1, 2, 2, 3, 3, 3], [5, 5, 6, 5, 5, 7, 7, 8])]
+        histogram, M2 = duplicate_stats(keys, 1)
+        # Keys (1, 5), (2, 5) and (3, 7) twice, (1, 6) and (3, 8) once.
+        assert histogram.tolist() == [0, 2, 3]
+        # Each position's duplicated keys hold exactly two reads.
+        assert M2 == 3
+
+
+class TestBamQC:
+    """ Duplicate statistics of whole runs. """
+
+    @pytest.fixture
+    def pileup_bam(self, tmpdir):
+        reads, keys = pileup_reads()
+        filename = str(tmpdir.join("pileup.bam"))
+        write_reads(filename, reads)
+        return filename, keys
+
+    @pytest.mark.parametrize("batch_size", BATCH_SIZES)
+    def test_batch_size(self, pileup_bam, run_qc, monkeypatch, batch_size):
+        """ Histogram, M1, M2 and NRF equal those of a one-batch count. """
+        bam_file, keys = pileup_bam
+        # Decode a block at a time, so that reads arrive in many batches.
+        monkeypatch.setattr(bamcolumns, "BLOCKS_PER_ROUND", 1)
+        whole = run_qc(bam_file, batch_size=0)
+        assert whole.histogram.tolist() == \
+            np.bincount(list(keys.values())).tolist()
+        batched = run_qc(bam_file, batch_size=batch_size)
+        assert np.array_equal(batched.histogram, whole.histogram)
+        # Total, distinct, M1, M2, ..., NRF, PBC1, PBC2
+        assert batched.metrics() == whole.metrics()
+        assert batched["M2"] == whole["M2"]
+
+    def test_keys(self, tmpdir, run_qc):
+        """
+        Read1 of a pair with its mate on the same chromosome is keyed by
+        position, template length and mate position; reads of single-end
+        chromosomes by position and read length. Discordant pairs, whose
+        mate is on another chromosome, count as pairs but are not keyed.
+        """
+        reads = [
+            # Two copies of a fragment, and one with another length.
+            _read(pysam, "a", 0, 100, 99, 60, 0, 250, 200),
+            _read(pysam, "a", 0, 250, 147, 60, 0, 100, -200),
+            _read(pysam, "b", 0, 100, 99, 60, 0, 250, 200),
+            _read(pysam, "b", 0, 250, 147, 60, 0, 100, -200),
+            _read(pysam, "c", 0, 100, 99, 60, 0, 300, 250),
+            _read(pysam, "c", 0, 300, 147, 60, 0, 100, -250),
+            # Read2 leftmost: keyed from read1, at the mate's position.
+            _read(pysam, "d", 0, 100, 163, 60, 0, 250, 200),
+            _read(pysam, "d", 0, 250, 83, 60, 0, 100, -200),
+            # Two discordant pairs at one position, mates on chr2.
+            _read(pysam, "e", 0, 1000, 97, 60, 1, 1000, 0),
+            _read(pysam, "f", 0, 1000, 97, 60, 1, 1000, 0),
+        ]
+        # Single-end chr2: two copies of a read, and one of another length.
+        for name, cigar in [("s", "50M"), ("t", "50M"), ("u", "40M")]:
+            reads.append(_read(pysam, name, 1, 2000, 0, 60, -1, -1, 0,
+                               cigar))
+        bam_file = str(tmpdir.join("keys.bam"))
+        write_reads(bam_file, reads)
+        state = run_qc(bam_file)
+        assert state["paired_reads"] == 10
+        assert state["se_reads"] == 3
+        # chr1: (100, 200, 250) twice, (100, 250, 300) and (250, -200, 100)
+        # once; chr2: (2000, 50) twice and (2000, 40) once.
+        assert state.distinct == 5
+        assert state.histogram.tolist() == [0, 3, 2]
+        assert state["dup_reads"] == 4
+        assert state["M2"] == 2
+
+    def test_resume(self, pileup_bam, run_qc, tmpdir, monkeypatch):
+        """ A rerun after a kill processes only the unfinished tiles. """
+        bam_file, _ = pileup_bam
+        folder = str(tmpdir.join("checkpoint"))
+        full = run_qc(bam_file, tile_size=1000, checkpoint=folder)
+        manifest = os.path.join(folder, MANIFEST)
+        with open(manifest) as f:
+            lines = f.read().splitlines()
+        # Killed after two tiles, while recording the third.
+        with open(manifest, "w") as f:
+            f.write("\n".join(lines[:3]) + "\n" + lines[3][:10])
+        ran = []
+        call = bamQC.bamQC.__call__
+
+        def counted(self, task):
+            ran.append(task)
+            return call(self, task)
+        monkeypatch.setattr(bamQC.bamQC, "__call__", counted)
+        resumed = run_qc(bam_file, tile_size=1000, checkpoint=folder)
+        finished = [json.loads(line)["task"] for line in lines[1:3]]
+        assert sorted(ran + finished) == \
+            sorted(json.loads(line)["task"] for line in lines[1:])
+        assert resumed.metrics() == full.metrics()
+        assert np.array_equal(resumed.histogram, full.histogram)
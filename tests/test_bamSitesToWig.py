@@ -0,0 +1,341 @@
+""" Tests for the cut counting kernels of bamSitesToWig. """
+
+import logging
+import os
+import random
+import shutil
+import subprocess
+
+import numpy as np
+import pytest
+
+from conftest import TOOLS_PATH, write_bam
+import bamSitesToWig
+from bamcolumns import BamColumns
+from bamSitesToWig import (CutTracer, TrackWriter, count_cuts,
+                           get_shifted_pos, nonzero_runs, shifted_cuts,
+                           smooth_samples)
+from tiling import make_tasks, parse_task
+
+pysam = pytest.importorskip("pysam")
+pyBigWig = pytest.importorskip("pyBigWig")
+
+SHIFT_FACTOR = {"+": 4, "-": -5}
+
+
+def reference_cuts(bam_file, chrom):
+    """ Sorted cut sites, shifted read by read as the original tool did. """
+    with pysam.AlignmentFile(bam_file) as bam:
+        cuts = [get_shifted_pos(read, SHIFT_FACTOR)
+                for read in bam.fetch(chrom)]
+    return sorted(c for c in cuts if c is not None)
+
+
+def run_perl(script, args, cuts, sparse=False):
+    """
+    Pipe sorted cuts through one of the Perl track writers.
+
+    In fixedStep mode the scripts never emit the count of the last cut they
+    read, so callers put a sentinel past the end of the chromosome last.
+
+    :return numpy.ndarray: the values of the fixedStep output, or the
+        position and value columns of the variableStep output
+    """
+    header = "variableStep chrom=test\n" if sparse \
+        else "fixedStep chrom=test start=1 step=1\n"
+    text = header + "".join("{}\n".format(c) for c in cuts)
+    out = subprocess.check_output(
+        ["perl", os.path.join(TOOLS_PATH, script)] + [str(a) for a in args],
+        input=text.encode()).decode().splitlines()
+    assert out[0] == header.strip()
+    if sparse:
+        return np.array([line.split("\t") for line in out[1:]],
+                        dtype=np.int64).reshape(-1, 2).T
+    return np.array(out[1:], dtype=np.int64)
+
+
+needs_perl = pytest.mark.skipif(shutil.which("perl") is None,
+                                reason="perl is not installed")
+
+
+def read_track(filename):
+    """ Values of a bigwig, by chromosome, with 0 where nothing is set. """
+    bw = pyBigWig.open(filename)
+    try:
+        return dict((chrom, np.nan_to_num(np.array(bw.values(chrom, 0, size))))
+                    for chrom, size in bw.chroms().items())
+    finally:
+        bw.close()
+
+
+@pytest.fixture
+def trace(tmpdir, monkeypatch):
+    """
+    Run CutTracer in this process, as bamSitesToWig.py would.
+
+    :return callable: takes the BAM file, chromosome sizes and CutTracer
+        settings, and returns the output file name and the tracer
+    """
+    # The script sets up its logger when run from the command line.
+    monkeypatch.setattr(bamSitesToWig, "_LOGGER",
+                        logging.getLogger("bamSitesToWig"), raising=False)
+
+    def run(bam_file, chrom_sizes, cores=1, **settings):
+        sizes = tmpdir.join("chrom.sizes")
+        sizes.write("".join("{}\t{}\n".format(c, n) for c, n in chrom_sizes))
+        outfile = str(tmpdir.join("cuts.bw"))
+        tracer = CutTracer(bam_file, str(sizes), str(tmpdir), cores, outfile,
+                           None, None, **settings)
+        tracer.register_files()
+        tracer.combine(tracer.run())
+        return outfile, tracer
+    return run
+
+
+class TestShiftedCuts:
+    """ Batched shifting matches shifting read by read. """
+
+    def test_matches_get_shifted_pos(self, bam_file, chrom_sizes):
+        """ Same cuts as get_shifted_pos, for every flag in the file. """
+        for chrom, _ in chrom_sizes:
+            cuts = [shifted_cuts(batch, SHIFT_FACTOR)[0]
+                    for batch in BamColumns(bam_file).fetch(chrom)]
+            assert sorted(np.concatenate(cuts).tolist()) == \
+                reference_cuts(bam_file, chrom)
+
+    def test_mask_selects_reads_with_a_cut(self, bam_file, chrom_sizes):
+        """ The mask keeps exactly the reads get_shifted_pos shifts. """
+        chrom = chrom_sizes[0][0]
+        batch = next(BamColumns(bam_file).fetch(chrom))
+        cuts, keep = shifted_cuts(batch, SHIFT_FACTOR)
+        assert len(cuts) == keep.sum()
+        with pysam.AlignmentFile(bam_file) as bam:
+            expected = [get_shifted_pos(read, SHIFT_FACTOR) is not None
+                        for read in bam.fetch(chrom)][:len(keep)]
+        assert keep.tolist() == expected
+
+
+class TestCountCuts:
+    """ Tallying cuts in memory. """
+
+    def test_counts_and_clips(self):
+        """ Distinct sorted positions; cuts off the chromosome dropped. """
+        positions, counts = count_cuts([5, 3, 5, 0, -2, 11, 10, 5], 10)
+        assert positions.tolist() == [3, 5, 10]
+        assert counts.tolist() == [1, 3, 1]
+
+    def test_empty(self):
+        """ No cuts give empty arrays. """
+        positions, counts = count_cuts([], 10)
+        assert len(positions) == 0 and len(counts) == 0
+
+    @needs_perl
+    def test_matches_cutsToWig(self, bam_file, chrom_sizes):
+        """ Same per-base counts as sort -n | cutsToWig.pl. """
+        for chrom, size in chrom_sizes:
+            cuts = reference_cuts(bam_file, chrom)
+            expected = run_perl("cutsToWig.pl", [size], cuts + [size + 1])
+            positions, counts = count_cuts(cuts, size)
+            dense = np.zeros(size, dtype=np.int64)
+            dense[positions - 1] = counts
+            assert len(expected) == size
+            assert np.array_equal(dense, expected)
+
+
+class TestSmoothSamples:
+    """ Smoothed tracks from the running total of the cut counts. """
+
+    def test_window(self):
+        """ A cut at c counts at every sample in [c - smooth, c + smooth). """
+        positions, counts = np.array([10]), np.array([2])
+        samples, values = smooth_samples(positions, counts, 0, 20, 1, 3)
+        assert samples.tolist() == list(range(7, 13))
+        assert values.tolist() == [2] * 6
+
+    @pytest.mark.parametrize("step", [1, 5, 7, 20])
+    @pytest.mark.parametrize("smooth_length", [1, 25])
+    def test_tiles_join_up(self, bam_file, chrom_sizes, step, smooth_length):
+        """ Samples of adjacent regions join into those of the whole. """
+        chrom, size = chrom_sizes[0]
+        positions, counts = count_cuts(reference_cuts(bam_file, chrom), size)
+        whole = smooth_samples(positions, counts, 0, size, step,
+                               smooth_length)
+        tiles = [smooth_samples(positions, counts, start,
+                                min(start + 3001, size), step, smooth_length)
+                 for start in range(0, size, 3001)]
+        for i in range(2):
+            assert np.array_equal(whole[i],
+                                  np.concatenate([t[i] for t in tiles]))
+
+    @needs_perl
+    @pytest.mark.parametrize("step", [1, 5, 7, 20])
+    @pytest.mark.parametrize("smooth_length", [1, 25])
+    def test_matches_smoothWig(self, bam_file, chrom_sizes, step,
+                               smooth_length):
+        """
+        Same values as smoothWig.pl at every step of the fixedStep grid
+        (start=1), and nothing in between.
+        """
+        for chrom, size in chrom_sizes:
+            cuts = reference_cuts(bam_file, chrom)
+            expected = run_perl("smoothWig.pl", [size, smooth_length, 1],
+                                cuts + [size + smooth_length + 1])[:size]
+            positions, counts = count_cuts(cuts, size)
+            samples, values = smooth_samples(positions, counts, 0, size,
+                                             step, smooth_length)
+            assert np.all((samples - 1) % step == 0)
+            dense = np.zeros(size, dtype=np.int64)
+            dense[samples - 1] = values
+            assert np.array_equal(dense[::step], expected[::step])
+
+
+class TestNonzeroRuns:
+    """ Collapsing sparse signal into bedGraph intervals. """
+
+    def test_runs(self):
+        """ Adjacent equal values merge; gaps and changes split. """
+        starts, ends, values = nonzero_runs(np.array([2, 3, 4, 6, 7, 8]),
+                                            np.array([1, 1, 2, 2, 2, 5]))
+        assert starts.tolist() == [1, 3, 5, 7]
+        assert ends.tolist() == [3, 4, 7, 8]
+        assert values.tolist() == [1.0, 2.0, 2.0, 5.0]
+
+    def test_empty(self):
+        """ No signal gives no intervals. """
+        starts, ends, values = nonzero_runs(np.array([], dtype=np.int64),
+                                            np.array([], dtype=np.int64))
+        assert len(starts) == len(ends) == len(values) == 0
+
+    @needs_perl
+    def test_matches_sparse_cutsToWig(self, bam_file, chrom_sizes):
+        """
+        The intervals cover exactly the sites cutsToWig.pl lists in
+        variableStep mode, with their counts, and are as long as possible.
+        """
+        for chrom, size in chrom_sizes:
+            cuts = reference_cuts(bam_file, chrom)
+            expected_positions, expected_counts = run_perl(
+                "cutsToWig.pl", [size], cuts, sparse=True)
+            starts, ends, values = nonzero_runs(*count_cuts(cuts, size))
+            lengths = ends - starts
+            positions = np.concatenate(
+                [np.arange(s, e) for s, e in zip(starts, ends)]) + 1
+            assert np.array_equal(positions, expected_positions)
+            assert np.array_equal(np.repeat(values, lengths),
+                                  expected_counts)
+            joined = (starts[1:] == ends[:-1]) & (values[1:] == values[:-1])
+            assert not joined.any()
+
+
+class TestTrackWriter:
+    """ Writing blocks into one bigwig as tasks finish. """
+
+    CHROM_SIZES = [("chrA", 9000), ("chrB", 7000), ("chrC", 9000),
+                   ("chrD", 5000)]
+
+    def test_out_of_order(self, tmpdir):
+        """
+        Blocks finishing in any order within a window of tasks in flight
+        are written correctly, and no more than that window waits.
+        """
+        rng = np.random.RandomState(4)
+        tasks = make_tasks(self.CHROM_SIZES, 2000)
+        sizes = dict(self.CHROM_SIZES)
+        expected, blocks = {}, {}
+        for chrom, size in self.CHROM_SIZES:
+            expected[chrom] = rng.poisson(0.5, size)
+        for task in tasks:
+            chrom, start, end = parse_task(task, sizes)
+            positions = np.flatnonzero(expected[chrom][start:end]) + start + 1
+            blocks[task] = (chrom, start, end, positions,
+                            expected[chrom][positions - 1])
+        in_flight = 4
+        finished = []
+        for first in range(0, len(tasks), in_flight):
+            window = tasks[first:first + in_flight]
+            random.Random(first).shuffle(window)
+            finished.extend(window)
+        filename = str(tmpdir.join("track.bw"))
+        writer = TrackWriter(filename, self.CHROM_SIZES, tasks)
+        peak = 0
+        for task in finished:
+            writer.add(task, blocks[task])
+            peak = max(peak, len(writer.pending))
+        writer.close()
+        assert peak < in_flight
+        assert not writer.pending
+        found = read_track(filename)
+        for chrom, values in expected.items():
+            assert np.array_equal(found[chrom], values)
+
+    def test_tiles_stream(self, tmpdir, trace, monkeypatch):
+        """
+        A tiled run collects blocks in the order they are written, however
+        the chromosomes' last, short tiles compare with the others.
+        """
+        bam_file = str(tmpdir.join("many.bam"))
+        write_bam(bam_file, chrom_sizes=self.CHROM_SIZES, n_pairs=2000)
+        peaks = []
+        add = TrackWriter.add
+
+        def tracked_add(writer, task, block):
+            add(writer, task, block)
+            peaks.append(len(writer.pending))
+        monkeypatch.setattr(TrackWriter, "add", tracked_add)
+        outfile, _ = trace(bam_file, self.CHROM_SIZES, tile_size=2000,
+                           smoothbw=str(tmpdir.join("smooth.bw")))
+        assert len(peaks) == 2 * len(make_tasks(self.CHROM_SIZES, 2000))
+        assert max(peaks) == 0
+        found = read_track(outfile)
+        for chrom, size in self.CHROM_SIZES:
+            positions, counts = count_cuts(reference_cuts(bam_file, chrom),
+                                           size)
+            expected = np.zeros(size)
+            expected[positions - 1] = counts
+            assert np.array_equal(found[chrom], expected)
+
+
+class TestNormalize:
+    """ Normalized tracks written next to the raw ones. """
+
+    def test_cpm(self, bam_file, chrom_sizes, trace):
+        """ The cpm track is the raw one times 1e6 / mapped reads. """
+        outfile, _ = trace(bam_file, chrom_sizes, tile_size=3001,
+                           normalize="cpm")
+        with pysam.AlignmentFile(bam_file) as bam:
+            mapped = sum(s.mapped for s in bam.get_index_statistics())
+        raw = read_track(outfile)
+        scaled = read_track(outfile.replace(".bw", "_cpm.bw"))
+        for chrom, _ in chrom_sizes:
+            assert raw[chrom].sum() > 0
+            assert scaled[chrom].sum() == \
+                pytest.approx(1e6 * raw[chrom].sum() / mapped, rel=1e-6)
+            assert np.allclose(scaled[chrom], raw[chrom] * 1e6 / mapped,
+                               rtol=1e-6)
+
+
+class TestFragmentBins:
+    """ Tracks restricted to fragment length bins. """
+
+    BINS = [("nfr", 0, 100), ("mono", 180, 247), ("any", 0, 100000)]
+
+    @pytest.mark.parametrize("tile_size", [None, 3001])
+    def test_bin_totals(self, bam_file, chrom_sizes, trace, tile_size):
+        """
+        Each bin holds the cuts of the fragments whose length it spans, and
+        no reads without a fragment length.
+        """
+        outfile, _ = trace(bam_file, chrom_sizes, tile_size=tile_size,
+                           fragment_bins=self.BINS)
+        with pysam.AlignmentFile(bam_file) as bam:
+            for chrom, _ in chrom_sizes:
+                lengths = [abs(read.template_length)
+                           for read in bam.fetch(chrom)
+                           if get_shifted_pos(read, SHIFT_FACTOR) is not None]
+                assert lengths.count(0)
+                for name, lo, hi in self.BINS:
+                    track = read_track(outfile.replace(".bw",
+                                                       "_" + name + ".bw"))
+                    expected = sum(1 for n in lengths if 0 < n and
+                                   lo <= n < hi)
+                    assert track[chrom].sum() == expected
@@ -0,0 +1,120 @@
+""" Tests for decoding BAM records into NumPy columns. """
+
+import shutil
+
+import numpy as np
+import pytest
+
+import bamcolumns
+from bamcolumns import COLUMNS, BamColumns
+
+pysam = pytest.importorskip("pysam")
+
+
+def pysam_columns(bam_file, chrom, start=None, end=None, min_mapq=0,
+                  require_flags=0, exclude_flags=0):
+    """ The columns of the matching reads, read by read through pysam. """
+    rows = []
+    with pysam.AlignmentFile(bam_file) as bam:
+        for read in bam.fetch(chrom, start, end):
+            if read.mapping_quality < min_mapq or \
+                    read.flag & require_flags != require_flags or \
+                    read.flag & exclude_flags:
+                continue
+            rows.append([read.flag, read.reference_start, read.reference_end,
+                         read.template_length, read.mapping_quality,
+                         read.is_reverse, read.next_reference_id,
+                         read.next_reference_start, read.query_length])
+    return dict((name, np.array([r[i] for r in rows], dtype=np.int64))
+                for i, name in enumerate(COLUMNS))
+
+
+def joined(batches):
+    """ Concatenate batches column by column. """
+    batches = list(batches)
+    return dict((name, np.concatenate([b[name] for b in batches])
+                 .astype(np.int64) if batches else np.zeros(0, np.int64))
+                for name in COLUMNS)
+
+
+def assert_same(found, expected):
+    for name in COLUMNS:
+        assert np.array_equal(found[name], expected[name]), name
+
+
+@pytest.fixture(scope="module")
+def csi_bam(bam_file, tmpdir_factory):
+    """ A copy of the test BAM file with a CSI index instead of a BAI. """
+    filename = str(tmpdir_factory.mktemp("csi").join("reads.bam"))
+    shutil.copy(bam_file, filename)
+    pysam.index("-c", filename)
+    return filename
+
+
+class TestFetch:
+    """ Native decoding gives the same reads and fields as pysam. """
+
+    REGIONS = [(None, None), (0, 1000), (4990, 5010), (16000, 16385),
+               (7950, None), (19999, 20000)]
+
+    @pytest.mark.parametrize(["start", "end"], REGIONS)
+    def test_regions(self, bam_file, chrom_sizes, start, end):
+        """ Reads overlapping a region, in file order. """
+        bam = BamColumns(bam_file)
+        assert bam.linear_index is not None
+        for chrom, _ in chrom_sizes:
+            assert_same(joined(bam.fetch(chrom, start, end)),
+                        pysam_columns(bam_file, chrom, start, end))
+
+    @pytest.mark.parametrize("filters", [
+        dict(min_mapq=30), dict(exclude_flags=0x10),
+        dict(require_flags=0x1, exclude_flags=0x400),
+        dict(min_mapq=60, require_flags=0x40)])
+    def test_filters(self, bam_file, chrom_sizes, filters):
+        """ MAPQ and flag filters applied while decoding. """
+        bam = BamColumns(bam_file)
+        for chrom, _ in chrom_sizes:
+            assert_same(joined(bam.fetch(chrom, 1000, 15000, **filters)),
+                        pysam_columns(bam_file, chrom, 1000, 15000,
+                                      **filters))
+
+    def test_one_block_per_batch(self, bam_file, chrom_sizes, monkeypatch):
+        """ Records split across batches are joined up. """
+        monkeypatch.setattr(bamcolumns, "BLOCKS_PER_ROUND", 1)
+        for chrom, _ in chrom_sizes:
+            batches = list(BamColumns(bam_file).fetch(chrom))
+            assert len(batches) > 1
+            assert_same(joined(batches), pysam_columns(bam_file, chrom))
+
+    def test_threads(self, bam_file, chrom_sizes):
+        """ Inflating blocks in threads changes nothing. """
+        chrom = chrom_sizes[0][0]
+        assert_same(joined(BamColumns(bam_file, threads=3).fetch(chrom)),
+                    joined(BamColumns(bam_file).fetch(chrom)))
+
+    def test_batch_types(self, bam_file, chrom_sizes):
+        """ is_reverse is a mask; batches are never empty. """
+        for batch in BamColumns(bam_file).fetch(chrom_sizes[0][0]):
+            assert batch["is_reverse"].dtype == bool
+            assert len(batch["pos"])
+            assert np.array_equal(batch["is_reverse"],
+                                  (batch["flag"] & 0x10) != 0)
+
+    def test_unknown_reference(self, bam_file):
+        with pytest.raises(ValueError):
+            list(BamColumns(bam_file).fetch("chrUn"))
+
+
+class TestFallback:
+    """ Without a BAI index, reads come through pysam in the same form. """
+
+    @pytest.mark.parametrize(["start", "end"], [(None, None), (100, 9000)])
+    def test_matches_native(self, bam_file, csi_bam, chrom_sizes,
+                            start, end):
+        native = BamColumns(bam_file)
+        fallback = BamColumns(csi_bam)
+        assert fallback.linear_index is None
+        for chrom, _ in chrom_sizes:
+            assert_same(
+                joined(fallback.fetch(chrom, start, end, min_mapq=30)),
+                joined(native.fetch(chrom, start, end, min_mapq=30)))
@@ -0,0 +1,118 @@
+""" Tests for counting cuts by feature and barcode. """
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from barcodes import FeatureSet, count_by_feature, write_matrix
+
+CHROM_SIZES = [("chr1", 1000), ("chr2", 250)]
+
+
+def count_loop(cuts, codes, starts, ends):
+    """ (feature, code) -> count, cut by cut and feature by feature. """
+    counts = Counter()
+    for cut, code in zip(cuts, codes):
+        if code < 0:
+            continue
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            # Cuts are 1-based; features are 0-based and half-open.
+            if start < cut <= end:
+                counts[(i, code)] += 1
+    return counts
+
+
+class TestCountByFeature:
+    """ Cut counts by feature and barcode. """
+
+    def test_matches_loop(self):
+        """ Overlapping features, unbarcoded cuts and cuts on the edges. """
+        rng = np.random.RandomState(7)
+        cuts = rng.randint(1, 1001, 3000)
+        codes = rng.randint(-1, 25, 3000)
+        starts = np.sort(rng.randint(0, 950, 60))
+        ends = starts + rng.randint(1, 120, 60)
+        cuts[:60] = starts + 1
+        cuts[60:120] = ends
+        cuts[120:180] = starts
+        index, code, count = count_by_feature(cuts, codes, starts, ends)
+        found = dict(((i, c), n) for i, c, n in zip(index, code, count))
+        assert found == count_loop(cuts, codes, starts, ends)
+        keys = list(zip(index.tolist(), code.tolist()))
+        assert keys == sorted(keys)
+
+    def test_nothing_counted(self):
+        """ No cuts in any feature give empty arrays. """
+        for cuts, codes in [([5, 6], [-1, -1]), ([500], [0]), ([], [])]:
+            index, code, count = count_by_feature(
+                np.array(cuts, dtype=np.int64),
+                np.array(codes, dtype=np.int64),
+                np.array([10]), np.array([20]))
+            assert len(index) == len(code) == len(count) == 0
+
+
+class TestFeatureSet:
+    """ Features from a BED file or fixed bins. """
+
+    def test_bed(self, tmpdir):
+        """ Features are sorted per chromosome; other lines are skipped. """
+        bed = tmpdir.join("peaks.bed")
+        bed.write("track name=peaks\n"
+                  "chr2\t100\t200\tp1\n"
+                  "chr1\t500\t600\n"
+                  "chr1\t50\t400\n"
+                  "chrUn\t0\t10\n"
+                  "chr1\t50\t100\n")
+        features = FeatureSet(CHROM_SIZES, bed_file=str(bed))
+        assert features.n_features == 4
+        assert features.max_length == 350
+        ids, starts, ends = features.owned("chr1", 0, 1000)
+        assert ids.tolist() == [0, 1, 2]
+        assert starts.tolist() == [50, 50, 500]
+        assert ends.tolist() == [100, 400, 600]
+        ids, starts, ends = features.owned("chr2", 0, 250)
+        assert ids.tolist() == [3]
+
+    def test_bins(self):
+        """ Bins tile every chromosome; the last one may be short. """
+        features = FeatureSet(CHROM_SIZES, bin_size=300)
+        assert features.n_features == 5
+        ids, starts, ends = features.owned("chr1", 0, 1000)
+        assert starts.tolist() == [0, 300, 600, 900]
+        assert ends.tolist() == [300, 600, 900, 1000]
+
+    def test_owned_by_one_tile(self):
+        """ Each feature belongs to the tile its start falls in. """
+        features = FeatureSet(CHROM_SIZES, bin_size=70)
+        owned = np.concatenate(
+            [features.owned("chr1", start, min(start + 256, 1000))[0]
+             for start in range(0, 1000, 256)])
+        assert owned.tolist() == list(range(features.offsets["chr2"]))
+
+    def test_needs_features(self):
+        with pytest.raises(ValueError):
+            FeatureSet(CHROM_SIZES)
+
+
+class TestWriteMatrix:
+    """ Merging per-task counts into a Matrix Market file. """
+
+    def test_matrix(self, tmpdir):
+        features = FeatureSet(CHROM_SIZES, bin_size=500)
+        files = [str(tmpdir.join("a")), str(tmpdir.join("missing")),
+                 str(tmpdir.join("b"))]
+        with open(files[0], "w") as f:
+            f.write("0\tAAC\t3\n1\tGGT\t1\n")
+        with open(files[2], "w") as f:
+            f.write("2\tAAC\t7\n")
+        prefix = str(tmpdir.join("sample"))
+        assert write_matrix(prefix, files, features) == (2, 3)
+        with open(prefix + "_matrix.mtx") as f:
+            lines = f.read().splitlines()
+        assert lines[0].startswith("%%MatrixMarket")
+        assert lines[1:] == ["3 2 3", "1 1 3", "2 2 1", "3 1 7"]
+        with open(prefix + "_barcodes.tsv") as f:
+            assert f.read().split() == ["AAC", "GGT"]
+        with open(prefix + "_features.bed") as f:
+            assert len(f.readlines()) == 3
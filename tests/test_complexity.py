@@ -0,0 +1,75 @@
+""" Tests for the library complexity curve. """
+
+import numpy as np
+import pytest
+
+from complexity import complexity_curve, fit_ztnb
+
+LIBRARY = 50000
+MEAN = 1.5
+SIZE = 2.0
+
+
+def sampled_histogram(seed=0, library=LIBRARY, mean=MEAN, size=SIZE):
+    """
+    Duplicate histogram of a library whose fragments' copy numbers are
+    negative binomial; fragments never seen are left out, as in bamQC.
+
+    :return numpy.ndarray: element k is the number of fragments seen k times
+    """
+    rng = np.random.RandomState(seed)
+    copies = rng.negative_binomial(size, size / (size + mean), library)
+    histogram = np.bincount(copies)
+    histogram[0] = 0
+    return histogram
+
+
+class TestFit:
+    """ Fitting the zero-truncated negative binomial. """
+
+    @pytest.mark.parametrize("seed", [0, 1, 2])
+    def test_recovers_parameters(self, seed):
+        """ Mean and size of the sampled library, within tolerance. """
+        mean, size = fit_ztnb(sampled_histogram(seed))
+        assert mean == pytest.approx(MEAN, rel=0.05)
+        assert size == pytest.approx(SIZE, rel=0.15)
+
+    def test_recovers_library_size(self):
+        """ Distinct molecules, including those never sequenced. """
+        _, _, library = complexity_curve(sampled_histogram())
+        assert library == pytest.approx(LIBRARY, rel=0.05)
+
+    @pytest.mark.parametrize("histogram", [[0, 500], [0], [0, 0, 0]])
+    def test_no_duplicates(self, histogram):
+        """ Without duplicates there is no saturation to fit. """
+        assert fit_ztnb(histogram) is None
+
+
+class TestCurve:
+    """ Expected distinct fragments against depth. """
+
+    def test_observed_depth(self):
+        """ At the sequenced depth the curve is the distinct count seen. """
+        histogram = sampled_histogram()
+        k = np.arange(len(histogram))
+        depths, distinct, _ = complexity_curve(histogram, max_fold=10,
+                                               points=100)
+        observed = np.flatnonzero(np.isclose(depths, (k * histogram).sum()))
+        assert len(observed) == 1
+        assert distinct[observed[0]] == histogram[1:].sum()
+
+    @pytest.mark.parametrize("histogram", [sampled_histogram(),
+                                           [0, 300, 25, 4]])
+    def test_monotone(self, histogram):
+        """ Distinct fragments grow with depth, short of the library. """
+        depths, distinct, library = complexity_curve(histogram, max_fold=20)
+        assert np.all(np.diff(depths) > 0)
+        assert np.all(np.diff(distinct) > 0)
+        assert distinct[-1] < library
+
+    def test_unsaturated(self):
+        """ Without duplicates, distinct fragments grow with depth. """
+        depths, distinct, library = complexity_curve([0, 500], max_fold=4,
+                                                     points=8)
+        assert library == float("inf")
+        assert distinct == pytest.approx(depths)
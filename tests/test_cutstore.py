@@ -0,0 +1,116 @@
+""" Tests for the per-base cut count store. """
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+from cutstore import INDEX_FILE, CutStore, create_store, write_counts
+
+CHROM_SIZES = [("chr1", 5000), ("chr2", 1200)]
+
+
+@pytest.fixture
+def dense():
+    """ Random per-base counts for each chromosome. """
+    rng = np.random.RandomState(3)
+    return dict((chrom, rng.poisson(0.3, size) * (rng.rand(size) < 0.5))
+                for chrom, size in CHROM_SIZES)
+
+
+@pytest.fixture
+def store(tmpdir, dense):
+    """ A store holding the dense counts, written in two halves. """
+    path = str(tmpdir.join("cuts"))
+    create_store(path, CHROM_SIZES, meta={"shift": 4})
+    for chrom, counts in dense.items():
+        positions = np.flatnonzero(counts) + 1
+        half = len(positions) // 2
+        for part in [slice(0, half), slice(half, None)]:
+            write_counts(path, chrom, positions[part],
+                         counts[positions[part] - 1])
+    return CutStore(path)
+
+
+def region_loop(dense, chroms, starts, ends):
+    """ Region totals, one slice at a time. """
+    totals = []
+    for chrom, start, end in zip(chroms, starts, ends):
+        counts = dense.get(chrom, np.zeros(0, dtype=np.int64))
+        totals.append(int(counts[max(start, 0):max(end, 0)].sum()))
+    return totals
+
+
+class TestCutStore:
+    """ Writing counts and querying regions. """
+
+    def test_counts(self, store, dense):
+        """ Counts read back base for base. """
+        assert store.chroms == dict(CHROM_SIZES)
+        assert store.meta == {"shift": 4}
+        for chrom, counts in dense.items():
+            assert np.array_equal(store.chrom_counts(chrom), counts)
+            assert np.array_equal(store.counts(chrom, 100, 250),
+                                  counts[100:250])
+
+    def test_sums(self, store, dense):
+        """ Region totals match slicing each region on its own. """
+        rng = np.random.RandomState(5)
+        n = 500
+        chroms = rng.choice(["chr1", "chr2", "chrUn"], n)
+        starts = rng.randint(-100, 5200, n)
+        ends = starts + rng.randint(-10, 800, n)
+        assert store.sums(chroms, starts, ends).tolist() == \
+            region_loop(dense, chroms, starts, ends)
+
+    def test_sums_edges(self, store, dense):
+        """ Empty, whole-chromosome and off-the-end regions. """
+        chroms = ["chr1", "chr1", "chr2", "chr2", "chrUn"]
+        starts = [10, 0, 1100, 1300, 0]
+        ends = [10, 5000, 1500, 1400, 100]
+        assert store.sums(chroms, starts, ends).tolist() == \
+            [0, int(dense["chr1"].sum()), int(dense["chr2"][1100:].sum()),
+             0, 0]
+        assert len(store.sums([], [], [])) == 0
+
+    def test_profiles(self, store, dense):
+        """ Windows around centers, padded off the ends, '-' reversed. """
+        chroms = ["chr1", "chr2", "chr1", "chrUn"]
+        centers = [2000, 30, 4990, 100]
+        strands = ["+", "-", "-", "+"]
+        mat = store.profiles(chroms, centers, 50, strands)
+        assert mat.shape == (4, 100)
+        assert np.array_equal(mat[0], dense["chr1"][1950:2050])
+        assert np.array_equal(mat[1, ::-1],
+                              np.concatenate([np.zeros(20, dtype=np.int64),
+                                              dense["chr2"][:80]]))
+        assert np.array_equal(mat[2, ::-1],
+                              np.concatenate([dense["chr1"][4940:],
+                                              np.zeros(40, dtype=np.int64)]))
+        assert not mat[3].any()
+
+    def test_clipped(self, tmpdir):
+        """ Counts beyond the store's type are clipped and reported. """
+        path = str(tmpdir.join("small"))
+        create_store(path, CHROM_SIZES, dtype="uint8")
+        clipped = write_counts(path, "chr1", np.array([1, 2, 3]),
+                               np.array([5, 255, 300]))
+        assert clipped == 1
+        assert CutStore(path).counts("chr1", 0, 4).tolist() == [5, 255, 255, 0]
+
+    def test_bad_dtype(self, tmpdir):
+        with pytest.raises(ValueError):
+            create_store(str(tmpdir.join("bad")), CHROM_SIZES, dtype="int8")
+
+    def test_unknown_version(self, tmpdir):
+        """ Stores of another layout version are refused. """
+        path = str(tmpdir.join("old"))
+        create_store(path, CHROM_SIZES)
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            index = json.load(f)
+        index["version"] += 1
+        with open(os.path.join(path, INDEX_FILE), "w") as f:
+            json.dump(index, f)
+        with pytest.raises(ValueError):
+            CutStore(path)
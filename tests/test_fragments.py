@@ -0,0 +1,134 @@
+""" Tests for writing fragment files and reading them back. """
+
+import logging
+import os
+
+import pytest
+
+import bamToFragments
+from bamSitesToWig import get_shifted_pos
+from bamToFragments import FragmentWriter
+from fragments import FragmentFile
+
+pysam = pytest.importorskip("pysam")
+
+SHIFT_FACTOR = {"+": 4, "-": -5}
+
+
+def reference_fragments(bam_file):
+    """
+    Shifted fragments of the properly paired reads, built from both mates.
+
+    :return dict: sorted (start, end, MAPQ) tuples by chromosome
+    """
+    mates = {}
+    with pysam.AlignmentFile(bam_file) as bam:
+        for read in bam.fetch():
+            if read.is_proper_pair:
+                key = (read.reference_name, read.query_name)
+                mates.setdefault(key, []).append(read)
+    fragments = {}
+    for (chrom, _), pair in mates.items():
+        left, right = sorted(pair, key=lambda r: r.reference_start)
+        fragments.setdefault(chrom, []).append(
+            (left.reference_start + SHIFT_FACTOR["+"] - 1,
+             right.reference_end + SHIFT_FACTOR["-"],
+             min(left.mapping_quality, right.mapping_quality)))
+    return dict((chrom, sorted(f)) for chrom, f in fragments.items())
+
+
+def _rows(columns):
+    return list(zip(columns["start"].tolist(), columns["end"].tolist(),
+                    columns["mapq"].tolist()))
+
+
+@pytest.fixture
+def write_fragments(tmpdir, monkeypatch):
+    """
+    Run FragmentWriter in this process, as bamToFragments.py would.
+
+    :return callable: takes the BAM file and a tile size, and returns the
+        name of the fragment file written
+    """
+    # The script sets up its logger when run from the command line.
+    monkeypatch.setattr(bamToFragments, "_LOGGER",
+                        logging.getLogger("bamToFragments"), raising=False)
+
+    def run(bam_file, tile_size=None):
+        outfile = str(tmpdir.join("fragments.tsv"))
+        writer = FragmentWriter(bam_file, 1, outfile, None,
+                                shift_factor=SHIFT_FACTOR,
+                                tile_size=tile_size, temp_parent=str(tmpdir))
+        writer.register_files()
+        writer.combine(writer.run())
+        return writer.outfile
+    return run
+
+
+class TestFragmentWriter:
+    """ The fragment file holds each proper pair once, shifted. """
+
+    @pytest.mark.parametrize("tile_size", [None, 3001])
+    def test_matches_pairs(self, bam_file, chrom_sizes, write_fragments,
+                           tile_size):
+        """ Same fragments as pairing the mates, tiled or not. """
+        filename = write_fragments(bam_file, tile_size)
+        assert filename.endswith(".gz")
+        assert os.path.exists(filename + ".tbi")
+        expected = reference_fragments(bam_file)
+        frags = FragmentFile(filename)
+        try:
+            assert sorted(frags.chroms) == sorted(expected)
+            for chrom, _ in chrom_sizes:
+                found = _rows(frags.read(chrom))
+                # Written in coordinate order, so tabix can index them.
+                assert [f[0] for f in found] == \
+                    sorted(f[0] for f in found)
+                assert sorted(found) == expected[chrom]
+        finally:
+            frags.close()
+
+    def test_ends_are_cut_sites(self, bam_file, chrom_sizes,
+                                write_fragments):
+        """ Fragment ends fall on the cuts bamSitesToWig counts. """
+        frags = FragmentFile(write_fragments(bam_file))
+        try:
+            for chrom, _ in chrom_sizes:
+                columns = frags.read(chrom)
+                # Starts are 0-based, so their cut is one base further on.
+                cuts = (columns["start"] + 1).tolist() + \
+                    columns["end"].tolist()
+                with pysam.AlignmentFile(bam_file) as bam:
+                    expected = [get_shifted_pos(read, SHIFT_FACTOR)
+                                for read in bam.fetch(chrom)
+                                if read.is_proper_pair]
+                assert sorted(cuts) == sorted(expected)
+        finally:
+            frags.close()
+
+
+class TestFragmentFile:
+    """ Reading regions of a fragment file. """
+
+    def test_region(self, bam_file, write_fragments):
+        """ A region yields the fragments overlapping it, in chunks. """
+        frags = FragmentFile(write_fragments(bam_file, 3001))
+        try:
+            start, end = 5000, 9000
+            expected = [f for f in reference_fragments(bam_file)["chr1"]
+                        if f[0] < end and f[1] > start]
+            assert sorted(_rows(frags.read("chr1", start, end))) == expected
+            chunks = list(frags.fetch("chr1", start, end, chunk_size=7))
+            assert all(len(c["start"]) <= 7 for c in chunks)
+            assert sum(len(c["start"]) for c in chunks) == len(expected)
+        finally:
+            frags.close()
+
+    def test_missing_chromosome(self, bam_file, write_fragments):
+        """ Chromosomes without fragments read as empty columns. """
+        frags = FragmentFile(write_fragments(bam_file))
+        try:
+            assert list(frags.fetch("chrX")) == []
+            assert all(len(v) == 0 for v in frags.read("chrX").values())
+        finally:
+            frags.close()
@@ -0,0 +1,140 @@
+""" Tests for the per-task metrics of the tiled tools. """
+
+import csv
+import json
+import logging
+import os
+
+import pytest
+
+import bamQC
+import bamSitesToWig
+from bamSitesToWig import CutTracer
+from metrics import NullMetrics, TaskMetrics, write_metrics
+
+pysam = pytest.importorskip("pysam")
+pytest.importorskip("pyBigWig")
+
+
+def read_metrics(prefix):
+    """ Rows of the metrics table, and the summary. """
+    with open(prefix + "_metrics.tsv") as f:
+        rows = list(csv.DictReader(f, delimiter="\t"))
+    with open(prefix + "_metrics_summary.json") as f:
+        return rows, json.load(f)
+
+
+def bam_reads(bam_file):
+    with pysam.AlignmentFile(bam_file) as bam:
+        return sum(1 for _ in bam.fetch())
+
+
+@pytest.fixture
+def loggers(monkeypatch):
+    """ The loggers the scripts set up when run from the command line. """
+    for module in [bamQC, bamSitesToWig]:
+        monkeypatch.setattr(module, "_LOGGER",
+                            logging.getLogger(module.__name__), raising=False)
+
+
+class TestTaskMetrics:
+    """ Recording one task. """
+
+    def test_record(self, tmpdir):
+        """ Phases add up; counts and written files are kept. """
+        metrics = TaskMetrics("chr1")
+        with metrics.phase("decode"):
+            pass
+        assert list(metrics.timed("shift", [1, 2, 3])) == [1, 2, 3]
+        metrics.add("decode", 1.5)
+        metrics.count("reads", 10)
+        metrics.count("reads", 5)
+        written = tmpdir.join("chr1.bed")
+        written.write("x" * 100)
+        record = metrics.finish([str(written), str(tmpdir.join("none"))])
+        assert record["task"] == "chr1"
+        assert [name for name, _ in record["phases"]] == ["decode", "shift"]
+        assert metrics.seconds("decode") >= 1.5
+        assert record["counts"] == {"reads": 15, "bytes_written": 100}
+        assert record["peak_rss"] > 0
+
+    def test_no_files(self):
+        """ Tasks that write nothing have no bytes_written. """
+        record = TaskMetrics("chr1").finish([])
+        assert "bytes_written" not in record["counts"]
+
+    def test_null(self):
+        """ NullMetrics measures nothing, at no cost to the caller. """
+        metrics = NullMetrics()
+        items = [1, 2]
+        assert metrics.timed("decode", items) is items
+        with metrics.phase("count"):
+            metrics.count("reads", 3)
+        assert metrics.seconds("count") == 0.0
+
+    def test_write(self, tmpdir):
+        """ The table has a column per count and phase; the summary sums. """
+        records = [
+            {"task": "chr1", "seconds": 2.0, "reads_per_second": 50.0,
+             "peak_rss": 2e6, "counts": {"reads": 100, "bytes_written": 10},
+             "phases": [["decode", 1.0], ["count", 0.5]]},
+            {"task": "chr2", "seconds": 1.0, "reads_per_second": 20.0,
+             "peak_rss": 3e6, "counts": {"reads": 20},
+             "phases": [["decode", 0.25], ["collect", 0.1]]}]
+        prefix = str(tmpdir.join("out"))
+        write_metrics(prefix, records, {"run_seconds": 4.0,
+                                        "output_bytes": {"out.bw": 1000}})
+        rows, summary = read_metrics(prefix)
+        assert [row["task"] for row in rows] == ["chr1", "chr2"]
+        assert [row["bytes_written"] for row in rows] == ["10", "0"]
+        assert rows[1]["phase_count"] == "0.000"
+        assert summary["reads"] == 120
+        assert summary["reads_per_second"] == 30.0
+        assert summary["bytes_written"] == 1010
+        assert summary["peak_rss_mb"] == 3.0
+        assert summary["phases"] == {"decode": 1.25, "count": 0.5,
+                                     "collect": 0.1}
+        assert [t[0] for t in summary["slowest_tasks"]] == ["chr1", "chr2"]
+
+
+class TestRuns:
+    """ Metrics of whole runs. """
+
+    @pytest.mark.parametrize("tile_size", [None, 3001])
+    def test_cut_tracer(self, bam_file, chrom_sizes, tmpdir, loggers,
+                        tile_size):
+        """
+        Tasks count each read once, however the reads are tiled and padded,
+        and the bigwig the parent writes is in the summary.
+        """
+        sizes = tmpdir.join("chrom.sizes")
+        sizes.write("".join("{}\t{}\n".format(c, n) for c, n in chrom_sizes))
+        outfile = str(tmpdir.join("cuts.bw"))
+        tracer = CutTracer(bam_file, str(sizes), str(tmpdir), 1, outfile,
+                           None, None, tile_size=tile_size, metrics=True)
+        tracer.register_files()
+        tracer.combine(tracer.run())
+        prefix = str(tmpdir.join("cuts"))
+        tracer.write_metrics(prefix)
+        rows, summary = read_metrics(prefix)
+        reads = bam_reads(bam_file)
+        assert sum(int(row["reads"]) for row in rows) == reads
+        assert summary["reads"] == reads
+        assert summary["output_bytes"] == {outfile: os.path.getsize(outfile)}
+        assert summary["bytes_written"] == os.path.getsize(outfile)
+
+    def test_bam_qc(self, bam_file, tmpdir, loggers):
+        """ bamQC tasks write their states; the report is an output. """
+        outfile = str(tmpdir.join("qc.tsv"))
+        qc = bamQC.bamQC(bam_file, 1, outfile, None, tile_size=3001,
+                         metrics=True)
+        qc.register_files()
+        qc.combine(qc.run())
+        prefix = str(tmpdir.join("qc"))
+        qc.write_metrics(prefix)
+        rows, summary = read_metrics(prefix)
+        assert summary["reads"] == bam_reads(bam_file)
+        task_bytes = sum(int(row["bytes_written"]) for row in rows)
+        assert task_bytes > 0
+        assert summary["bytes_written"] == \
+            task_bytes + os.path.getsize(outfile)
@@ -0,0 +1,109 @@
+""" Tests for the sampling profiler. """
+
+import glob
+import multiprocessing
+import threading
+import time
+
+import pytest
+
+import profiler
+from profiler import StackSampler, merge
+
+INTERVAL = 0.001
+
+
+def busy(seconds=0.2):
+    """ Keep the interpreter in this frame for a while. """
+    total, until = 0, time.time() + seconds
+    while time.time() < until:
+        total += sum(range(100))
+    return total
+
+
+def read_stacks(filename):
+    """ Counts of a collapsed-stack file, by stack. """
+    with open(filename) as f:
+        return dict((stack, int(n)) for stack, _, n in
+                    (line.rstrip("\n").rpartition(" ") for line in f))
+
+
+@pytest.fixture
+def state(monkeypatch):
+    """ Profiler state that is restored after the test. """
+    monkeypatch.setattr(profiler, "_STATE", dict(profiler._STATE))
+    return profiler._STATE
+
+
+class TestStackSampler:
+    """ Sampling the stacks of a thread. """
+
+    def test_busy_frame(self, tmpdir):
+        """ A busy function shows up, under the role, in collapsed form. """
+        sampler = StackSampler("main", INTERVAL)
+        sampler.start()
+        try:
+            busy()
+        finally:
+            sampler.stop()
+        busy_stacks = [s for s in sampler.counts
+                       if s.endswith("test_profiler.py:busy")]
+        assert busy_stacks
+        assert all(s.startswith("main;") for s in sampler.counts)
+        assert "test_profiler.py:test_busy_frame" in busy_stacks[0]
+        filename = str(tmpdir.join("stacks.txt"))
+        sampler.save(filename)
+        assert read_stacks(filename) == sampler.counts
+
+    def test_other_thread(self):
+        """ The sampled thread can be another than the caller. """
+        thread = threading.Thread(target=busy)
+        thread.start()
+        sampler = StackSampler("worker", INTERVAL, target=thread.ident)
+        sampler.start()
+        thread.join()
+        sampler.stop()
+        assert any(s.startswith("worker;") and s.endswith(":busy")
+                   for s in sampler.counts)
+
+
+class TestMerge:
+    """ Summing the samples of several processes. """
+
+    def test_sums(self, tmpdir):
+        """ Shared stacks add up; the others are kept. """
+        parts = [tmpdir.join("a.part"), tmpdir.join("b.part")]
+        parts[0].write("main;f 3\nmain;f;g 2\n")
+        parts[1].write("main;f 4\nworker;h 1\n")
+        merged = str(tmpdir.join("profile.txt"))
+        assert merge(merged, [str(p) for p in parts]) == 10
+        assert read_stacks(merged) == {"main;f": 7, "main;f;g": 2,
+                                       "worker;h": 1}
+
+    def test_workers(self, tmpdir, state):
+        """ The parent and forked pool workers end up in one file. """
+        path = str(tmpdir.join("profile.txt"))
+        profiler.start(path, INTERVAL)
+        busy(0.1)
+        pool = multiprocessing.get_context("fork").Pool(2)
+        try:
+            pool.map(profiler.profiled(busy), [0.2] * 4)
+        finally:
+            pool.close()
+            pool.join()
+        assert profiler.finish() == path
+        assert glob.glob(path + ".*.part") == []
+        stacks = read_stacks(path)
+        roots = set(s.split(";")[0] for s in stacks)
+        assert roots == {"main", "worker"}
+        assert any(s.startswith("worker;") and s.endswith(":busy")
+                   for s in stacks)
+        assert any(s.startswith("main;") and s.endswith(":busy")
+                   for s in stacks)
+
+    def test_off(self, state):
+        """ Without a profile path nothing is sampled or written. """
+        sampler = state["sampler"]
+        profiler.start(None)
+        assert state["path"] is None and state["sampler"] is sampler
+        assert profiler.finish() is None
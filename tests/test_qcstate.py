@@ -0,0 +1,145 @@
+""" Tests for the mergeable bamQC state. """
+
+import struct
+
+import numpy as np
+import pytest
+
+from qcstate import FIELDS, HEADER, MAGIC, SKETCH_HEADER, VERSION, QCState
+from sketch import HyperLogLog, mix64
+
+COUNTERS = {"num_reads": 1000, "paired_reads": 800, "dups": 120,
+            "mito_paired_reads": 40, "pe_paired_reads": 800,
+            "dup_reads": 150, "M2": 30}
+
+
+def sketched(keys, precision=10):
+    sketch = HyperLogLog(precision)
+    sketch.add(mix64(np.asarray(keys)))
+    return QCState(COUNTERS, sketch=sketch)
+
+
+def assert_same(a, b):
+    assert np.array_equal(a.counters, b.counters)
+    assert np.array_equal(a.histogram, b.histogram)
+    if a.sketch is None:
+        assert b.sketch is None
+    else:
+        assert np.array_equal(a.sketch.registers, b.sketch.registers)
+
+
+class TestFile:
+    """ Saving and loading states. """
+
+    def test_exact_round_trip(self, tmpdir):
+        state = QCState(COUNTERS, [0, 300, 25, 4])
+        filename = str(tmpdir.join("exact.qc"))
+        state.save(filename)
+        loaded = QCState.load(filename)
+        assert_same(loaded, state)
+        assert loaded.sketch is None
+
+    def test_sketched_round_trip(self, tmpdir):
+        state = sketched(range(5000))
+        filename = str(tmpdir.join("sketched.qc"))
+        state.save(filename)
+        loaded = QCState.load(filename)
+        assert_same(loaded, state)
+        assert loaded.sketch.estimate() == state.sketch.estimate()
+
+    def test_version_1(self, tmpdir):
+        """ Files from before sketches load as exact states. """
+        counters = np.arange(len(FIELDS), dtype="<i8")
+        histogram = np.array([0, 7, 2], dtype="<i8")
+        filename = str(tmpdir.join("v1.qc"))
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<II", 1, len(FIELDS)))
+            f.write(counters.tobytes())
+            f.write(struct.pack("<I", len(histogram)))
+            f.write(histogram.tobytes())
+        loaded = QCState.load(filename)
+        assert loaded.counters.tolist() == counters.tolist()
+        assert loaded.histogram.tolist() == [0, 7, 2]
+        assert loaded.sketch is None
+        assert loaded.header() == HEADER
+
+    @pytest.mark.parametrize("head", [
+        b"NOTAQC\0\0" + struct.pack("<II", VERSION, len(FIELDS)),
+        MAGIC + struct.pack("<II", VERSION + 1, len(FIELDS)),
+        MAGIC + struct.pack("<II", VERSION, len(FIELDS) + 1)])
+    def test_refuses_unknown_files(self, tmpdir, head):
+        filename = str(tmpdir.join("bad.qc"))
+        with open(filename, "wb") as f:
+            f.write(head)
+        with pytest.raises(ValueError):
+            QCState.load(filename)
+
+
+class TestMerge:
+    """ Adding states up. """
+
+    def test_exact(self):
+        """ Counters and histograms add, whatever their lengths. """
+        a = QCState({"num_reads": 10, "dups": 2}, [0, 5, 1])
+        b = QCState({"num_reads": 7, "M2": 1}, [0, 2, 0, 0, 1])
+        c = QCState({"num_reads": 1}, [0, 1])
+        merged = QCState.merge([a, b, c])
+        assert merged["num_reads"] == 18
+        assert merged["dups"] == 2 and merged["M2"] == 1
+        assert merged.histogram.tolist() == [0, 8, 1, 0, 1]
+        assert merged.distinct == 10
+        assert_same(a + (b + c), (a + b) + c)
+        assert_same(b + a, a + b)
+
+    def test_sketched(self):
+        """ Sketches merge as the union of their keys. """
+        merged = QCState.merge([sketched(range(0, 3000)),
+                                sketched(range(2000, 5000))])
+        assert merged["num_reads"] == 2 * COUNTERS["num_reads"]
+        assert np.array_equal(merged.sketch.registers,
+                              sketched(range(5000)).sketch.registers)
+
+    def test_empty_state_merges_with_sketch(self):
+        """ A state with nothing counted yet takes either kind. """
+        merged = QCState() + sketched(range(10))
+        assert merged.sketch is not None
+
+    def test_refuses_exact_with_sketched(self):
+        exact = QCState(COUNTERS, [0, 300, 25])
+        with pytest.raises(ValueError):
+            exact + sketched(range(100))
+        with pytest.raises(ValueError):
+            QCState.merge([sketched(range(100)), exact])
+
+
+class TestMetrics:
+    """ The bamQC report. """
+
+    def test_exact(self):
+        state = QCState(COUNTERS, [0, 300, 25, 4])
+        assert state.header() == HEADER
+        metrics = dict(zip(HEADER, state.metrics()))
+        assert metrics["Total_read_pairs"] == 400
+        assert metrics["Distinct_read_pairs"] == 329
+        assert metrics["One_read_pair"] == 250
+        assert metrics["Two_read_pairs"] == 30
+        assert metrics["Duplicate_rate"] == 120 / 400.0
+        assert metrics["Mitochondria_rate"] == 20 / 400.0
+        assert metrics["NRF"] == 250 / 400.0
+        assert metrics["PBC1"] == 250 / 329.0
+        assert metrics["PBC2"] == 250 / 30.0
+
+    def test_sketched(self):
+        """ Counts a sketch cannot give are NA; others are unchanged. """
+        state = sketched(range(300))
+        assert state.header() == SKETCH_HEADER
+        metrics = dict(zip(SKETCH_HEADER, state.metrics()))
+        for name in ["One_read_pair", "Two_read_pairs", "NRF", "PBC1",
+                     "PBC2"]:
+            assert metrics[name] == "NA"
+        assert metrics["Duplicate_rate"] == 120 / 400.0
+        assert metrics["Distinct_read_pairs"] == pytest.approx(300, rel=0.1)
+        assert metrics["Distinct_rate"] == \
+            metrics["Distinct_read_pairs"] / 400.0
+        assert metrics["Confidence"] == 1.96 * state.sketch.error
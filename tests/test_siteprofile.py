@@ -0,0 +1,165 @@
+""" Tests for profiling insertions around sites. """
+
+import numpy as np
+import pytest
+
+from siteprofile import (HALVES, MIN_MAPQ, SiteProfile, enrichment_score,
+                         insertions, read_sites)
+
+pysam = pytest.importorskip("pysam")
+
+EXTEND = 300
+
+
+def per_site_matrix(bam_file, bed_file, extend, mode, rows):
+    """
+    The V-plot as the original pyTssEnrichment.py built it: fetching the
+    reads of each site on its own and adding insertions one at a time.
+    """
+    mat = np.zeros((rows, 2 * extend))
+    with open(bed_file) as f:
+        sites = [line.split() for line in f if line.strip()]
+    with pysam.AlignmentFile(bam_file) as bam:
+        for site in sites:
+            start, end = int(site[1]), int(site[2])
+            center = start + (end - start) // 2
+            s_int, e_int = center - extend, center + extend
+            reverse = len(site) > 3 and site[3] == "-"
+            for read in bam.fetch(site[0], max(0, s_int - 2000),
+                                  e_int + 2000):
+                if read.mapping_quality < MIN_MAPQ or read.is_reverse:
+                    continue
+                l_pos = read.reference_start + 4
+                ilen = abs(read.template_length) - 9
+                c_pos = l_pos + ilen // 2
+                if mode == "ends":
+                    values = [(l_pos, 1), (l_pos + ilen, 1)]
+                elif ilen % 2 == 1:
+                    values = [(c_pos, 0.5), (c_pos + 1, 0.5)]
+                else:
+                    values = [(c_pos, 1)]
+                for val, weight in values:
+                    if s_int <= val < e_int - 1 and ilen < rows:
+                        base = val - s_int
+                        if reverse:
+                            base = 2 * extend - base - 1
+                        mat[ilen][base] += weight
+    return mat
+
+
+def write_sites(filename, chrom_sizes, n, seed, strands=True):
+    """ Random sites, some close together and some near the ends. """
+    rng = np.random.RandomState(seed)
+    with open(filename, "w") as f:
+        for i in range(n):
+            chrom, size = chrom_sizes[rng.randint(len(chrom_sizes))]
+            start = rng.randint(0, size - 10) if i % 10 else \
+                rng.choice([0, size - 11])
+            fields = [chrom, start, start + rng.randint(1, 10)]
+            if strands:
+                fields.append(rng.choice(["+", "-"]))
+            f.write("\t".join(str(x) for x in fields) + "\n")
+    return filename
+
+
+@pytest.fixture(scope="module")
+def bed_files(tmpdir_factory, chrom_sizes):
+    folder = tmpdir_factory.mktemp("sites")
+    return [write_sites(str(folder.join("a.bed")), chrom_sizes, 120, 1),
+            write_sites(str(folder.join("b.bed")), chrom_sizes, 40, 2,
+                        strands=False)]
+
+
+class TestSiteProfile:
+    """ One sorted pass gives what the per-site loop gave. """
+
+    @pytest.mark.parametrize("mode", ["center", "ends"])
+    @pytest.mark.parametrize("rows", [1000, 300])
+    def test_matches_per_site_loop(self, bam_file, bed_files, mode, rows):
+        for bed_file in bed_files:
+            found = SiteProfile(bam_file, [read_sites(bed_file)], EXTEND,
+                                mode=mode, rows=rows).run()[0]
+            expected = per_site_matrix(bam_file, bed_file, EXTEND, mode,
+                                       rows)
+            assert expected.sum() > 0
+            assert np.array_equal(found, expected)
+
+    def test_sets_and_summaries(self, bam_file, bed_files):
+        """ Each set sums its own sites; summaries are sums of the matrix. """
+        sets = [read_sites(bed_file) for bed_file in bed_files]
+        matrix = SiteProfile(bam_file, sets, EXTEND).count()
+        for i, bed_file in enumerate(bed_files):
+            assert np.array_equal(
+                matrix[i] / float(HALVES),
+                per_site_matrix(bam_file, bed_file, EXTEND, "center", 1000))
+        positions = SiteProfile(bam_file, sets, EXTEND,
+                                summary="positions").count()
+        sizes = SiteProfile(bam_file, sets, EXTEND, summary="sizes").count()
+        assert np.array_equal(positions, matrix.sum(axis=1))
+        assert np.array_equal(sizes, matrix.sum(axis=2))
+        single = SiteProfile(bam_file, sets[:1], EXTEND,
+                             summary="sizes").count()
+        assert np.array_equal(single[0], sizes[0])
+
+    def test_bins(self, bam_file, bed_files):
+        """ Bins sum neighbouring positions and sizes. """
+        sites = [read_sites(bed_files[0])]
+        matrix = SiteProfile(bam_file, sites, EXTEND).count()[0]
+        binned = SiteProfile(bam_file, sites, EXTEND, position_bin=7,
+                             size_bin=30).count()[0]
+        expected = np.zeros((-(-1000 // 30), -(-2 * EXTEND // 7)),
+                            dtype=np.int64)
+        np.add.at(expected, (np.arange(1000)[:, None] // 30,
+                             np.arange(2 * EXTEND)[None, :] // 7), matrix)
+        assert np.array_equal(binned, expected)
+
+    def test_cores(self, bam_file, bed_files):
+        """ Workers' shared counts add up to the serial counts. """
+        sets = [read_sites(bed_file) for bed_file in bed_files]
+        for summary in ["matrix", "positions"]:
+            serial = SiteProfile(bam_file, sets, EXTEND, summary=summary)
+            parallel = SiteProfile(bam_file, sets, EXTEND, summary=summary,
+                                   cores=3)
+            assert len(parallel.tasks()) > 1
+            assert np.array_equal(parallel.count(), serial.count())
+
+    def test_unknown_chromosomes(self, bam_file):
+        """ Sites on chromosomes the BAM lacks are skipped. """
+        sites = {"chrUn": (np.array([100]), np.array([False]))}
+        profile = SiteProfile(bam_file, [sites], EXTEND, summary="positions")
+        assert not profile.count().any()
+
+    @pytest.mark.parametrize("settings", [
+        dict(mode="starts"), dict(summary="vector"), dict(position_bin=0)])
+    def test_bad_settings(self, bam_file, settings):
+        with pytest.raises(ValueError):
+            SiteProfile(bam_file, [{}], EXTEND, **settings)
+
+
+class TestInsertions:
+    """ Insertions of a batch of reads. """
+
+    BATCH = {"pos": np.array([100, 200, 300]),
+             "tlen": np.array([59, -60, 2000])}
+
+    def test_center(self):
+        """ Odd sizes split the center between two bases. """
+        positions, sizes, weights = insertions(self.BATCH, "center")
+        assert positions.tolist() == [129, 229, 230]
+        assert sizes.tolist() == [50, 51, 51]
+        assert weights.tolist() == [HALVES, 1, 1]
+
+    def test_ends(self):
+        positions, sizes, weights = insertions(self.BATCH, "ends")
+        assert positions.tolist() == [104, 204, 154, 255]
+        assert sizes.tolist() == [50, 51, 50, 51]
+        assert weights.tolist() == [HALVES] * 4
+
+
+def test_enrichment_score():
+    """ Central mean over the mean of the first bases, as pepatac reports. """
+    profile = np.ones(4000)
+    profile[1950:2050] = 5
+    # The first base is left out of the background sum.
+    assert enrichment_score(profile) == pytest.approx(5 * 200 / 199.0)
+    assert enrichment_score(np.zeros(4000)) is None
@@ -0,0 +1,87 @@
+""" Tests for the HyperLogLog distinct count sketch. """
+
+import numpy as np
+import pytest
+
+from sketch import (MAX_PRECISION, MIN_PRECISION, HyperLogLog, hash_keys,
+                    precision_for_error)
+
+
+def keys(lo, hi):
+    """ Hashed duplicate keys for fragments lo to hi on one chromosome. """
+    positions = np.arange(lo, hi, dtype=np.int64)
+    return hash_keys("chr1", [positions, positions % 500 + 50])
+
+
+class TestHyperLogLog:
+    """ Estimates and merges. """
+
+    @pytest.mark.parametrize("precision", [10, 14])
+    @pytest.mark.parametrize("n", [50, 2000, 30000, 300000])
+    def test_within_error(self, precision, n):
+        """ Estimates fall within four standard errors of the count. """
+        sketch = HyperLogLog(precision)
+        sketch.add(keys(0, n))
+        assert abs(sketch.estimate() - n) <= 4 * sketch.error * n
+
+    def test_duplicates_ignored(self):
+        """ Adding the same keys again changes nothing. """
+        sketch = HyperLogLog(12)
+        sketch.add(keys(0, 5000))
+        registers = sketch.registers.copy()
+        sketch.add(keys(0, 5000))
+        sketch.add(keys(1000, 2000))
+        assert np.array_equal(sketch.registers, registers)
+
+    def test_empty(self):
+        sketch = HyperLogLog(12)
+        sketch.add(keys(0, 0))
+        assert sketch.estimate() == 0
+
+    def test_merge_is_union(self):
+        """ Merged sketches equal the sketch of the union of their keys. """
+        parts = [(0, 40000), (25000, 60000), (100000, 101000)]
+        merged = HyperLogLog(12)
+        union = HyperLogLog(12)
+        for lo, hi in parts:
+            part = HyperLogLog(12)
+            part.add(keys(lo, hi))
+            merged = merged + part
+            union.add(keys(lo, hi))
+        assert np.array_equal(merged.registers, union.registers)
+        assert merged.estimate() == union.estimate()
+
+    def test_merge_needs_same_precision(self):
+        with pytest.raises(ValueError):
+            HyperLogLog(10) + HyperLogLog(12)
+
+    def test_registers_set_precision(self):
+        sketch = HyperLogLog(registers=np.zeros(2 ** 11, dtype=np.uint8))
+        assert sketch.precision == 11
+
+
+class TestHashKeys:
+    """ Hashing duplicate keys. """
+
+    def test_stable(self):
+        """ A key hashes the same way every time, and by chromosome. """
+        first = keys(0, 1000)
+        assert first.dtype == np.uint64
+        assert np.array_equal(first, keys(0, 1000))
+        assert len(np.unique(first)) == 1000
+        positions = np.arange(1000, dtype=np.int64)
+        other = hash_keys("chr2", [positions, positions % 500 + 50])
+        assert not np.intersect1d(first, other).size
+
+    def test_negative_fields(self):
+        """ Negative template lengths hash apart from positive ones. """
+        positions = np.zeros(2, dtype=np.int64)
+        h = hash_keys("chr1", [positions, np.array([-150, 150])])
+        assert h[0] != h[1]
+
+
+@pytest.mark.parametrize(["error", "precision"], [
+    (0.01, 14), (0.0081, 15), (0.05, 9), (0.5, MIN_PRECISION),
+    (0.0001, MAX_PRECISION)])
+def test_precision_for_error(error, precision):
+    assert precision_for_error(error) == precision
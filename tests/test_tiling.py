@@ -0,0 +1,184 @@
+""" Tests for splitting chromosomes into tiles and fetching their reads. """
+
+from collections import Counter
+import json
+import os
+import shutil
+
+import pytest
+
+from pararead.processor import PARA_READ_FILES, READS_FILE_KEY
+from tiling import (MANIFEST, Checkpoint, TiledProcessor, dispatch_order,
+                    make_tasks, parse_task)
+
+pysam = pytest.importorskip("pysam")
+
+TILE_SIZES = [None, 1000, 3001, 8000, 50000]
+FINGERPRINT = {"reads": "reads.bam", "size": 100, "tile_size": None}
+
+
+class _Tiles(TiledProcessor):
+    """ The parts of a ParaReadProcessor that fetching a task relies on. """
+
+    def __init__(self, bam_file, chrom_sizes):
+        self.path_reads_file = bam_file
+        self._size_by_chromosome = dict(chrom_sizes)
+
+    def get_chrom_size(self, chrom):
+        return self._size_by_chromosome[chrom]
+
+    def fetch_chunk(self, chrom):
+        return PARA_READ_FILES[READS_FILE_KEY].fetch(
+            chrom, multiple_iterators=True)
+
+
+@pytest.fixture
+def tiles(bam_file, chrom_sizes, monkeypatch):
+    """ A processor over the test BAM file, opened as pararead opens it. """
+    with pysam.AlignmentFile(bam_file) as bam:
+        monkeypatch.setitem(PARA_READ_FILES, READS_FILE_KEY, bam)
+        yield _Tiles(bam_file, chrom_sizes)
+
+
+def _all_reads(bam_file):
+    with pysam.AlignmentFile(bam_file) as bam:
+        return Counter((r.reference_name, r.query_name, r.flag)
+                       for r in bam.fetch())
+
+
+class TestMakeTasks:
+    """ Task keys and the regions they stand for. """
+
+    @pytest.mark.parametrize("tile_size", TILE_SIZES)
+    def test_round_trip(self, chrom_sizes, tile_size):
+        """ Each key parses back to a region; regions tile each chromosome. """
+        size_by_chrom = dict(chrom_sizes)
+        regions = [parse_task(task, size_by_chrom)
+                   for task in make_tasks(chrom_sizes, tile_size)]
+        for chrom, size in chrom_sizes:
+            own = [(start, end) for c, start, end in regions if c == chrom]
+            assert own[0][0] == 0 and own[-1][1] == size
+            assert all(a[1] == b[0] for a, b in zip(own, own[1:]))
+            assert all(0 < end - start <= (tile_size or size)
+                       for start, end in own)
+
+    def test_small_chromosomes_stay_whole(self, chrom_sizes):
+        """ Chromosomes no longer than a tile keep their name as the key. """
+        assert make_tasks(chrom_sizes, 8000) == \
+            ["chr1:0-8000", "chr1:8000-16000", "chr1:16000-20000", "chr2"]
+
+    def test_dispatch_order(self):
+        """ Busiest chromosomes first, each one's tiles in genomic order. """
+        chrom_sizes = [("chr1", 2500), ("chr2", 1000), ("chr3", 1500)]
+        reads = {"chr1": 10, "chr2": 50, "chr3": 20}
+        assert dispatch_order(chrom_sizes, reads, 1000) == [
+            "chr2", "chr3:0-1000", "chr3:1000-1500", "chr1:0-1000",
+            "chr1:1000-2000", "chr1:2000-2500"]
+        assert dispatch_order(chrom_sizes, reads) == ["chr2", "chr3", "chr1"]
+
+    @pytest.mark.parametrize("task", ["chr3", "chr3:0-10", "chr1:10", ""])
+    def test_unknown_task(self, chrom_sizes, task):
+        """ Keys naming no known chromosome are refused. """
+        with pytest.raises(ValueError):
+            parse_task(task, dict(chrom_sizes))
+
+
+class TestFetchTask:
+    """ Each read belongs to exactly one tile. """
+
+    @pytest.mark.parametrize("tile_size", TILE_SIZES)
+    def test_reads_owned_once(self, bam_file, chrom_sizes, tiles, tile_size):
+        """ Tiles' reads together are the file's reads, each once. """
+        fetched = Counter()
+        for task in make_tasks(chrom_sizes, tile_size):
+            fetched.update((r.reference_name, r.query_name, r.flag)
+                           for r in tiles.fetch_task(task))
+        assert fetched == _all_reads(bam_file)
+
+    @pytest.mark.parametrize("pad", [0, 500])
+    @pytest.mark.parametrize("tile_size", TILE_SIZES)
+    def test_columns_owned_once(self, bam_file, chrom_sizes, tiles,
+                                tile_size, pad):
+        """ Owned column batches hold the same reads as fetch_task. """
+        for task in make_tasks(chrom_sizes, tile_size):
+            expected = sorted((r.reference_start, r.flag)
+                              for r in tiles.fetch_task(task))
+            found = []
+            for batch in tiles.fetch_columns(task, pad, owned=True):
+                found.extend(zip(batch["pos"].tolist(),
+                                 batch["flag"].tolist()))
+            assert sorted(found) == expected
+
+    def test_padding_widens_region(self, chrom_sizes, tiles):
+        """ Padded fetches also return reads from beyond the tile. """
+        task = make_tasks(chrom_sizes, 3001)[1]
+        _, start, end = parse_task(task, dict(chrom_sizes))
+        starts = [r.reference_start for r in tiles.fetch_region(task, 500)]
+        assert min(starts) < start and max(starts) >= end
+
+
+def _finish(checkpoint, task, content):
+    """ Write a task's file into the checkpoint folder and record it. """
+    filename = os.path.join(checkpoint.folder, task + ".txt")
+    with open(filename, "w") as f:
+        f.write(content)
+    checkpoint.record(task, [filename])
+    return filename
+
+
+class TestCheckpoint:
+    """ Resuming from the manifest of finished tasks. """
+
+    def test_resume_partial_manifest(self, tmpdir):
+        """ Tasks recorded before a kill are complete; the rest are not. """
+        folder = str(tmpdir.join("checkpoint"))
+        checkpoint = Checkpoint(folder, FINGERPRINT)
+        _finish(checkpoint, "chr1", "one")
+        _finish(checkpoint, "chr2", "two")
+        # Killed while writing the next line.
+        with open(os.path.join(folder, MANIFEST), "a") as f:
+            f.write('{"task": "chr3", "fi')
+        resumed = Checkpoint(folder, dict(FINGERPRINT))
+        assert resumed.is_complete("chr1") and resumed.is_complete("chr2")
+        assert not resumed.is_complete("chr3")
+        _finish(resumed, "chr3", "three")
+        again = Checkpoint(folder, FINGERPRINT)
+        assert all(again.is_complete(t) for t in ["chr1", "chr2", "chr3"])
+
+    def test_changed_fingerprint(self, tmpdir):
+        """ A run with other inputs or settings starts over. """
+        folder = str(tmpdir.join("checkpoint"))
+        _finish(Checkpoint(folder, FINGERPRINT), "chr1", "one")
+        changed = dict(FINGERPRINT, tile_size=1000)
+        checkpoint = Checkpoint(folder, changed)
+        assert not checkpoint.is_complete("chr1")
+        with open(os.path.join(folder, MANIFEST)) as f:
+            assert [json.loads(line) for line in f] == [changed]
+
+    def test_changed_file(self, tmpdir):
+        """ A task whose file no longer matches its checksum reruns. """
+        folder = str(tmpdir.join("checkpoint"))
+        checkpoint = Checkpoint(folder, FINGERPRINT)
+        filename = _finish(checkpoint, "chr1", "one")
+        _finish(checkpoint, "chr2", "two")
+        # Same size, other content.
+        with open(filename, "w") as f:
+            f.write("won")
+        resumed = Checkpoint(folder, FINGERPRINT)
+        assert not resumed.is_complete("chr1")
+        assert resumed.is_complete("chr2")
+        os.remove(filename)
+        assert not resumed.is_complete("chr1")
+
+    def test_fingerprint_ignores_folder(self, bam_file, chrom_sizes, tmpdir):
+        """ The same BAM file seen from another folder resumes. """
+        moved = str(tmpdir.join(os.path.basename(bam_file)))
+        shutil.copy2(bam_file, moved)
+        fingerprints = []
+        for filename in [bam_file, moved]:
+            tiles = _Tiles(filename, chrom_sizes)
+            fingerprints.append(tiles._fingerprint())
+        assert fingerprints[0] == fingerprints[1]
+        with open(moved, "ab") as f:
+            f.write(b"\0")
+        assert tiles._fingerprint() != fingerprints[0]
@@ -0,0 +1,81 @@
+""" Tests for storing V-plots and their zoom levels. """
+
+import numpy as np
+import pytest
+
+from siteprofile import HALVES, SiteProfile
+from vplot import load_vplot, save_vplot, zoom
+
+
+class TestZoom:
+    """ Summing blocks of bins. """
+
+    def test_blocks(self):
+        counts = np.arange(12).reshape(3, 4)
+        assert zoom(counts, 2).tolist() == [[0 + 1 + 4 + 5, 2 + 3 + 6 + 7],
+                                            [8 + 9, 10 + 11]]
+
+    @pytest.mark.parametrize("factor", [1, 3, 4, 50])
+    def test_keeps_total(self, factor):
+        """ Partial blocks at the ends still hold their counts. """
+        counts = np.random.RandomState(1).randint(0, 9, (10, 31))
+        zoomed = zoom(counts, factor)
+        assert zoomed.shape == (-(-10 // factor), -(-31 // factor))
+        assert zoomed.sum() == counts.sum()
+
+
+class TestSaveLoad:
+    """ Round trips through the .npz file. """
+
+    def test_round_trip(self, tmpdir):
+        """ Half insertions come back as insertions, with the settings. """
+        counts = np.random.RandomState(2).randint(0, 300, (40, 60))
+        filename = str(tmpdir.join("vplot.npz"))
+        save_vplot(filename, counts, halves=2, extend=30, position_bin=1,
+                   size_bin=25, zoom_factors=[4, 16])
+        matrix, info = load_vplot(filename)
+        assert np.array_equal(matrix, counts / 2.0)
+        assert info == {"extend": 30, "position_bin": 1, "size_bin": 25,
+                        "halves": 2}
+        with np.load(filename) as data:
+            assert data["counts"].dtype == np.uint16
+        for level in [4, 16]:
+            matrix, info = load_vplot(filename, level)
+            assert np.array_equal(matrix, zoom(counts, level) / 2.0)
+            assert info["position_bin"] == level
+            assert info["size_bin"] == 25 * level
+
+    def test_whole_insertions(self, tmpdir):
+        """ Counts with nothing split are stored as whole insertions. """
+        counts = np.array([[0, 2], [4, 8]])
+        filename = str(tmpdir.join("vplot.npz"))
+        save_vplot(filename, counts, halves=2, extend=1)
+        matrix, info = load_vplot(filename)
+        assert info["halves"] == 1
+        assert matrix.tolist() == [[0, 1], [2, 4]]
+        with np.load(filename) as data:
+            assert data["counts"].dtype == np.uint8
+
+    def test_missing_level(self, tmpdir):
+        filename = str(tmpdir.join("vplot.npz"))
+        save_vplot(filename, np.ones((4, 4), dtype=np.int64), halves=1,
+                   extend=2, zoom_factors=[2])
+        with pytest.raises(ValueError):
+            load_vplot(filename, 4)
+
+    def test_negative_counts(self, tmpdir):
+        with pytest.raises(ValueError):
+            save_vplot(str(tmpdir.join("vplot.npz")), np.array([[-1]]),
+                       halves=1, extend=1)
+
+    def test_site_profile(self, tmpdir, bam_file):
+        """ A stored profile loads as SiteProfile.run() returns it. """
+        sites = {"chr1": (np.arange(1000, 19000, 900),
+                          np.arange(20) % 3 == 0)}
+        profile = SiteProfile(bam_file, [sites], 200, position_bin=5,
+                              size_bin=10)
+        filename = str(tmpdir.join("vplot.npz"))
+        save_vplot(filename, profile.count()[0], HALVES, 200, 5, 10)
+        matrix, info = load_vplot(filename)
+        assert np.array_equal(matrix, profile.run()[0])
+        assert (info["position_bin"], info["size_bin"]) == (5, 10)
@@ -0,0 +1,167 @@
+""" Tests for the shared-folder work queue and the runs it coordinates. """
+
+from collections import Counter
+import logging
+import multiprocessing
+import os
+import time
+
+import numpy as np
+import pytest
+
+import bamQC
+import tiling
+import workqueue
+from qcstate import QCState
+from workqueue import CLAIMED, PENDING, SETTINGS, WorkQueue
+
+pysam = pytest.importorskip("pysam")
+
+TASKS = ["chr1:0-1000", "chr1:1000-2000", "chr2"]
+
+
+class TestWorkQueue:
+    """ Publishing, claiming and requeueing tasks. """
+
+    def test_claims(self, tmpdir):
+        """ Tasks are claimed in order, each once. """
+        queue = WorkQueue(str(tmpdir.join("queue")))
+        assert queue.publish(TASKS, {"run": 1}) == []
+        claims = [queue.claim() for _ in TASKS]
+        assert [task for _, task in claims] == TASKS
+        assert queue.claim() is None
+        for name, _ in claims:
+            queue.finish(name, True)
+        assert queue.idle()
+        assert list(queue.wait(TASKS)) == [(t, True) for t in TASKS]
+
+    def test_republish(self, tmpdir):
+        """ A restarted coordinator keeps the tasks already done. """
+        folder = str(tmpdir.join("queue"))
+        queue = WorkQueue(folder)
+        queue.publish(TASKS, {"run": 1})
+        name, _ = queue.claim()
+        queue.finish(name, True)
+        queue.claim()
+        assert WorkQueue(folder).publish(TASKS, {"run": 1}) == [TASKS[0]]
+        assert [queue.claim()[1] for _ in TASKS[1:]] == TASKS[1:]
+        # Another run starts over.
+        assert WorkQueue(folder).publish(TASKS, {"run": 2}) == []
+
+    def test_stale_claim(self, tmpdir):
+        """ A claim nobody refreshes goes back to pending. """
+        queue = WorkQueue(str(tmpdir.join("queue")), stale_seconds=0.5)
+        queue.publish(TASKS, {"run": 1})
+        lost, task = queue.claim()
+        alive, _ = queue.claim()
+        stop = queue.heartbeat(alive)
+        try:
+            queue.requeue_stale()
+            assert os.listdir(os.path.join(queue.folder, PENDING)) == \
+                ["000002"]
+            # The owner of the first claim is gone; the second beats.
+            old = time.time() - 1
+            os.utime(os.path.join(queue.folder, CLAIMED, lost), (old, old))
+            queue.requeue_stale()
+            assert sorted(os.listdir(os.path.join(queue.folder, PENDING))) \
+                == [lost, "000002"]
+            assert os.listdir(os.path.join(queue.folder, CLAIMED)) == [alive]
+            assert queue.claim() == (lost, task)
+        finally:
+            stop.set()
+
+    def test_open_unpublished(self, tmpdir):
+        """ Workers refuse a folder no coordinator has published to. """
+        folder = str(tmpdir.join("queue"))
+        with pytest.raises(ValueError):
+            WorkQueue(folder, create=False)
+        assert not os.path.exists(folder)
+        WorkQueue(folder)
+        with pytest.raises(ValueError):
+            WorkQueue(folder, create=False)
+
+
+@pytest.fixture
+def qc(tmpdir, monkeypatch):
+    """
+    bamQC runs in this process and forked ones, which log each task they
+    process to a file.
+
+    :return callable: takes the BAM file and bamQC settings, and returns a
+        bamQC instance ready to run
+    """
+    # The script sets up its logger when run from the command line.
+    monkeypatch.setattr(bamQC, "_LOGGER", logging.getLogger("bamQC"),
+                        raising=False)
+    monkeypatch.setattr(workqueue, "POLL_SECONDS", 0.05)
+    monkeypatch.setattr(tiling, "POLL_SECONDS", 0.05)
+    log = str(tmpdir.join("tasks.log"))
+    call = bamQC.bamQC.__call__
+
+    def logged(self, task):
+        # Slow enough that every worker gets some of the tasks.
+        time.sleep(0.1)
+        with open(log, "a") as f:
+            f.write("{}\t{}\n".format(os.getpid(), task))
+        return call(self, task)
+    monkeypatch.setattr(bamQC.bamQC, "__call__", logged)
+
+    def make(bam_file, cores=1, **settings):
+        processor = bamQC.bamQC(bam_file, cores, str(tmpdir.join("qc.tsv")),
+                                None, **settings)
+        processor.register_files()
+        return processor
+    make.log = log
+    return make
+
+
+def _worker(qc, bam_file, folder, tile_size):
+    while not os.path.exists(os.path.join(folder, SETTINGS)):
+        time.sleep(0.01)
+    qc(bam_file, work_queue=folder, tile_size=tile_size).work()
+
+
+class TestDistributedRun:
+    """ Runs whose tasks are processed by workers through a queue. """
+
+    def test_workers(self, bam_file, tmpdir, qc):
+        """ Each task runs once, and the result matches a local run. """
+        local_state = str(tmpdir.join("local.state"))
+        local = qc(bam_file, tile_size=3001, state_file=local_state)
+        local.combine(local.run())
+        os.remove(qc.log)
+
+        folder = str(tmpdir.join("queue"))
+        context = multiprocessing.get_context("fork")
+        workers = [context.Process(target=_worker,
+                                   args=(qc, bam_file, folder, 3001))
+                   for _ in range(3)]
+        for worker in workers:
+            worker.start()
+        # A coordinator without cores of its own leaves every task to them.
+        queued_state = str(tmpdir.join("queued.state"))
+        coordinator = qc(bam_file, cores=0, tile_size=3001,
+                         state_file=queued_state, work_queue=folder)
+        tasks = coordinator.run()
+        coordinator.combine(tasks)
+        for worker in workers:
+            worker.join(60)
+            assert worker.exitcode == 0
+
+        with open(qc.log) as f:
+            runs = [line.rstrip("\n").split("\t") for line in f]
+        assert Counter(task for _, task in runs) == Counter(tasks)
+        assert len(set(pid for pid, _ in runs)) > 1
+        queued, local = QCState.load(queued_state), QCState.load(local_state)
+        assert np.array_equal(queued.counters, local.counters)
+        assert np.array_equal(queued.histogram, local.histogram)
+
+    def test_worker_without_coordinator(self, bam_file, tmpdir, qc):
+        """ A worker started before any run is published exits at once. """
+        folder = str(tmpdir.join("queue"))
+        worker = qc(bam_file, work_queue=folder)
+        started = time.time()
+        with pytest.raises(ValueError):
+            worker.work()
+        assert time.time() - started < 5
+        assert not os.path.exists(folder)
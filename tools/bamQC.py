@@ -9,6 +9,7 @@
 #
 
 from argparse import ArgumentParser
+import array
 import os
 import sys
 
@@ -16,12 +17,127 @@ import pararead
 #from pararead.processor import _LOGGER
 from pararead import add_logging_options, ParaReadProcessor
 from pararead import logger_via_cli
+from pararead.processor import PARA_READ_FILES, READS_FILE_KEY
+from tiling import TiledProcessor
+from qcstate import HEADER, QCState
+from sketch import HyperLogLog, hash_keys, precision_for_error
+from complexity import complexity_curve
+import profiler
 
-import pandas as _pd
 import numpy as np
 
-class bamQC(pararead.ParaReadProcessor):
-    def __init__(self, reads_filename, n_proc, out_filename, verbosity):
+
+def duplicate_stats(keys, n_group):
+    """
+    Count distinct and duplicated reads from their duplicate keys.
+
+    :param list[array.array] keys: one column per key field, with the read
+        position first
+    :param int n_group: number of leading key fields that define a
+        position, for M2
+    :return (numpy.ndarray, int): duplicate histogram, where element k is
+        the number of distinct keys seen k times; and number of positions
+        whose duplicated keys hold exactly two reads (M2)
+    """
+    keys = np.array([np.frombuffer(k, dtype=k.typecode) for k in keys],
+                    dtype=np.int64)
+    if not keys.shape[1]:
+        return np.zeros(1, dtype=np.int64), 0
+    keys = keys[:, np.lexsort(keys[::-1])]
+    new = np.r_[True, (keys[:, 1:] != keys[:, :-1]).any(axis=0)]
+    firsts = np.flatnonzero(new)
+    counts = np.diff(np.r_[firsts, keys.shape[1]])
+    duplicated = counts > 1
+    # Sum the reads of duplicated keys by position; M2 counts positions
+    # with exactly two.
+    dupKeys = keys[:n_group, firsts[duplicated]]
+    dupCounts = counts[duplicated]
+    if dupCounts.size:
+        newPos = np.r_[True, (dupKeys[:, 1:] != dupKeys[:, :-1]).any(axis=0)]
+        perPos = np.add.reduceat(dupCounts, np.flatnonzero(newPos))
+        M2 = int(np.count_nonzero(perPos == 2))
+    else:
+        M2 = 0
+    return np.bincount(counts), M2
+
+
+class DuplicateCounter(object):
+    """
+    Accumulate duplicate statistics over the keys of coordinate-sorted
+    reads, a batch at a time.
+
+    Duplicates share a position, so a batch that ends where the position
+    changes holds every copy of its keys; memory is bounded by the batch
+    size or the largest single-position pileup, whichever is bigger.
+    """
+    def __init__(self, n_fields, n_group, batch_size=None):
+        """
+        :param int n_fields: number of key fields, position first
+        :param int n_group: number of leading fields that define a position
+        :param int batch_size: keys held before counting; all of them, if
+            unset
+        """
+        self.keys = [array.array('l') for _ in range(n_fields)]
+        self.n_group = n_group
+        self.batch_size = batch_size
+        self.state = QCState()
+
+    def add(self, *columns):
+        """
+        :param numpy.ndarray columns: one array per key field, for a batch
+            of reads in coordinate order
+        """
+        for key, values in zip(self.keys, columns):
+            key.frombytes(np.asarray(values, dtype=key.typecode).tobytes())
+        if self.batch_size and len(self.keys[0]) >= self.batch_size:
+            # Keys at the last position may continue in the next batch.
+            positions = np.frombuffer(self.keys[0], dtype=self.keys[0].typecode)
+            n = int(np.searchsorted(positions, positions[-1]))
+            if n:
+                self.flush(n)
+
+    def flush(self, n=None):
+        """
+        Count the first n keys held (all of them, if unset) and drop them.
+        """
+        n = len(self.keys[0]) if n is None else n
+        histogram, M2 = duplicate_stats([k[:n] for k in self.keys],
+                                        self.n_group)
+        dupReads = int((np.arange(len(histogram)) * histogram)[2:].sum())
+        self.state = self.state + QCState({'dup_reads': dupReads, 'M2': M2},
+                                          histogram)
+        self.keys = [k[n:] for k in self.keys]
+
+
+class SketchCounter(DuplicateCounter):
+    """
+    Feed duplicate keys into a HyperLogLog sketch instead of counting them
+    exactly, so neither sorting nor memory grows with the number of keys.
+    """
+    def __init__(self, n_fields, chrom, precision, batch_size=None):
+        """
+        :param int n_fields: number of key fields
+        :param str chrom: chromosome the keys are on, hashed with them
+        :param int precision: sketch precision
+        :param int batch_size: keys held before hashing them
+        """
+        super(SketchCounter, self).__init__(n_fields, 1, batch_size)
+        self.chrom = chrom
+        self.state = QCState(sketch=HyperLogLog(precision))
+
+    def flush(self, n=None):
+        n = len(self.keys[0]) if n is None else n
+        self.state.sketch.add(hash_keys(self.chrom, [
+            np.frombuffer(k, dtype=k.typecode)[:n] for k in self.keys]))
+        self.keys = [k[n:] for k in self.keys]
+
+
+class bamQC(TiledProcessor, pararead.ParaReadProcessor):
+    def __init__(self, reads_filename, n_proc, out_filename, verbosity,
+                 tile_size=None, batch_size=1000000, state_file=None,
+                 sketch_error=None, complexity_file=None, max_fold=10,
+                 io_threads=1, checkpoint=None, work_queue=None,
+                 metrics=False):
         """
         Derive from ParaReadProcessor to build the bamQC caller instance.
 
@@ -33,10 +149,44 @@ class bamQC(pararead.ParaReadProcessor):
             Number of cores to use for processing.
         out_filename : str
             Name of output bamQC file
+        tile_size : int, default None
+            Split chromosomes longer than this into tiles processed as
+            separate tasks. Each tile counts the reads that start in it.
+        batch_size : int, default 1000000
+            Number of duplicate keys a task holds before counting them, as
+            reads stream in coordinate order. 0 holds a whole task.
+        state_file : str, default None
+            Where to save the merged QC state, for merging with other runs.
+        sketch_error : float, default None
+            Estimate distinct fragments with a HyperLogLog sketch of this
+            relative standard error instead of counting them exactly.
+        complexity_file : str, default None
+            Where to write the library complexity curve, extrapolated to
+            max_fold times the observed depth.
+        io_threads : int, default 1
+            Threads each task uses to decompress the BAM file.
+        checkpoint : str, default None
+            Folder in which to keep per-task states and a manifest of the
+            finished tasks, so that a killed run can resume.
+        work_queue : str, default None
+            Folder on shared storage through which tasks are handed to
+            workers, possibly on other nodes.
+        metrics : bool, default False
+            Measure each task, for write_metrics().
         """
         super(bamQC, self).__init__(reads_filename, n_proc, out_filename)
         self.reads_filename = reads_filename
         self.verbosity = verbosity
+        self.tile_size = tile_size
+        self.batch_size = batch_size
+        self.state_file = state_file
+        self.sketch_error = sketch_error
+        self.complexity_file = complexity_file
+        self.max_fold = max_fold
+        self.io_threads = io_threads
+        self.checkpoint = checkpoint
+        self.work_queue = work_queue
+        self.metrics = metrics
 
     def register_files(self):
         """
@@ -47,192 +197,234 @@ class bamQC(pararead.ParaReadProcessor):
         """
         super(bamQC, self).register_files()
 
-    def __call__(self, chrom):
+    def checkpoint_params(self):
+        return {"sketch_error": self.sketch_error}
+
+    def task_files(self, task):
+        return [self._tempf(task) + ".qcstate"]
+
+    def output_files(self):
+        return [f for f in [self.outfile, self.state_file,
+                            self.complexity_file] if f]
+
+    def __call__(self, task):
         """
         Primary function of the method.
         This function takes a chrom, and processes the reads in that chromosome
         from the input bamfile
 
-        @param chrom: a string with a chromosome, used by pysam.fetch to
-        grab a subset of reads from the bamfile
-        """
-
-        chrom_size = self.get_chrom_size(chrom)
-        
-        ##### DEFINE FUNCTIONS #####
-        def isPaired(chr):
-            for read in chr:
-                if read.is_paired:
-                    return True
-            return False
-
-        def countFlags(chr):
-            dups, unmap, unmap_mate, prop_pair, \
-                qcfail, num_pairs, num_reads = (0, 0, 0, 0, 0, 0, 0)
-            for read in chr:
-                num_reads += 1
-                if read.is_paired:
-                    num_pairs += 1
-                if read.is_duplicate:
-                    dups += 1
-                if read.is_unmapped:
-                    unmap += 1
-                if read.mate_is_unmapped:
-                    unmap_mate += 1
-                if read.is_proper_pair:
-                    prop_pair += 1
-                if read.is_qcfail:
-                    qcfail += 1   
-            return {'num_reads':num_reads, 'num_pairs':num_pairs/2,
-                    'dups':dups, 'unmap':unmap, 'unmap_mate':unmap_mate,
-                    'prop_pair':prop_pair, 'qcfail':qcfail}
-
-        def getRead(chr, paired):
-            if not paired:
-                keyDict = {'query_name', 'query_pos', 'template_length'}
-                readDict = dict([(key, []) for key in keyDict])
-                for read in chr:
-                    readDict['query_name'].append(read.query_name)
-                    readDict['query_pos'].append(read.pos)
-                    readDict['template_length'].append(read.query_length)
-                return _pd.DataFrame(readDict)
-            else:
-                keyDict = {'query_name', 'query_pos', 'template_length'}
-                read1 = dict([(key, []) for key in keyDict])
-                read2 = dict([(key, []) for key in keyDict])
-                for read in chr:
-                    if read.is_paired:
-                        if read.is_read1:
-                            read1['query_name'].append(read.query_name)
-                            read1['query_pos'].append(read.pos)
-                            read1['template_length'].append(read.template_length)
-                        elif read.is_read2:
-                            read2['query_name'].append(read.query_name)
-                            read2['query_pos'].append(read.pos)
-                            read2['template_length'].append(read.template_length)
-                merge = _pd.merge(_pd.DataFrame(read1), _pd.DataFrame(read2),
-                                  on = 'query_name')
-                return merge 
-
-        ##### MAIN #####
-        _LOGGER.info("[Name: " + chrom + "; Size: " + str(chrom_size) + "]")
-        if os.path.isfile(self.reads_filename):
-            chrom_out_file = self._tempf(chrom)
-            readCount = []
-            chrStats = {}
-            mitoCount = 0
-            isPE = isPaired(self.fetch_chunk(chrom))   
-            flags = countFlags(self.fetch_chunk(chrom))
-            if ('chrM' or 'rCRSd') in chrom:
-                mitoCount = mitoCount + float(flags['num_pairs'])
-                chrStats = {'mitoReads':mitoCount}         
-                #chrStats.update(flags)
-                np.save(chrom_out_file, chrStats)
-                return chrom
-            if isPE:
-                readVals = getRead(self.fetch_chunk(chrom), isPE)
-                readVals = readVals.drop(columns='query_name')            
-                M_DISTINCT = len(readVals.drop_duplicates())
-                M1 = ((flags['num_pairs']) -
-                       len(readVals[readVals.duplicated(keep=False)]))
-                posDup = readVals[readVals.duplicated(keep=False)]
-                posDupTable = posDup.groupby(['query_pos_x','template_length_x']).count()
-                cTable = posDupTable.groupby(['query_pos_y']).count()
-                M2 = 0
-                for key, value in cTable['template_length_y'].items():
-                    if key == 2:
-                        M2 = value
-                chrStats = {'M_DISTINCT':M_DISTINCT, 'M1':M1, 'M2':M2}         
-                chrStats.update(flags)
-                np.save(chrom_out_file, chrStats)
-            else:
-                readSE = getRead(self.fetch_chunk(chrom), isPE)
-                readSE = readSE.drop(columns='query_name')
-                M_DISTINCT = len(readSE.drop_duplicates())
-                M1 = (flags['num_reads']) - len(readSE[readSE.duplicated(keep=False)])
-                posDup = readSE[readSE.duplicated(keep=False)]
-                cTable = posDup.groupby(['query_pos']).count()
-                M2 = 0
-                if not cTable.empty:
-                    for key,value in cTable['template_length'].items():
-                        if value == 2:
-                            M2 += 1
-                chrStats = {'M_DISTINCT':M_DISTINCT, 'M1':M1, 'M2':M2}         
-                chrStats.update(flags)
-                np.save(chrom_out_file, chrStats)
-            return chrom
-        else:
-            _LOGGER.warn("{} could not be found.".format(self.reads_filename))
+        @param task: a string with a chromosome, or a region of one if
+        tiling, used by pysam.fetch to grab a subset of reads from the bamfile
+        """
+
+        chrom, start, end = self.task_region(task)
+        _LOGGER.info("[Name: " + task + "; Size: " + str(end - start) + "]")
+        if not os.path.isfile(self.reads_filename):
+            _LOGGER.warning("{} could not be found.".
+                            format(self.reads_filename))
             return
 
+        chrom_out_file = self.task_files(task)[0]
+        isMito = ('chrM' or 'rCRSd') in chrom
+        dups, unmap, unmap_mate, prop_pair, \
+            qcfail, num_pairs, num_reads = (0, 0, 0, 0, 0, 0, 0)
+        # Duplicate keys, counted in the same pass as the flags:
+        # (position, template length, mate position) of each read1 whose
+        # mate maps to the same chromosome, or (position, read length) of
+        # each read if none is paired. Pairs at one position with one
+        # template length are what PBC2 counts as duplicated.
+        isPE = False
+        if self.sketch_error:
+            precision = precision_for_error(self.sketch_error)
+            peKeys = SketchCounter(3, chrom, precision, self.batch_size)
+            seKeys = SketchCounter(2, chrom, precision, self.batch_size)
+        else:
+            peKeys = DuplicateCounter(3, 2, self.batch_size)
+            seKeys = DuplicateCounter(2, 1, self.batch_size)
+        tid = PARA_READ_FILES[READS_FILE_KEY].get_tid(chrom)
+        metrics = self.task_metrics
+        for batch in self.fetch_columns(task, owned=True):
+            with metrics.phase("flags"):
+                flag = batch["flag"]
+                num_reads += len(flag)
+                dups += np.count_nonzero(flag & 0x400)
+                unmap += np.count_nonzero(flag & 0x4)
+                unmap_mate += np.count_nonzero(flag & 0x8)
+                prop_pair += np.count_nonzero(flag & 0x2)
+                qcfail += np.count_nonzero(flag & 0x200)
+                paired = (flag & 0x1) != 0
+                num_pairs += np.count_nonzero(paired)
+            if paired.any() and not isPE:
+                isPE = True
+                seKeys = None
+            if isMito:
+                continue
+            with metrics.phase("duplicates"):
+                if isPE:
+                    # The mate's position is recorded on read1 itself, so a
+                    # pair is complete even when its mate starts in another
+                    # tile.
+                    pair = paired & ((flag & 0x40) != 0) & \
+                        ((flag & 0x8) == 0) & (batch["next_tid"] == tid)
+                    peKeys.add(batch["pos"][pair], batch["tlen"][pair],
+                               batch["next_pos"][pair])
+                else:
+                    seKeys.add(batch["pos"], batch["qlen"])
+
+        if isMito:
+            (QCState({'mito_paired_reads':num_pairs}) + peKeys.state).save(
+                chrom_out_file)
+            return task
+        keys = peKeys if isPE else seKeys
+        with metrics.phase("duplicates"):
+            keys.flush()
+        flags = QCState({'num_reads':num_reads, 'paired_reads':num_pairs,
+                         'dups':dups, 'unmap':unmap, 'unmap_mate':unmap_mate,
+                         'prop_pair':prop_pair, 'qcfail':qcfail,
+                         'pe_paired_reads':num_pairs if isPE else 0,
+                         'se_reads':0 if isPE else num_reads})
+        (flags + keys.state).save(chrom_out_file)
+        return task
+
     def combine(self, good_chromosomes, strict=False):
         """
         After running the process in parallel, this 'reduce' step will merge
-        all the temporary files into one, calculate the NRF, PBC1, and PBC2
-        and write those values to the outfile.
+        the per-task QC states, calculate the NRF, PBC1, and PBC2 and write
+        those values to the outfile, and the merged state to state_file if
+        one was given.
         """
         if not good_chromosomes:
-            _LOGGER.warn("No successful chromosomes, so no combining.")
-            header = ["Total_read_pairs", "Distinct_read_pairs",
-                      "One_read_pair", "Two_read_pairs", "Duplicate_rate",
-                      "Mitochondria_reads", "Mitochondria_rate", "NRF",
-                      "PBC1", "PBC2"]
-            np.savetxt(self.outfile, np.c_[0, 0, 0, 0, 0, 0, 0, 0, 0, 0],
-                       header='\t'.join(header), fmt='%s', delimiter='\t',
-                       comments='')
+            _LOGGER.warning("No successful chromosomes, so no combining.")
+            write_report(self.outfile, None)
             return
-        else:
-            _LOGGER.info("Merging {} files into output file: '{}'".
-                         format(len(good_chromosomes), self.outfile))
-            temp_files = [self._tempf(chrom) for chrom in good_chromosomes]
-            stats = {}
-            for i in range(len(temp_files)):
-                if not os.path.exists(temp_files[i] + '.npy'):
-                    continue
-                # load chrom data and add to dict                
-                chrStats = np.load(temp_files[i] + '.npy')
-                stats = {k: stats.get(k, 0) + chrStats.item().get(k, 0) for k in set(stats) | set(chrStats.item())}
-            if stats['num_pairs'] == 0:
-                total = max(1, float(stats['num_reads'])) 
-            else:
-                total = max(1, float(stats['num_pairs'])) 
-            dupRate = float(stats['dups'])/total
-            NRF = float(stats['M1'])/total
-            M2 = max(1, float(stats['M2']))
-            PBC1 = float(stats['M1'])/max(1, float(stats['M_DISTINCT']))
-            PBC2 = float(stats['M1'])/float(M2)
-            try:
-                mitoReads = float(stats['mitoReads'])
-            except KeyError:
-                mitoReads = 0	
-            try:
-                mitoRate = float(stats['mitoReads'])/total
-            except KeyError:
-                mitoRate = 0
-            header = ["Total_read_pairs", "Distinct_read_pairs",
-                      "One_read_pair", "Two_read_pairs", "Duplicate_rate",
-                      "Mitochondria_reads", "Mitochondria_rate", "NRF",
-                      "PBC1", "PBC2"]
-            np.savetxt(self.outfile, np.c_[total, stats['M_DISTINCT'],
-                       stats['M1'], M2, dupRate, mitoReads,
-                       mitoRate, NRF, PBC1, PBC2],
-                       header='\t'.join(header), fmt='%s', delimiter='\t',
-                       comments='')
+        _LOGGER.info("Merging {} files into output file: '{}'".
+                     format(len(good_chromosomes), self.outfile))
+        temp_files = [self.task_files(chrom)[0]
+                      for chrom in good_chromosomes]
+        state = QCState.merge(QCState.load(f) for f in temp_files
+                              if os.path.exists(f))
+        write_report(self.outfile, state)
+        if self.state_file:
+            state.save(self.state_file)
+        if self.complexity_file:
+            write_complexity(self.complexity_file, state, self.max_fold)
+
+
+def write_report(outfile, state):
+    """
+    Write the bamQC metrics table.
+
+    :param str outfile: output file name
+    :param QCState state: merged QC state; None writes a row of zeros
+    """
+    header = state.header() if state else HEADER
+    values = state.metrics() if state else [0] * len(header)
+    np.savetxt(outfile, np.array([values], dtype=object), header='\t'.join(header),
+               fmt='%s', delimiter='\t', comments='')
+
+
+def write_complexity(outfile, state, max_fold=10):
+    """
+    Write the expected number of distinct fragments against depth, from
+    the duplicate histogram, for deciding on deeper sequencing.
+
+    :param str outfile: output file name
+    :param QCState state: merged QC state, with exact duplicate counts
+    :param float max_fold: extrapolate to this multiple of the observed depth
+    """
+    if state.sketch is not None:
+        _LOGGER.warning("Sketched QC states have no duplicate histogram; "
+                        "skipping the complexity curve.")
+        return
+    depths, distinct, library = complexity_curve(state.histogram, max_fold)
+    _LOGGER.info("Estimated library size: {:.0f} distinct fragments".
+                 format(library))
+    np.savetxt(outfile, np.c_[depths, distinct],
+               header='Total_read_pairs\tDistinct_read_pairs', fmt='%.1f',
+               delimiter='\t', comments='')
 
 
 # read options from command line
 def parse_args(cmdl):
     parser = ArgumentParser(description='--Produce bamQC File--')
     parser.add_argument('-i', '--infile', dest='infile',
-                        help="Path to input file (in BAM format).",
-                        required=True)
+                        help="Path to input file (in BAM format).")
     parser.add_argument('-o', '--outfile', dest='outfile',
                         help="Output file name.")
     parser.add_argument('-c', '--cores', dest='cores', default=20, type=int,
                         help="Number of processors to use. Default=20")
+    parser.add_argument('-t', '--tile-size', dest='tile_size', default=None,
+                        type=int,
+                        help="Split chromosomes longer than this many bases "
+                             "into separately processed tiles. Default=None")
+    parser.add_argument('--io-threads', dest='io_threads', default=1,
+                        type=int,
+                        help="Threads each task uses to decompress the BAM "
+                             "file. Default=1")
+    parser.add_argument('-b', '--batch-size', dest='batch_size',
+                        default=1000000, type=int,
+                        help="Duplicate keys held per task before counting; "
+                             "reads are streamed in coordinate order, so "
+                             "memory stays bounded. 0 holds a whole "
+                             "chromosome. Default=1000000")
+    parser.add_argument('-s', '--state', dest='state', default=None,
+                        help="Also save the merged QC state to this file. "
+                             "Default=None")
+    parser.add_argument('-e', '--sketch-error', dest='sketch_error',
+                        default=None, type=float,
+                        help="Estimate distinct fragments with a HyperLogLog "
+                             "sketch of this relative error (e.g. 0.01) "
+                             "instead of exact counts. NRF, PBC1, PBC2 and "
+                             "their counts are reported as NA, and "
+                             "Distinct_rate (distinct / total) and "
+                             "Confidence columns are added. Default=None")
+    parser.add_argument('-x', '--complexity', dest='complexity', default=None,
+                        help="Also write the library complexity curve "
+                             "(expected distinct fragments against depth) "
+                             "to this file. Default=None")
+    parser.add_argument('--max-fold', dest='max_fold', default=10, type=float,
+                        help="Extrapolate the complexity curve to this "
+                             "multiple of the sequenced depth. Default=10")
+    parser.add_argument('--checkpoint', dest='checkpoint', default=None,
+                        help="Keep per-task results in this folder and, if "
+                             "an earlier run was interrupted, process only "
+                             "the tasks it did not finish. Removed once the "
+                             "output is written. Default=None")
+    parser.add_argument('--work-queue', dest='work_queue', default=None,
+                        help="Coordinate the run through this folder on "
+                             "shared storage: publish the tasks there, "
+                             "process them with -c local cores and any "
+                             "workers started with --worker, then combine. "
+                             "Default=None")
+    parser.add_argument('--worker', dest='worker', action='store_true',
+                        default=False,
+                        help="Only process tasks from --work-queue, with -c "
+                             "cores, and exit; start with the same arguments "
+                             "as the coordinator, once it has published its "
+                             "tasks. Default=False")
+    parser.add_argument('--metrics', dest='metrics', action='store_true',
+                        default=False,
+                        help="Record reads, phase timings, peak memory and "
+                             "bytes written for each task in "
+                             "<outfile>_metrics.tsv, with a run summary in "
+                             "<outfile>_metrics_summary.json. Default=False")
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help="Sample the call stacks of this process and its "
+                             "workers, and write them to this file as "
+                             "collapsed stacks for a flame graph. "
+                             "Default=None")
+    parser.add_argument('-m', '--merge', dest='merge', nargs="+", default=None,
+                        help="Instead of reading a BAM file, merge these QC "
+                             "state files (e.g. from several lanes) into one "
+                             "report. Default=None")
 
     parser = add_logging_options(parser)
-    return parser.parse_args(cmdl)
+    args = parser.parse_args(cmdl)
+    if not args.infile and not args.merge:
+        parser.error("either -i/--infile or -m/--merge is required")
+    if args.worker and not args.work_queue:
+        parser.error("--worker requires --work-queue")
+    return args
 
 
 # parallel processed computation of matrix for each chromosome
@@ -240,14 +432,48 @@ if __name__ == "__main__":
 
     args = parse_args(sys.argv[1:])
     _LOGGER = logger_via_cli(args)
+    profiler.start(args.profile)
+
+    if args.merge:
+        # Combine earlier runs' states without touching their BAM files.
+        state = QCState.merge(QCState.load(f) for f in args.merge)
+        write_report(args.outfile, state)
+        if args.state:
+            state.save(args.state)
+        if args.complexity:
+            write_complexity(args.complexity, state, args.max_fold)
+        profiler.finish()
+        sys.exit(0)
 
     qc = bamQC(reads_filename=args.infile,
                out_filename=args.outfile,
                n_proc=args.cores,
-               verbosity=args.verbosity)
+               verbosity=args.verbosity,
+               tile_size=args.tile_size,
+               batch_size=args.batch_size,
+               state_file=args.state,
+               sketch_error=args.sketch_error,
+               complexity_file=args.complexity,
+               max_fold=args.max_fold,
+               io_threads=args.io_threads,
+               checkpoint=args.checkpoint,
+               work_queue=args.work_queue,
+               metrics=args.metrics)
 
     qc.register_files()
+    if args.worker:
+        try:
+            qc.work()
+        except ValueError as e:
+            # No run published yet, or another run's: nothing to take part in.
+            _LOGGER.error(str(e))
+            sys.exit(1)
+        profiler.finish(merge_parts=False)
+        sys.exit(0)
     good_chromosomes = qc.run()
 
     _LOGGER.info("Reduce step (merge files)...")
     qc.combine(good_chromosomes)
+    qc.write_metrics(os.path.splitext(qc.outfile)[0])
+    qc.clear_checkpoint()
+    profiler.finish()
@@ -6,41 +6,393 @@ __license__ = "BSD2"
 __version__ = "0.1"
 __email__ = "nathan@code.databio.org"
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
+import array
 import itertools # Used for nested region looping across reads
 import numpy
 from operator import methodcaller
 import os
+import pickle
 import subprocess
 import sys
+import time
 
 import pararead
 import pysam
+from tiling import TiledProcessor
+import barcodes
+import cutstore
+import profiler
+
+try:
+    import pyBigWig
+except ImportError:
+    pyBigWig = None
 
 
 from pararead import add_logging_options, ParaReadProcessor
 from pararead import logger_via_cli
+from pararead.processor import PARA_READ_FILES, READS_FILE_KEY
+
+# Number of bases materialized at once when writing a dense track with the
+# numpy engine; this bounds worker memory regardless of chromosome size.
+DENSE_BLOCK_SIZE = 1000000
+
+
+def get_shifted_pos(read, shift_factor):
+    """
+    Shifts a read according to a shift factor to account for either
+    transposition insertion site shifting or DNAse read shifting,
+    depending on the strand of the read. Returns the shifted position of
+    interest.
+    :param read: A pysam read object
+    :param shift_factor: A dict with positive or negative integer values
+        for keys ["+", "-"], indicating how much (and which direction)
+        to shift reads on the + or - strand
+    """
+    # default
+    shifted_pos = None
+    if read.flag & 1:  # paired
+        if read.flag == 99:  # paired, mapped in pair, mate reversed, first in pair
+            shifted_pos = read.reference_start + shift_factor["+"]
+            #r.reference_length  # col 8
+        elif read.flag == 147:  # mate of 99
+            shifted_pos = read.reference_end + shift_factor["-"]
+        elif read.flag == 163:  # paired, mapped in pair, mate reversed, second in pair
+            shifted_pos = read.reference_start + shift_factor["+"]
+        elif read.flag == 83:   # mate of 163
+            shifted_pos = read.reference_end + shift_factor["-"]
+    else:  # unpaired
+        if read.flag & 16:  # read reverse strand
+            shifted_pos = read.reference_end + shift_factor["-"]
+        else:
+            shifted_pos = read.reference_start + shift_factor["+"]
+
+    return shifted_pos
+
+
+def shifted_cuts(batch, shift_factor):
+    """
+    Apply get_shifted_pos to a batch of reads at once.
+
+    :param dict batch: read columns from bamcolumns.BamColumns.fetch
+    :param shift_factor: A dict with positive or negative integer values
+        for keys ["+", "-"], as for get_shifted_pos
+    :return (numpy.ndarray, numpy.ndarray): shifted positions of the reads
+        that have one, and a mask of those reads within the batch
+    """
+    flag = batch["flag"]
+    unpaired = (flag & 1) == 0
+    plus = (flag == 99) | (flag == 163) | (unpaired & ~batch["is_reverse"])
+    minus = (flag == 147) | (flag == 83) | (unpaired & batch["is_reverse"])
+    shifted = numpy.where(plus, batch["pos"] + shift_factor["+"],
+                          batch["end"] + shift_factor["-"])
+    keep = plus | minus
+    return shifted[keep], keep
+
+
+def count_cuts(cuts, chrom_size):
+    """
+    Tally cut sites into a sparse count vector.
+
+    This is the in-memory equivalent of 'sort -n | cutsToWig.pl': positions
+    are 1-based wiggle coordinates, and anything that falls off either end
+    of the chromosome is clipped, as wigToBigWig -clip would.
+
+    :param cuts: array-like of integer cut positions, in any order
+    :param int chrom_size: length of the chromosome
+    :return (numpy.ndarray, numpy.ndarray): sorted distinct positions and the
+        number of cuts at each of them
+    """
+    cuts = numpy.asarray(cuts, dtype=numpy.int64)
+    cuts = cuts[(cuts >= 1) & (cuts <= chrom_size)]
+    return numpy.unique(cuts, return_counts=True)
+
+
+def smooth_counts(positions, cumulative, samples, smooth_length):
+    """
+    Count the cuts in a window around each sample position.
+
+    A cut at c contributes to every position in [c - smooth_length,
+    c + smooth_length), matching the window used by smoothWig.pl.
+
+    :param numpy.ndarray positions: sorted distinct cut positions
+    :param numpy.ndarray cumulative: running total of cut counts, with a
+        leading zero, so cumulative[i] is the number of cuts before
+        positions[i]
+    :param numpy.ndarray samples: positions at which to evaluate the track
+    :param int smooth_length: half-width of the window
+    :return numpy.ndarray: number of cuts covering each sample
+    """
+    hi = numpy.searchsorted(positions, samples + smooth_length, side="right")
+    lo = numpy.searchsorted(positions, samples - smooth_length, side="right")
+    return cumulative[hi] - cumulative[lo]
+
+
+def nonzero_runs(positions, values):
+    """
+    Collapse a sparse per-base signal into bedGraph-style intervals.
+
+    Consecutive positions carrying the same value become one interval, so
+    the output grows with the amount of signal, not with chromosome length.
+
+    :param numpy.ndarray positions: sorted distinct 1-based positions
+    :param numpy.ndarray values: non-zero signal at each of those positions
+    :return (numpy.ndarray, numpy.ndarray, numpy.ndarray): 0-based starts,
+        exclusive ends and values of each run
+    """
+    if not len(positions):
+        empty = numpy.array([], dtype=numpy.int64)
+        return empty, empty, numpy.array([], dtype=numpy.float64)
+    breaks = numpy.flatnonzero((numpy.diff(positions) != 1) |
+                               (numpy.diff(values) != 0)) + 1
+    firsts = numpy.concatenate(([0], breaks))
+    lasts = numpy.concatenate((breaks - 1, [len(positions) - 1]))
+    return (positions[firsts] - 1, positions[lasts],
+            values[firsts].astype(numpy.float64))
+
+
+def smooth_samples(positions, counts, start, end, step, smooth_length):
+    """
+    Evaluate the smooth track over a region and keep its non-zero samples.
+
+    Samples sit on a chromosome-wide grid (1, 1 + step, ...), so tiles line
+    up seamlessly.
+
+    :param numpy.ndarray positions: sorted distinct cut positions, including
+        any within smooth_length of the region
+    :param numpy.ndarray counts: number of cuts at each of those positions
+    :param int start: 0-based start of the region
+    :param int end: exclusive end of the region
+    :param int step: spacing between samples
+    :param int smooth_length: half-width of the smoothing window
+    :return (numpy.ndarray, numpy.ndarray): 1-based sample positions with
+        signal, and the signal at each
+    """
+    cumulative = numpy.concatenate(([0], numpy.cumsum(counts)))
+    first_step = (start + step - 1) // step
+    n_steps = (end + step - 1) // step
+    block_steps = max(1, DENSE_BLOCK_SIZE // step)
+    kept_samples, kept_values = [], []
+    for first in range(first_step, n_steps, block_steps):
+        last = min(first + block_steps, n_steps)
+        samples = numpy.arange(first, last, dtype=numpy.int64) * step + 1
+        values = smooth_counts(positions, cumulative, samples, smooth_length)
+        keep = values != 0
+        kept_samples.append(samples[keep])
+        kept_values.append(values[keep])
+    if not kept_samples:
+        return (numpy.array([], dtype=numpy.int64),
+                numpy.array([], dtype=numpy.int64))
+    return numpy.concatenate(kept_samples), numpy.concatenate(kept_values)
+
+
+def read_chrom_sizes(chrom_sizes_file):
+    """
+    Parse a UCSC-style chromosome sizes file.
+
+    :param str chrom_sizes_file: path to a two-column (name, size) file
+    :return list[(str, int)]: chromosome names and sizes, in file order
+    """
+    chrom_sizes = []
+    with open(chrom_sizes_file) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) >= 2:
+                chrom_sizes.append((fields[0], int(fields[1])))
+    return chrom_sizes
+
+
+# Open writers for the numpy engine, keyed by (track, normalization). These
+# live in the parent only; like the reads file, they can't be pickled along
+# with the CutTracer.
+TRACK_WRITERS = {}
+
+NORMALIZATIONS = ["cpm", "rpgc", "spikein"]
+
+
+def derived_filename(filename, *tags):
+    """
+    Name a derived track after its raw counterpart.
+
+    :param str filename: path to the raw track, e.g. 'sample_exact.bw'
+    :param str tags: labels to append, e.g. 'nfr', 'cpm'; nulls are skipped
+    :return str: path for the derived track, e.g. 'sample_exact_nfr_cpm.bw'
+    """
+    root, ext = os.path.splitext(filename)
+    return "_".join([root] + [t for t in tags if t]) + ext
+
+
+def fragment_bin(spec):
+    """
+    Parse a fragment length bin given as 'name:min-max'.
+
+    :param str spec: bin specification, e.g. 'nfr:0-100'
+    :return (str, int, int): name, and the half-open [min, max) range of
+        fragment lengths it accepts
+    :raise argparse.ArgumentTypeError: if the specification is malformed
+    """
+    try:
+        name, bounds = spec.rsplit(":", 1)
+        lo, hi = [int(x) for x in bounds.split("-")]
+    except ValueError:
+        raise ArgumentTypeError("Fragment bin must be 'name:min-max': " + spec)
+    if not name or lo >= hi:
+        raise ArgumentTypeError("Invalid fragment bin: " + spec)
+    return name, lo, hi
+
+
+class TrackWriter(object):
+    """
+    Assemble one multi-chromosome bigwig from the blocks workers send back.
+
+    Each block holds the signal for the region a task owns. Blocks must go
+    into the file in header order, so any that arrive early wait until the
+    ones before them are written; pyBigWig builds the zoom levels as the file
+    is closed. This replaces writing a temporary bigwig per chromosome and
+    joining them with bigWigCat.
+    """
+    def __init__(self, filename, chrom_sizes, task_order, step=1, sparse=False,
+                 scale=1.0):
+        """
+        :param str filename: path of the bigwig to write
+        :param list[(str, int)] chrom_sizes: header, in writing order
+        :param list[str] task_order: task keys, in the order their blocks
+            must be written
+        :param int step: spacing between the samples in the blocks
+        :param bool sparse: write only non-zero values, rather than a value
+            for every step
+        :param float scale: factor applied to every value as it is written
+        """
+        self.filename = filename
+        self.bw = pyBigWig.open(filename, "w")
+        self.bw.addHeader(chrom_sizes)
+        self.task_order = task_order
+        self.step = step
+        self.sparse = sparse
+        self.scale = scale
+        self.pending = {}
+        self.next_task = 0
+
+    def add(self, task, block):
+        """
+        Hand over a task's block, writing whatever is now next in line.
+
+        :param str task: task key
+        :param tuple block: (chrom, start, end, samples, values) for the
+            region the task owns, or None if there is nothing to write
+        """
+        self.pending[task] = block
+        while self.next_task < len(self.task_order) and \
+                self.task_order[self.next_task] in self.pending:
+            block = self.pending.pop(self.task_order[self.next_task])
+            self.next_task += 1
+            if block is not None:
+                self._write(*block)
+
+    def close(self):
+        if self.pending:
+            _LOGGER.warning("{} block(s) never became writable for '{}'".
+                            format(len(self.pending), self.filename))
+        self.bw.close()
+
+    def _write(self, chrom, start, end, samples, values):
+        """
+        Write the signal for one region.
+
+        Dense output is materialized one block at a time, so memory use
+        depends on DENSE_BLOCK_SIZE and the number of non-zero samples rather
+        than on the chromosome length. Sparse output writes per-base signal
+        as bedGraph runs, and sampled signal as variableStep entries.
+
+        :param str chrom: chromosome name
+        :param int start: 0-based start of the region
+        :param int end: exclusive end of the region
+        :param numpy.ndarray samples: sorted 1-based positions with signal,
+            on the grid 1, 1 + step, ...
+        :param numpy.ndarray values: signal at each of those positions
+        """
+        step = self.step
+        samples = samples.astype(numpy.int64)
+        values = values * self.scale
+        if self.sparse:
+            if not len(samples):
+                return
+            if step == 1:
+                starts, ends, run_values = nonzero_runs(samples, values)
+                self.bw.addEntries([chrom] * len(starts), starts, ends=ends,
+                                   values=run_values)
+            else:
+                self.bw.addEntries(chrom, samples - 1, span=1,
+                                   values=values.astype(numpy.float64))
+            return
+        slots = (samples - 1) // step
+        first_step = (start + step - 1) // step
+        n_steps = (end + step - 1) // step
+        block_steps = max(1, DENSE_BLOCK_SIZE // step)
+        for first in range(first_step, n_steps, block_steps):
+            last = min(first + block_steps, n_steps)
+            lo, hi = numpy.searchsorted(slots, [first, last])
+            block = numpy.zeros(last - first, dtype=numpy.float64)
+            block[slots[lo:hi] - first] = values[lo:hi]
+            self.bw.addEntries(chrom, first * step, values=block, span=1,
+                               step=step)
+
 
 # A function object like this will be pickled by the parallel call to map,
 # So it cannot contain huge files or the pickling will limit everything.
 # For this reason I must rely on global vars for the big stuff.
-class CutTracer(pararead.ParaReadProcessor):
+class CutTracer(TiledProcessor, pararead.ParaReadProcessor):
     """
     A function object that holds parameters and can be called
-    on different chromosomes. This extends the ParaReadProcessor object so
-    that it can be run in parallel.
+    on different chromosomes (or tiles of them). This extends the
+    ParaReadProcessor object so that it can be run in parallel.
     """
     def __init__(self, reads_filename, chrom_sizes_file, temp_parent, nProc, out_filename,
         limit, verbosity, shift_factor={"+":4, "-":-5}, summary_filename=None, 
-        bedout=False, smoothbw=False, smooth_length=25, step_size=5, retain_temp=False):
+        bedout=False, smoothbw=False, smooth_length=25, step_size=5, retain_temp=False,
+        engine="numpy", tile_size=None, sparse=False, normalize=None,
+        spike_in=None, genome_size=None, fragment_bins=None, store=None,
+        store_dtype="uint16", barcode_tag=None, barcode_features=None,
+        barcode_bin_size=5000, barcode_out=None, io_threads=1,
+        checkpoint=None, work_queue=None, metrics=False):
         # The resultAcronym should be set for each class
         self.resultAcronym="cuttrace"
         self.chrom_sizes_file = chrom_sizes_file
         self.shift_factor = shift_factor
+        self.engine = engine
+
+        if engine == "numpy":
+            if pyBigWig is None:
+                raise ImportError("The numpy engine requires pyBigWig; "
+                                  "install it or use '--engine pipe'.")
+            self.chrom_sizes = read_chrom_sizes(chrom_sizes_file)
+
+        if normalize and engine == "pipe":
+            raise ValueError("Normalized tracks require the numpy engine.")
+        if fragment_bins and engine == "pipe":
+            raise ValueError("Fragment length bins require the numpy engine.")
+        if store and engine == "pipe":
+            raise ValueError("A cut store requires the numpy engine.")
+        if barcode_tag and engine == "pipe":
+            raise ValueError("Barcode counting requires the numpy engine.")
+        if normalize == "spikein" and not spike_in:
+            raise ValueError("Spike-in normalization needs spike-in contigs.")
+
+        # The pipe engine writes whole-chromosome wiggles, so it can't tile.
+        if tile_size and engine == "pipe":
+            _LOGGER.warning("Tiling requires the numpy engine; processing whole chromosomes.")
+            tile_size = None
+        self.tile_size = tile_size
+        self.io_threads = io_threads
+        self.checkpoint = checkpoint
+        self.work_queue = work_queue
+        self.metrics = metrics
 
         # Saving a smooth bigwig doubles the processor use for each chrom, so we
-        # need to run half as many chroms at a time
-        if smoothbw:
+        # need to run half as many chroms at a time. The numpy engine smooths
+        # in the same worker, so it keeps every core.
+        if smoothbw and engine == "pipe":
             _LOGGER.info("Cutting parallel chroms in half to accommodate smooth track.")
             nProc = max(int(nProc / 2), 1)
 
@@ -53,29 +405,433 @@ class CutTracer(pararead.ParaReadProcessor):
         self.smoothbw = smoothbw
         self.smooth_length = smooth_length
         self.step_size = step_size
+        self.sparse = sparse
+        self.normalize = normalize
+        self.spike_in = spike_in or []
+        self.genome_size = genome_size
+        self.fragment_bins = fragment_bins or []
+        self.store = store
+        self.store_dtype = store_dtype
+        self.barcode_tag = barcode_tag
+        self.barcode_features = barcode_features
+        self.barcode_bin_size = barcode_bin_size
+        if barcode_tag:
+            # Built before the workers fork, so each inherits a copy.
+            self.features = barcodes.FeatureSet(
+                self.chrom_sizes, bed_file=barcode_features,
+                bin_size=barcode_bin_size)
+            self.barcode_out = barcode_out or \
+                os.path.splitext(self.outfile)[0] + "_barcode"
 
     def register_files(self):
         super(CutTracer, self).register_files()
 
+    def checkpoint_params(self):
+        params = {"engine": self.engine, "shift_factor": self.shift_factor,
+                  "bedout": bool(self.bedout), "smoothbw": bool(self.smoothbw),
+                  "smooth_length": self.smooth_length,
+                  "step_size": self.step_size,
+                  "fragment_bins": self.fragment_bins,
+                  "barcode_tag": self.barcode_tag}
+        if self.barcode_tag:
+            params.update(barcode_features=self.barcode_features,
+                          barcode_bin_size=self.barcode_bin_size)
+        if self.engine == "pipe":
+            params["sparse"] = self.sparse
+        return params
+
+    def task_files(self, task):
+        chromOutFile = self._tempf(task)
+        if self.engine == "pipe":
+            files = [chromOutFile + ".bw"]
+            if self.smoothbw:
+                files.append(chromOutFile + "_smooth.bw")
+        else:
+            files = [chromOutFile + ".blocks"]
+            if self.barcode_tag:
+                files.append(chromOutFile + ".barcodes")
+        if self.bedout:
+            files.append(chromOutFile + ".bed")
+        return files
+
+    def output_files(self):
+        """
+        The bigwigs, bed and cut store this run writes, for the metrics.
+        """
+        files = []
+        bins = [None] + [name for name, _, _ in self.fragment_bins]
+        for filename in [self.outfile, self.smoothbw]:
+            if not filename:
+                continue
+            for fragments in bins:
+                files.append(derived_filename(filename, fragments))
+                if self.normalize:
+                    files.append(derived_filename(filename, fragments,
+                                                  self.normalize))
+        return files + [f for f in [self.bedout, self.store] if f]
+
+    def save_result(self, task, result):
+        """
+        Keep a numpy task's blocks, which otherwise only reach the writers.
+        """
+        if self.engine == "pipe":
+            return
+        with open(self._tempf(task) + ".blocks", "wb") as f:
+            pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+
+    def load_result(self, task):
+        """
+        Reload the blocks of a task finished by an earlier run or by a
+        queue worker. The cut store is laid out afresh in prepare(), and
+        queue workers leave it alone, so the counts are written to it here.
+        """
+        if self.engine == "pipe":
+            return task
+        with open(self._tempf(task) + ".blocks", "rb") as f:
+            blocks = pickle.load(f)
+        if self.store:
+            chrom, _, _, positions, counts = blocks[("exact", None)]
+            cutstore.write_counts(self.store, chrom, positions, counts)
+        return blocks
+
     def unbuffered_write(self, txt):
         """ Writes unbuffered output by flushing after each stdout.write call """
         sys.stdout.write(txt)
         sys.stdout.flush()
 
-    def __call__(self, chrom):
+    def __call__(self, task):
         """
         Workhorse function of the method.
         This function takes a chrom, and processes the reads in that chromosome
         in the input bamfile
-        @param chrom: a string with a chromosome, used by bamFile.fetch to
-        grab a subset of reads from the bamfile
+        @param task: a string with a chromosome, or a region of one if
+        tiling, used by bamFile.fetch to grab a subset of reads from the
+        bamfile
+        """
+        if self.engine == "pipe":
+            return self._trace_pipe(task)
+        return self._trace_numpy(task)
+
+    def _write_bed_line(self, bedOut, chrom, read, shifted_pos):
+        strand = "-" if read.is_reverse else "+"
+        # The bed file needs 6 columns (even though some are dummy) because
+        # MACS says so.
+        bedOut.write("\t".join([
+            chrom,
+            str(shifted_pos - self.smooth_length),
+            str(shifted_pos + self.smooth_length), 
+            "N", 
+            "0",
+            strand]) + "\n")
+
+    def scale_factor(self):
+        """
+        Derive the normalization factor from the read counts in the BAM
+        index, so it is known before any reads are decoded.
+
+        cpm: counts per million reads mapped outside any spike-in contigs.
+        rpgc: scaled to 1x depth, so that the exact track averages one cut
+            per base over the effective genome size (by default, the sum of
+            the chromosome sizes).
+        spikein: counts per million reads mapped to the spike-in contigs.
+
+        :return float: factor by which to multiply the raw counts
+        """
+        readsfile = PARA_READ_FILES[READS_FILE_KEY]
+        mapped = dict((istat.contig, istat.mapped)
+                      for istat in readsfile.get_index_statistics())
+        spike = set(self.spike_in)
+        if self.normalize == "spikein":
+            total = sum(n for c, n in mapped.items() if c in spike)
+        else:
+            total = sum(n for c, n in mapped.items() if c not in spike)
+        if not total:
+            _LOGGER.warning("No reads to normalize by; scaling by 0.")
+            return 0.0
+        if self.normalize == "rpgc":
+            genome_size = self.genome_size or \
+                sum(size for _, size in self.chrom_sizes)
+            return float(genome_size) / total
+        return 1e6 / total
+
+    def prepare(self, queue):
+        """
+        Decide the order of the output bigwigs before any task runs.
+
+        Chromosomes go into the header in the order their first task is
+        dispatched, and run() dispatches a chromosome's tiles in genomic
+        order, so the writing order is the dispatch order: only the blocks
+        of tasks that finish ahead of others still running wait in memory.
+        Chromosomes without reads follow, so every one of them is declared,
+        as with wigToBigWig -keepAllChromosomes.
+        """
+        if self.engine == "pipe":
+            return
+        size_by_chrom = dict(self.chrom_sizes)
+        header, listed = [], set()
+        for task in queue:
+            chrom = self.task_region(task)[0]
+            if chrom in size_by_chrom and chrom not in listed:
+                header.append((chrom, size_by_chrom[chrom]))
+                listed.add(chrom)
+        header += [c for c in self.chrom_sizes if c[0] not in listed]
+        rank = dict((chrom, i) for i, (chrom, _) in enumerate(header))
+        self.header = header
+        self.task_order = sorted(queue, key=lambda t: (
+            rank.get(self.task_region(t)[0], len(rank)), self.task_region(t)[1]))
+        if self.normalize:
+            self.scale = self.scale_factor()
+            _LOGGER.info("Scaling {} tracks by {}".format(self.normalize, self.scale))
+        if self.store:
+            # Laid out up front, so workers can fill in their own regions.
+            _LOGGER.info("Writing cut store: '{}'".format(self.store))
+            cutstore.create_store(self.store, self.chrom_sizes,
+                                  self.store_dtype,
+                                  meta={"shift_factor": self.shift_factor})
+
+    def collect(self, task, result):
+        """
+        Pass a finished task's blocks on to the output writers.
+        """
+        if self.engine == "pipe":
+            return
+        if not TRACK_WRITERS:
+            outputs = [("exact", self.outfile, 1)]
+            if self.smoothbw:
+                outputs.append(("smooth", self.smoothbw, self.step_size))
+            bins = [None] + [name for name, _, _ in self.fragment_bins]
+            for track, filename, step in outputs:
+                for fragments in bins:
+                    TRACK_WRITERS[(track, fragments, None)] = TrackWriter(
+                        derived_filename(filename, fragments),
+                        self.header, self.task_order, step=step,
+                        sparse=self.sparse)
+                    # Normalized tracks are scaled copies written from the
+                    # same blocks, so they cost no extra pass over the reads.
+                    if self.normalize:
+                        TRACK_WRITERS[(track, fragments, self.normalize)] = TrackWriter(
+                            derived_filename(filename, fragments, self.normalize),
+                            self.header, self.task_order, step=step,
+                            sparse=self.sparse, scale=self.scale)
+        for (track, fragments, _), writer in TRACK_WRITERS.items():
+            writer.add(task, result[(track, fragments)] if result else None)
+
+    def _trace_numpy(self, task):
+        """
+        Count shifted cut sites in memory and send the signal back to the
+        parent, which writes the bigwigs; no subprocesses are spawned.
+
+        A tile reports only the bases it covers, but it fetches reads from a
+        little beyond its edges: enough that every cut landing in the tile,
+        or within smooth_length of it, is counted no matter which tile the
+        read starts in.
+
+        :param str task: chromosome, or region of one, to process
+        :return dict: blocks of (chrom, start, end, samples, values) for the
+            TrackWriters, keyed by ("exact" or "smooth", fragment bin name),
+            where a bin name of None means all reads
+        """
+        chrom, start, end = self.task_region(task)
+        chrom_size = self.get_chrom_size(chrom)
+        _LOGGER.info("[Name: " + task + "; Size: " + str(end - start) + "]")
+        if chrom not in dict(self.chrom_sizes):
+            _LOGGER.warning("Skipping {}: not in chromosome sizes file".format(chrom))
+            return None
+
+        pad = self.smooth_length + max(map(abs, self.shift_factor.values())) + 1
+        if self.barcode_tag:
+            # A tile counts the features that start in it, so it also needs
+            # the reads that fall in them past its end.
+            pad += self.features.max_length
+            cuts, lengths, reverse, codes, barcode_codes = \
+                self._tagged_cuts(task, pad)
+        else:
+            cuts, lengths, reverse = self._cuts(task, pad)
+
+        metrics = self.task_metrics
+        if self.bedout:
+            with metrics.phase("bed"):
+                # Each bed line is written by the tile that owns its cut site.
+                owned = ((start == 0) | (cuts > start)) & \
+                    ((end == chrom_size) | (cuts <= end))
+                self._write_bed(self._tempf(task) + ".bed", chrom,
+                                cuts[owned], reverse[owned])
+
+        blocks = {}
+        with metrics.phase("count"):
+            self._add_blocks(blocks, None, chrom, start, end, chrom_size, cuts)
+            if self.fragment_bins:
+                # Unpaired reads, and pairs split across chromosomes, have
+                # no fragment length (tlen 0), so they belong to no bin.
+                paired = lengths > 0
+                for name, lo, hi in self.fragment_bins:
+                    in_bin = paired & (lengths >= lo) & (lengths < hi)
+                    self._add_blocks(blocks, name, chrom, start, end,
+                                     chrom_size, cuts[in_bin])
+        # Queue workers may run on other nodes, so only the parent writes
+        # the store there; see load_result().
+        if self.store and not self.work_queue:
+            with metrics.phase("store"):
+                _, _, _, positions, counts = blocks[("exact", None)]
+                clipped = cutstore.write_counts(self.store, chrom, positions,
+                                                counts)
+            if clipped:
+                _LOGGER.warning("Clipped {} counts in {} to fit the {} store".
+                                format(clipped, task, self.store_dtype))
+        if self.barcode_tag:
+            with metrics.phase("barcodes"):
+                self._count_barcodes(task, chrom, start, end, cuts, codes,
+                                     barcode_codes)
+        metrics.count("cuts", len(cuts))
+        metrics.count("bytes_returned", sum(
+            block[3].nbytes + block[4].nbytes for block in blocks.values()))
+        return blocks
+
+    def _cuts(self, task, pad):
+        """
+        Shifted cut sites of the reads around a task region, decoded as
+        batches of columns rather than read by read.
+
+        :return (numpy.ndarray, numpy.ndarray, numpy.ndarray): cut sites,
+            fragment lengths and whether each read is on the minus strand
         """
+        cuts, lengths, reverse = [], [], []
+        for batch in self.fetch_columns(task, pad):
+            with self.task_metrics.phase("shift"):
+                shifted, keep = shifted_cuts(batch, self.shift_factor)
+                cuts.append(shifted)
+                lengths.append(numpy.abs(batch["tlen"][keep]))
+                reverse.append(batch["is_reverse"][keep])
+        if not cuts:
+            return (numpy.array([], dtype=numpy.int64),
+                    numpy.array([], dtype=numpy.int64),
+                    numpy.array([], dtype=bool))
+        return (numpy.concatenate(cuts), numpy.concatenate(lengths),
+                numpy.concatenate(reverse))
 
+    def _tagged_cuts(self, task, pad):
+        """
+        As _cuts, also reading each read's barcode, which only pysam can
+        decode.
+
+        :return tuple: cut sites, fragment lengths and strands as for _cuts,
+            then the barcode code of each cut (-1 for untagged reads) and
+            the code of each barcode
+        """
+        cuts = array.array('l')
+        lengths = array.array('l')
+        reverse = array.array('b')
+        codes = array.array('l')
+        barcode_codes = {}
+        # Decoding, shifting and tag lookups happen read by read here, so
+        # they are timed together.
+        with self.task_metrics.phase("decode"):
+            reads = self._tagged_reads(task, pad, cuts, lengths, reverse,
+                                       codes, barcode_codes)
+        self.task_metrics.count("reads", reads)
+        return (numpy.frombuffer(cuts, dtype=cuts.typecode),
+                numpy.frombuffer(lengths, dtype=lengths.typecode),
+                numpy.frombuffer(reverse, dtype=reverse.typecode).astype(bool),
+                codes, barcode_codes)
+
+    def _tagged_reads(self, task, pad, cuts, lengths, reverse, codes,
+                      barcode_codes):
+        """
+        Fill in the arrays of _tagged_cuts.
+
+        :return int: number of reads that start in the task region; those
+            in the padding are counted by their own tiles
+        """
+        _, start, end = self.task_region(task)
+        n = 0
+        for read in self.fetch_region(task, pad):
+            if start <= read.reference_start < end:
+                n += 1
+            shifted_pos = get_shifted_pos(read, self.shift_factor)
+            if shifted_pos is None:
+                continue
+            cuts.append(shifted_pos)
+            lengths.append(abs(read.template_length))
+            reverse.append(read.is_reverse)
+            try:
+                barcode = read.get_tag(self.barcode_tag)
+                codes.append(barcode_codes.setdefault(
+                    barcode, len(barcode_codes)))
+            except KeyError:
+                codes.append(-1)
+        return n
+
+    def _write_bed(self, filename, chrom, cuts, reverse):
+        """
+        Write cut sites as the 6-column bed of _write_bed_line.
+        """
+        strands = numpy.where(reverse, "-", "+")
+        with open(filename, "w") as bedOut:
+            for cut, strand in zip(cuts.tolist(), strands.tolist()):
+                bedOut.write("{}\t{}\t{}\tN\t0\t{}\n".format(
+                    chrom, cut - self.smooth_length, cut + self.smooth_length,
+                    strand))
+
+    def _count_barcodes(self, task, chrom, start, end, cuts, codes,
+                        barcode_codes):
+        """
+        Write the task's nonzero (feature, barcode) cut counts to its temp
+        file, for combine() to merge into the barcode matrix.
+        """
+        ids, starts, ends = self.features.owned(chrom, start, end)
+        index, code, count = barcodes.count_by_feature(
+            cuts, numpy.frombuffer(codes, dtype=codes.typecode), starts, ends)
+        names = sorted(barcode_codes, key=barcode_codes.get)
+        with open(self._tempf(task) + ".barcodes", "w") as f:
+            for i, c, n in zip(ids[index], code, count):
+                f.write("{}\t{}\t{}\n".format(i, names[c], n))
+        _LOGGER.debug("Counted {} barcodes over {} features in {}".
+                      format(len(names), len(ids), task))
+
+    def _add_blocks(self, blocks, fragments, chrom, start, end, chrom_size, cuts):
+        """
+        Count one set of cuts and add its exact (and smooth) blocks.
+
+        :param dict blocks: blocks for the task, updated in place
+        :param str fragments: fragment bin name, or None for all reads
+        :param str chrom: chromosome name
+        :param int start: 0-based start of the region the task owns
+        :param int end: exclusive end of the region the task owns
+        :param int chrom_size: chromosome length
+        :param cuts: array-like of the cut positions
+        """
+        positions, counts = count_cuts(cuts, chrom_size)
+
+        # Compact types keep the blocks cheap to send back to the parent.
+        lo, hi = numpy.searchsorted(positions, [start + 1, end + 1])
+        blocks[("exact", fragments)] = (chrom, start, end,
+                                        positions[lo:hi].astype(numpy.uint32),
+                                        counts[lo:hi].astype(numpy.uint32))
+        _LOGGER.debug("Counted " + str(counts[lo:hi].sum()) + " cuts for " +
+                      chrom + ":" + str(start) + "-" + str(end) +
+                      (" (" + fragments + ")" if fragments else ""))
+
+        if self.smoothbw:
+            samples, values = smooth_samples(positions, counts, start, end,
+                                             self.step_size, self.smooth_length)
+            blocks[("smooth", fragments)] = (chrom, start, end,
+                                             samples.astype(numpy.uint32),
+                                             values.astype(numpy.uint32))
+
+    def _trace_pipe(self, chrom):
+        """
+        Legacy engine: stream cut sites as text through sort, the perl
+        wiggle writers and wigToBigWig.
+
+        :param str chrom: chromosome to process
+        :return str: the chromosome name, signaling success
+        """
         chrom_size = self.get_chrom_size(chrom)
 
         #self.unbuffered_write("[Name: " + chrom + "; Size: " + str(chrom_size) + "]")
         _LOGGER.info("[Name: " + chrom + "; Size: " + str(chrom_size) + "]")
-        reads = self.fetch_chunk(chrom)
+        metrics = self.task_metrics
+        reads = metrics.timed("decode", self.fetch_chunk(chrom))
 
         # if isinstance(reads, list):
         #     print("Chrom has no reads: " + chrom)
@@ -116,69 +872,43 @@ class CutTracer(pararead.ParaReadProcessor):
             bedOut = open(chromOutFileBed, "w")
         
 
-        def get_shifted_pos(read, shift_factor):
-            """
-            Shifts a read according to a shift factor to account for either
-            transposition insertion site shifting or DNAse read shifting,
-            depending on the strand of the read. Returns the shifted position of
-            interest.
-            :param read: A pysam read object
-            :param shift_factor: A dict with positive or negative integer values
-                for keys ["+", "-"], indicating how much (and which direction)
-                to shift reads on the + or - strand
-            """
-            # default
-            shifted_pos = None
-            if read.flag & 1:  # paired
-                if read.flag == 99:  # paired, mapped in pair, mate reversed, first in pair
-                    shifted_pos = read.reference_start + shift_factor["+"]
-                    #r.reference_length  # col 8
-                elif read.flag == 147:  # mate of 99
-                    shifted_pos = read.reference_end + shift_factor["-"]
-                elif read.flag == 163:  # paired, mapped in pair, mate reversed, second in pair
-                    shifted_pos = read.reference_start + shift_factor["+"]
-                elif read.flag == 83:   # mate of 163
-                    shifted_pos = read.reference_end + shift_factor["-"]
-            else:  # unpaired
-                if read.flag & 16:  # read reverse strand
-                    shifted_pos = read.reference_end + shift_factor["-"]
-                else:
-                    shifted_pos = read.reference_start + shift_factor["+"]
-
-            return shifted_pos    
-
-
+        # The perl writers switch to sparse output when they see a
+        # variableStep header, and pass the header through.
         begin = 1
-        header_line = "fixedStep chrom=" + chrom + " start=" + str(begin) + " step=1\n";
+        if self.sparse:
+            header_line = "variableStep chrom=" + chrom + "\n"
+        else:
+            header_line = "fixedStep chrom=" + chrom + " start=" + str(begin) + " step=1\n";
         cutsToWigProcess.stdin.write(header_line)
 
         if self.smoothbw:
-            header_line = "fixedStep chrom=" + chrom + " start=" + str(begin) + " step=" + str(self.step_size) + "\n";
+            if not self.sparse:
+                header_line = "fixedStep chrom=" + chrom + " start=" + str(begin) + " step=" + str(self.step_size) + "\n";
             cutsToWigProcessSm.stdin.write(header_line)
 
         try:
+            # Time spent writing to the pipes, net of decoding the reads.
+            streaming = time.time()
+            n_reads = 0
             for read in reads:
-                shifted_pos = get_shifted_pos(read, shift_factor)
+                n_reads += 1
+                shifted_pos = get_shifted_pos(read, self.shift_factor)
                 cutsToWigProcess.stdin.write(str(shifted_pos) + "\n")
 
                 if self.smoothbw:
                     cutsToWigProcessSm.stdin.write(str(shifted_pos) + "\n")
 
                 if self.bedout:
-                    strand = "-" if read.is_reverse else "+"
-                    # The bed file needs 6 columns (even though some are dummy) because
-                    # MACS says so.
-                    bedOut.write("\t".join([
-                        chrom,
-                        str(shifted_pos - self.smooth_length),
-                        str(shifted_pos + self.smooth_length), 
-                        "N", 
-                        "0",
-                        strand]) + "\n")
+                    self._write_bed_line(bedOut, chrom, read, shifted_pos)
             
 
+            metrics.add("pipe", time.time() - streaming -
+                        metrics.seconds("decode"))
+            metrics.count("reads", n_reads)
+
             # Clean up processes
 
+            encoding = time.time()
             cutsToWigProcess.stdin.close()
 
             if self.bedout:
@@ -194,6 +924,7 @@ class CutTracer(pararead.ParaReadProcessor):
 
             _LOGGER.debug("Encoding bigwig for " + chrom + " (last read position:" + str(read.pos) + ")...")
             wigToBigWigProcess.communicate()
+            metrics.add("encode", time.time() - encoding)
 
         except StopIteration as e:
             print("StopIteration error for chrom ", chrom, ": ", e)
@@ -205,33 +936,53 @@ class CutTracer(pararead.ParaReadProcessor):
         """
         After running the process in parallel, this 'reduce' step will simply
         merge all the temporary files into one, and rename it to the output
-        file name.
+        file name. Tiles arrive in genomic order and never overlap, so
+        bigWigCat stitches them back into whole chromosomes. The numpy engine
+        has already written its bigwigs as results came in, so only the
+        zoom levels remain to be finished as the writers close.
         """
+        for track in list(TRACK_WRITERS):
+            _LOGGER.info("Finishing output file: '{}'".
+                         format(TRACK_WRITERS[track].filename))
+            TRACK_WRITERS.pop(track).close()
+
         if not good_chromosomes:
             _LOGGER.info("No successful chromosomes, so no combining.")
             return
-        elif len(good_chromosomes) == 1:
-            subprocess.call(["mv", self._tempf(good_chromosomes[0]) + ".bw", self.outfile])
-            subprocess.call(["mv", self._tempf(good_chromosomes[0]) + "_smooth.bw", self.smoothbw])
-
-        else:
-            _LOGGER.info("Merging {} files into output file: '{}'".
-                  format(len(good_chromosomes), self.outfile))
-            temp_files = [self._tempf(chrom) + ".bw" for chrom in good_chromosomes]
-            cmd = "bigWigCat " + self.outfile + " " + " ".join(temp_files)
-            _LOGGER.debug(cmd)
-            p = subprocess.call(['bigWigCat', self.outfile] + temp_files)
-
+        if self.barcode_tag:
+            n_barcodes, nnz = barcodes.write_matrix(
+                self.barcode_out,
+                [self._tempf(task) + ".barcodes" for task in good_chromosomes],
+                self.features)
+            _LOGGER.info("Wrote {} counts for {} barcodes to '{}_matrix.mtx'".
+                         format(nnz, n_barcodes, self.barcode_out))
+        if self.engine != "numpy":
+            if len(good_chromosomes) == 1:
+                subprocess.call(["mv", self._tempf(good_chromosomes[0]) + ".bw", self.outfile])
+                if self.smoothbw:
+                    subprocess.call(["mv", self._tempf(good_chromosomes[0]) + "_smooth.bw", self.smoothbw])
 
-            if self.smoothbw:
+            else:
                 _LOGGER.info("Merging {} files into output file: '{}'".
-                      format(len(good_chromosomes), self.smoothbw))
-                temp_files = [self._tempf(chrom) + "_smooth.bw" for chrom in good_chromosomes]
-                cmd = "bigWigCat " + self.smoothbw + " " + " ".join(temp_files)
+                      format(len(good_chromosomes), self.outfile))
+                temp_files = [self._tempf(chrom) + ".bw" for chrom in good_chromosomes]
+                cmd = "bigWigCat " + self.outfile + " " + " ".join(temp_files)
                 _LOGGER.debug(cmd)
-                p = subprocess.call(['bigWigCat', self.smoothbw] + temp_files)
+                p = subprocess.call(['bigWigCat', self.outfile] + temp_files)
 
-            if self.bedout:
+
+                if self.smoothbw:
+                    _LOGGER.info("Merging {} files into output file: '{}'".
+                          format(len(good_chromosomes), self.smoothbw))
+                    temp_files = [self._tempf(chrom) + "_smooth.bw" for chrom in good_chromosomes]
+                    cmd = "bigWigCat " + self.smoothbw + " " + " ".join(temp_files)
+                    _LOGGER.debug(cmd)
+                    p = subprocess.call(['bigWigCat', self.smoothbw] + temp_files)
+
+        if self.bedout:
+            if len(good_chromosomes) == 1:
+                subprocess.call(["mv", self._tempf(good_chromosomes[0]) + ".bed", self.bedout])
+            else:
                 # root, ext = os.path.splitext(self.outfile)
                 temp_files = [self._tempf(chrom) + ".bed" for chrom in good_chromosomes]
                 cmd = "cat " + " ".join(temp_files) + " > " + self.bedout
@@ -239,7 +990,6 @@ class CutTracer(pararead.ParaReadProcessor):
                 p = subprocess.call(cmd, shell=True)
 
 
-
 def parse_args(cmdl):
     parser = ArgumentParser(description='Bam processor')
     parser.add_argument('-i', '--infile', dest='infile',
@@ -254,7 +1004,7 @@ def parse_args(cmdl):
         help="Output file (bigwig format)")
     parser.add_argument('-w', '--smoothbw', dest='smoothbw', default=None,
         help="Output filename for smooth bigwig. Default: None")
-    parser.add_argument('-r', '--step-size', default=5,
+    parser.add_argument('-r', '--step-size', default=5, type=int,
         help="Step size for smooth tracks. Default: 5")
     parser.add_argument('-b', '--bedout', default=None,
         help="Output filename for bed file. Default: None")
@@ -273,15 +1023,87 @@ def parse_args(cmdl):
         help="Number of cores to use", default=2, type=int)
     parser.add_argument('--retain-temp', action='store_true', default=False,
         help="Retain temporary files? Default: False")
+    parser.add_argument('-t', '--tile-size', default=None, type=int,
+        help="Split chromosomes longer than this many bases into tiles that"
+        " are processed independently (numpy engine only). Default: None")
+    parser.add_argument('--io-threads', default=1, type=int,
+        help="Threads each task uses to decompress the BAM file (numpy"
+        " engine). Default: 1")
+    parser.add_argument('--checkpoint', default=None,
+        help="Keep per-task results in this folder and, if an earlier run"
+        " was interrupted, process only the tasks it did not finish. Removed"
+        " once the output is written, unless --retain-temp. Default: None")
+    parser.add_argument('--work-queue', default=None,
+        help="Coordinate the run through this folder on shared storage:"
+        " publish the tasks there, process them with -p local cores and any"
+        " workers started with --worker, then combine. Default: None")
+    parser.add_argument('--worker', action='store_true', default=False,
+        help="Only process tasks from --work-queue, with -p cores, and exit;"
+        " start with the same arguments as the coordinator, once it has"
+        " published its tasks. Default: False")
+    parser.add_argument('--metrics', action='store_true', default=False,
+        help="Record reads, phase timings, peak memory and bytes written for"
+        " each task in <outfile>_metrics.tsv, with a run summary in"
+        " <outfile>_metrics_summary.json. Default: False")
+    parser.add_argument('--profile', default=None,
+        help="Sample the call stacks of this process and its workers, and"
+        " write them to this file as collapsed stacks for a flame graph."
+        " Default: None")
+    parser.add_argument('--sparse', action='store_true', default=False,
+        help="Write only positions with signal, rather than a value for"
+        " every base including zeros. Default: False")
+    parser.add_argument('-n', '--normalize', default=None, choices=NORMALIZATIONS,
+        help="Also write tracks normalized to counts per million mapped reads"
+        " (cpm), to 1x genome coverage (rpgc) or to counts per million"
+        " spike-in reads (spikein), next to the raw ones. Default: None")
+    parser.add_argument('--spike-in', default=None, nargs="+",
+        help="Spike-in contigs; excluded from the cpm and rpgc totals and"
+        " used as the total for spikein. Default: None")
+    parser.add_argument('--genome-size', default=None, type=int,
+        help="Effective genome size for rpgc. Default: sum of chromosome sizes")
+    parser.add_argument('-f', '--fragment-bins', default=None, nargs="+",
+        type=fragment_bin, metavar="NAME:MIN-MAX",
+        help="Also write exact and smooth tracks restricted to fragments with"
+        " lengths in [MIN, MAX), one pair per bin, e.g. nfr:0-100"
+        " mono:180-247. Reads without a fragment length (unpaired, or with"
+        " the mate on another chromosome) are in no bin. Default: None")
+    parser.add_argument('--engine', default="numpy", choices=["numpy", "pipe"],
+        help="Count cuts in memory and write bigwigs with pyBigWig (numpy), "
+        "or stream them through sort, perl and wigToBigWig (pipe). "
+        "Default: numpy")
+    parser.add_argument('--store', default=None,
+        help="Also write the exact per-base cut counts to this directory as"
+        " memory-mapped arrays, for region queries with cutstore.CutStore"
+        " (numpy engine only). Default: None")
+    parser.add_argument('--store-dtype', default="uint16", choices=cutstore.DTYPES,
+        help="Integer type of the cut store; larger counts are clipped."
+        " Default: uint16")
+    parser.add_argument('--barcode-tag', default=None,
+        help="Also count cuts per barcode, taken from this read tag (e.g. CB),"
+        " over features, into a sparse matrix (numpy engine only)."
+        " Default: None")
+    parser.add_argument('--barcode-features', default=None,
+        help="BED file of features, such as peaks, to count barcode cuts"
+        " over. Default: fixed bins")
+    parser.add_argument('--barcode-bin-size', default=5000, type=int,
+        help="Size of the fixed bins used without --barcode-features."
+        " Default: 5000")
+    parser.add_argument('--barcode-out', default=None,
+        help="Prefix of the barcode matrix, features and barcodes files."
+        " Default: output file name without extension, plus '_barcode'")
 
     parser = add_logging_options(parser)
-    return parser.parse_args(cmdl)
+    args = parser.parse_args(cmdl)
+    if args.worker and not args.work_queue:
+        parser.error("--worker requires --work-queue")
+    return args
 
 
 if __name__ == "__main__":
 
     args = parse_args(sys.argv[1:])
     _LOGGER = logger_via_cli(args)
+    profiler.start(args.profile)
 
     if args.dnase:
         shift_factor = {"+":1, "-":0}  # DNase
@@ -301,13 +1123,43 @@ if __name__ == "__main__":
                     smoothbw=args.smoothbw,
                     smooth_length=args.smooth_length,
                     step_size=args.step_size,
-                    retain_temp=args.retain_temp)
+                    retain_temp=args.retain_temp,
+                    engine=args.engine,
+                    tile_size=args.tile_size,
+                    sparse=args.sparse,
+                    normalize=args.normalize,
+                    spike_in=args.spike_in,
+                    genome_size=args.genome_size,
+                    fragment_bins=args.fragment_bins,
+                    store=args.store,
+                    store_dtype=args.store_dtype,
+                    barcode_tag=args.barcode_tag,
+                    barcode_features=args.barcode_features,
+                    barcode_bin_size=args.barcode_bin_size,
+                    barcode_out=args.barcode_out,
+                    io_threads=args.io_threads,
+                    checkpoint=args.checkpoint,
+                    work_queue=args.work_queue,
+                    metrics=args.metrics)
 
     ct.register_files()
+    if args.worker:
+        try:
+            ct.work()
+        except ValueError as e:
+            # No run published yet, or another run's: nothing to take part in.
+            _LOGGER.error(str(e))
+            sys.exit(1)
+        profiler.finish(merge_parts=False)
+        sys.exit(0)
     good_chromosomes = ct.run()
     
     _LOGGER.info("Reduce step (merge files)...")
     ct.combine(good_chromosomes)
+    ct.write_metrics(os.path.splitext(ct.outfile)[0])
+    if not args.retain_temp:
+        ct.clear_checkpoint()
+    profiler.finish()
 
 
 
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# bamToFragments.py
+#
+# Function: Script takes as input a paired-end BAM file and writes, in one
+#           pass, a bgzipped and tabix-indexed file of Tn5-shifted fragments
+#           (chrom, start, end, MAPQ). Read it back with fragments.FragmentFile.
+#
+
+from argparse import ArgumentParser
+import sys
+
+import pararead
+from pararead import add_logging_options
+from pararead import logger_via_cli
+import pysam
+from tiling import TiledProcessor
+import profiler
+
+from fragments import fragment_from_read
+
+
+class FragmentWriter(TiledProcessor, pararead.ParaReadProcessor):
+    def __init__(self, reads_filename, n_proc, out_filename, verbosity,
+                 shift_factor={"+": 4, "-": -5}, tile_size=None,
+                 temp_parent="", limit=None, retain_temp=False):
+        """
+        Derive from ParaReadProcessor to build the fragment writer instance.
+
+        Parameters
+        ----------
+        reads_filename : str
+            Path to BAM file with aligned, paired sequencing reads.
+        n_proc : int
+            Number of cores to use for processing.
+        out_filename : str
+            Name of the bgzipped output file; ".gz" is added if missing.
+        shift_factor : dict
+            Shifts applied to "+" and "-" strand cut sites.
+        tile_size : int, default None
+            Split chromosomes longer than this into tiles processed as
+            separate tasks. Each tile writes the fragments that start in it.
+        """
+        if not out_filename.endswith(".gz"):
+            out_filename += ".gz"
+        super(FragmentWriter, self).__init__(reads_filename, n_proc,
+            out_filename, "fragments", temp_parent, limit,
+            allow_unaligned=False, retain_temp=retain_temp)
+        self.verbosity = verbosity
+        self.shift_factor = shift_factor
+        self.tile_size = tile_size
+
+    def register_files(self):
+        super(FragmentWriter, self).register_files()
+
+    def __call__(self, task):
+        """
+        Write the fragments that start in a task region to its temp file.
+
+        :param str task: chromosome, or region of one if tiling
+        :return str: the task, signaling success, or None if it held no
+            fragments
+        """
+        chrom, start, end = self.task_region(task)
+        _LOGGER.info("[Name: " + task + "; Size: " + str(end - start) + "]")
+        n = 0
+        # Reads come in start order, and each fragment starts a fixed
+        # distance from its leftmost mate, so the lines come out sorted.
+        with open(self._tempf(task), "w") as f:
+            for read in self.fetch_task(task):
+                fragment = fragment_from_read(read, self.shift_factor)
+                if fragment is None:
+                    continue
+                f.write("{}\t{}\t{}\t{}\n".format(chrom, *fragment))
+                n += 1
+        _LOGGER.debug("Wrote " + str(n) + " fragments for " + task)
+        return task if n else None
+
+    def combine(self, good_chromosomes):
+        """
+        Concatenate the task files in genomic order, then compress and index
+        the result.
+        """
+        if not good_chromosomes:
+            _LOGGER.warning("No fragments found, so no output written.")
+            return
+        _LOGGER.info("Merging {} files into output file: '{}'".
+                     format(len(good_chromosomes), self.outfile))
+        plain = self.outfile[:-len(".gz")]
+        with open(plain, "w") as out:
+            for task in good_chromosomes:
+                with open(self._tempf(task)) as f:
+                    for line in f:
+                        out.write(line)
+        # Compresses to self.outfile, removes the plain copy and writes the
+        # .tbi index next to it.
+        pysam.tabix_index(plain, preset="bed", force=True)
+
+
+def parse_args(cmdl):
+    parser = ArgumentParser(description='--Produce an indexed fragment file--')
+    parser.add_argument('-i', '--infile', dest='infile',
+                        help="Path to input file (in BAM format).",
+                        required=True)
+    parser.add_argument('-o', '--outfile', dest='outfile', required=True,
+                        help="Output file name (bgzipped; '.gz' is added if "
+                             "missing).")
+    parser.add_argument('-c', '--cores', dest='cores', default=20, type=int,
+                        help="Number of processors to use. Default=20")
+    parser.add_argument('-t', '--tile-size', dest='tile_size', default=None,
+                        type=int,
+                        help="Split chromosomes longer than this many bases "
+                             "into separately processed tiles. Default=None")
+    parser.add_argument('-e', '--temp-parent', default="",
+                        help="Temporary file location. Default: the working "
+                             "directory")
+    parser.add_argument('-m', '--limit', dest='limit', nargs="+", default=None,
+                        help="Limit to these chromosomes")
+    parser.add_argument("--dnase", action="store_true",
+                        help="Turn on DNase mode (this adjusts the shift "
+                             "parameters)")
+    parser.add_argument('--retain-temp', action='store_true', default=False,
+                        help="Retain temporary files? Default: False")
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help="Sample the call stacks of this process and its "
+                             "workers, and write them to this file as "
+                             "collapsed stacks for a flame graph. "
+                             "Default=None")
+
+    parser = add_logging_options(parser)
+    return parser.parse_args(cmdl)
+
+
+if __name__ == "__main__":
+
+    args = parse_args(sys.argv[1:])
+    _LOGGER = logger_via_cli(args)
+    profiler.start(args.profile)
+
+    if args.dnase:
+        shift_factor = {"+":1, "-":0}  # DNase
+    else:
+        shift_factor = {"+":4, "-":-5}  # ATAC
+
+    fw = FragmentWriter(reads_filename=args.infile,
+                        n_proc=args.cores,
+                        out_filename=args.outfile,
+                        verbosity=args.verbosity,
+                        shift_factor=shift_factor,
+                        tile_size=args.tile_size,
+                        temp_parent=args.temp_parent,
+                        limit=args.limit,
+                        retain_temp=args.retain_temp)
+
+    fw.register_files()
+    good_chromosomes = fw.run()
+
+    _LOGGER.info("Reduce step (merge files)...")
+    fw.combine(good_chromosomes)
+    profiler.finish()
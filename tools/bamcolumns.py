@@ -0,0 +1,311 @@
+#!/usr/bin/env python
+# bamcolumns.py
+#
+# Function: Read the fields the ATAC tools need (flag, position, reference
+#           end, template length, MAPQ, strand, mate position and read
+#           length) from a BAM region as batches of NumPy arrays, rather
+#           than as one pysam AlignedSegment per read. BGZF blocks can be
+#           inflated by several threads, and flag and MAPQ filters are
+#           applied before any per-read work is done.
+#
+# BAM records are decoded directly, using the .bai index to find where a
+# region starts. Files without a .bai index (e.g. CSI-indexed or SAM/CRAM)
+# are read through pysam instead, giving the same columns.
+#
+# Usage:
+#   from bamcolumns import BamColumns
+#   bam = BamColumns("sample.bam", threads=4)
+#   for batch in bam.fetch("chr1", min_mapq=30, exclude_flags=0x4):
+#       cuts = np.where(batch["is_reverse"], batch["end"] - 5,
+#                       batch["pos"] + 4)
+
+import os
+import struct
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import pysam
+
+COLUMNS = ["flag", "pos", "end", "tlen", "mapq", "is_reverse", "next_tid",
+           "next_pos", "qlen"]
+
+# CIGAR operations that consume the reference: M, D, N, = and X.
+_REF_OPS = np.array([1, 0, 1, 1, 0, 0, 0, 1, 1] + [0] * 7, dtype=bool)
+# Blocks inflated per round; each holds at most 64 KiB of records.
+BLOCKS_PER_ROUND = 64
+_BAI_WINDOW_SHIFT = 14
+_INT32 = struct.Struct("<i")
+
+
+def _read_bai(filename):
+    """
+    Linear index of a .bai file: for each reference, the smallest virtual
+    offset of the reads overlapping each 16 kb window.
+    """
+    with open(filename, "rb") as f:
+        data = f.read()
+    if data[:4] != b"BAI\1":
+        raise ValueError("Not a BAI index: '{}'".format(filename))
+    n_ref, = struct.unpack_from("<i", data, 4)
+    offset = 8
+    linear = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            n_chunk, = struct.unpack_from("<i", data, offset + 4)
+            offset += 8 + 16 * n_chunk
+        n_intv, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        linear.append(np.frombuffer(data, dtype="<u8", count=n_intv,
+                                    offset=offset))
+        offset += 8 * n_intv
+    return linear
+
+
+def _inflate(block):
+    # A BGZF block is a gzip member: an 18-byte header, raw deflate data,
+    # then CRC32 and the uncompressed size.
+    return zlib.decompress(block[18:-8], -15)
+
+
+class _BgzfReader(object):
+    """ Sequential reader of a BGZF file from a virtual offset. """
+    def __init__(self, filename, pool=None):
+        self.handle = open(filename, "rb")
+        self.pool = pool
+
+    def blocks(self, voffset=0):
+        """
+        Yield the uncompressed data from a virtual offset onwards, a few
+        dozen blocks at a time.
+        """
+        self.handle.seek(voffset >> 16)
+        skip = voffset & 0xFFFF
+        while True:
+            compressed = []
+            for _ in range(BLOCKS_PER_ROUND):
+                header = self.handle.read(18)
+                if len(header) < 18:
+                    break
+                bsize, = struct.unpack_from("<H", header, 16)
+                compressed.append(header + self.handle.read(bsize - 17))
+            if not compressed:
+                return
+            if self.pool is not None and len(compressed) > 1:
+                data = b"".join(self.pool.map(_inflate, compressed))
+            else:
+                data = b"".join(_inflate(b) for b in compressed)
+            if skip:
+                data, skip = data[skip:], 0
+            if data:
+                yield data
+
+    def close(self):
+        self.handle.close()
+
+
+def _gather(data, offsets, dtype):
+    """ Read one fixed-width field at each offset of a byte array. """
+    width = np.dtype(dtype).itemsize
+    return data[offsets[:, None] + np.arange(width)].view(dtype).ravel()
+
+
+class BamColumns(object):
+    """
+    Columnar, batched access to the reads of an indexed BAM file.
+    """
+    def __init__(self, filename, threads=1):
+        """
+        :param str filename: coordinate-sorted BAM file
+        :param int threads: threads used to inflate BGZF blocks
+        """
+        self.filename = filename
+        self.threads = threads
+        with pysam.AlignmentFile(filename) as bam:
+            self.references = list(bam.references)
+            self.lengths = list(bam.lengths)
+        index = filename + ".bai"
+        if not os.path.exists(index):
+            index = os.path.splitext(filename)[0] + ".bai"
+        self.linear_index = None
+        if filename.endswith(".bam") and os.path.exists(index):
+            self.linear_index = _read_bai(index)
+
+    def tid(self, chrom):
+        """ Numeric id of a reference, as used in next_tid. """
+        return self.references.index(chrom)
+
+    def fetch(self, chrom, start=None, end=None, min_mapq=0,
+              require_flags=0, exclude_flags=0):
+        """
+        Stream the reads overlapping a region, in coordinate order.
+
+        :param str chrom: reference name
+        :param int start: 0-based start; the reference start if unset
+        :param int end: exclusive end; the reference end if unset
+        :param int min_mapq: skip reads with a lower MAPQ
+        :param int require_flags: skip reads lacking any of these flag bits
+        :param int exclude_flags: skip reads with any of these flag bits
+        :return Iterable[dict]: batches mapping each of COLUMNS to an array;
+            pos and end are 0-based and end is exclusive
+        """
+        tid = self.tid(chrom)
+        start = start or 0
+        end = self.lengths[tid] if end is None else end
+        filters = (min_mapq, require_flags, exclude_flags)
+        if self.linear_index is None:
+            batches = self._fetch_pysam(chrom, start, end, filters)
+        else:
+            batches = self._fetch_native(tid, start, end, filters)
+        for batch in batches:
+            if len(batch["pos"]):
+                yield batch
+
+    def _fetch_native(self, tid, start, end, filters):
+        linear = self.linear_index[tid]
+        # Windows without reads may hold 0; any earlier window's offset is
+        # still a safe place to start, and before the first read, the
+        # first window with reads is.
+        nonzero = np.flatnonzero(linear)
+        if not len(nonzero):
+            return
+        before = nonzero[nonzero <= start >> _BAI_WINDOW_SHIFT]
+        voffset = int(linear[before[-1] if len(before) else nonzero[0]])
+        pool = ThreadPool(self.threads) if self.threads > 1 else None
+        reader = _BgzfReader(self.filename, pool)
+        try:
+            leftover = b""
+            for data in reader.blocks(voffset):
+                data = leftover + data
+                offsets = []
+                append, unpack = offsets.append, _INT32.unpack_from
+                offset, last = 0, len(data) - 4
+                # Records vary in length, so finding them is the one step
+                # done read by read.
+                while offset <= last:
+                    following = offset + 4 + unpack(data, offset)[0]
+                    if following > last + 4:
+                        break
+                    append(offset)
+                    offset = following
+                leftover = data[offset:]
+                if not offsets:
+                    continue
+                batch, done = _decode(np.frombuffer(data, dtype=np.uint8),
+                                      np.array(offsets, dtype=np.int64),
+                                      tid, start, end, filters)
+                if batch is not None:
+                    yield batch
+                if done:
+                    return
+        finally:
+            reader.close()
+            if pool is not None:
+                pool.close()
+
+    def _fetch_pysam(self, chrom, start, end, filters, batch_size=100000):
+        min_mapq, require_flags, exclude_flags = filters
+        bam = pysam.AlignmentFile(self.filename)
+        rows = []
+        for read in bam.fetch(chrom, start, end):
+            if read.mapping_quality < min_mapq or \
+                    read.flag & require_flags != require_flags or \
+                    read.flag & exclude_flags:
+                continue
+            rows.append((read.flag, read.reference_start,
+                         read.reference_end or read.reference_start,
+                         read.template_length, read.mapping_quality,
+                         read.is_reverse, read.next_reference_id,
+                         read.next_reference_start, read.query_length))
+            if len(rows) == batch_size:
+                yield _columns(rows)
+                rows = []
+        if rows:
+            yield _columns(rows)
+        bam.close()
+
+
+def _columns(rows):
+    values = list(zip(*rows))
+    batch = dict((name, np.array(values[i], dtype=np.int64))
+                 for i, name in enumerate(COLUMNS))
+    batch["is_reverse"] = batch["is_reverse"].astype(bool)
+    return batch
+
+
+def _passes(flag, mapq, min_mapq, require_flags, exclude_flags):
+    keep = np.ones(len(flag), dtype=bool)
+    if min_mapq:
+        keep &= mapq >= min_mapq
+    if require_flags:
+        keep &= (flag & require_flags) == require_flags
+    if exclude_flags:
+        keep &= (flag & exclude_flags) == 0
+    return keep
+
+
+def _decode(data, offsets, tid, start, end, filters):
+    """
+    Decode the records at the given offsets of an uncompressed block run.
+
+    :return (dict, bool): columns of the records overlapping the region
+        and passing the filters (None if there are none), and whether the
+        region has been passed
+    """
+    refid = _gather(data, offsets + 4, "<i4")
+    pos = _gather(data, offsets + 8, "<i4").astype(np.int64)
+    # Records are sorted, so the region ends at the first record on a later
+    # reference or at or past its end.
+    past = (refid != tid) | (pos >= end)
+    done = bool(past.any())
+    if done:
+        n = int(np.argmax(past))
+        offsets, pos = offsets[:n], pos[:n]
+    if not len(offsets):
+        return None, done
+    flag = _gather(data, offsets + 18, "<u2").astype(np.int64)
+    mapq = _gather(data, offsets + 13, "u1").astype(np.int64)
+    # Filter before the CIGARs are walked.
+    keep = _passes(flag, mapq, *filters)
+    if not keep.all():
+        offsets, pos, flag, mapq = (offsets[keep], pos[keep], flag[keep],
+                                    mapq[keep])
+    ref_end = _reference_end(data, offsets, pos)
+    # Like htslib, a read without aligned bases overlaps its position.
+    overlaps = np.maximum(ref_end, pos + 1) > start
+    if not overlaps.all():
+        offsets, pos, flag, mapq, ref_end = (
+            offsets[overlaps], pos[overlaps], flag[overlaps], mapq[overlaps],
+            ref_end[overlaps])
+    batch = {
+        "flag": flag,
+        "pos": pos,
+        "end": ref_end,
+        "tlen": _gather(data, offsets + 32, "<i4").astype(np.int64),
+        "mapq": mapq,
+        "is_reverse": (flag & 0x10) != 0,
+        "next_tid": _gather(data, offsets + 24, "<i4").astype(np.int64),
+        "next_pos": _gather(data, offsets + 28, "<i4").astype(np.int64),
+        "qlen": _gather(data, offsets + 20, "<i4").astype(np.int64),
+    }
+    return batch, done
+
+
+def _reference_end(data, offsets, pos):
+    """ Exclusive reference end of each record, from its CIGAR. """
+    n_ops = _gather(data, offsets + 16, "<u2").astype(np.int64)
+    name_length = _gather(data, offsets + 12, "u1").astype(np.int64)
+    cigar_start = offsets + 36 + name_length
+    total = int(n_ops.sum())
+    if not total:
+        return pos.copy()
+    record = np.repeat(np.arange(len(offsets)), n_ops)
+    first = np.cumsum(n_ops) - n_ops
+    op_offsets = np.repeat(cigar_start, n_ops) + \
+        4 * (np.arange(total) - np.repeat(first, n_ops))
+    ops = _gather(data, op_offsets, "<u4")
+    lengths = np.where(_REF_OPS[ops & 0xF], ops >> 4, 0)
+    return pos + np.bincount(record, weights=lengths,
+                             minlength=len(offsets)).astype(np.int64)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# barcodes.py
+#
+# Function: Per-barcode insertion counting over peaks or fixed genomic bins,
+#           for pooled and single-cell style libraries. bamSitesToWig.py
+#           counts each tile's cuts by (feature, barcode) in its workers and
+#           merges the tiles here into a sparse Matrix Market file, so memory
+#           follows the number of nonzero counts rather than features times
+#           barcodes.
+#
+# Outputs, for a prefix P:
+#   P_matrix.mtx    features x barcodes counts (Matrix Market, 1-based)
+#   P_features.bed  the features, in matrix row order
+#   P_barcodes.tsv  the barcodes, in matrix column order
+
+import os
+
+import numpy as np
+
+
+class FeatureSet(object):
+    """
+    The regions cuts are counted over: intervals from a BED file, or fixed
+    bins tiling every chromosome. Features are numbered in chromosome order,
+    then by start.
+    """
+    def __init__(self, chrom_sizes, bed_file=None, bin_size=None):
+        """
+        :param list[(str, int)] chrom_sizes: chromosome names and lengths
+        :param str bed_file: BED file of features, e.g. peaks; overlapping
+            features are allowed and each gets its own counts
+        :param int bin_size: length of fixed bins, used if bed_file is unset
+        :raise ValueError: if neither bed_file nor bin_size is given
+        """
+        if not bed_file and not bin_size:
+            raise ValueError("Features need a BED file or a bin size.")
+        intervals = dict((chrom, ([], [])) for chrom, _ in chrom_sizes)
+        if bed_file:
+            with open(bed_file) as f:
+                for line in f:
+                    fields = line.split("\t")
+                    if len(fields) < 3 or fields[0] not in intervals \
+                            or line.startswith(("#", "track", "browser")):
+                        continue
+                    intervals[fields[0]][0].append(int(fields[1]))
+                    intervals[fields[0]][1].append(int(fields[2]))
+        else:
+            for chrom, size in chrom_sizes:
+                starts = list(range(0, size, bin_size))
+                intervals[chrom] = (starts, [min(s + bin_size, size)
+                                             for s in starts])
+        self.chroms = {}
+        self.offsets = {}
+        self.max_length = 0
+        n = 0
+        for chrom, _ in chrom_sizes:
+            starts = np.array(intervals[chrom][0], dtype=np.int64)
+            ends = np.array(intervals[chrom][1], dtype=np.int64)
+            order = np.lexsort((ends, starts))
+            self.chroms[chrom] = (starts[order], ends[order])
+            self.offsets[chrom] = n
+            n += len(starts)
+            if len(starts):
+                self.max_length = max(self.max_length, int((ends - starts).max()))
+        self.n_features = n
+
+    def owned(self, chrom, start, end):
+        """
+        The features that start in a region, so that each feature is counted
+        by exactly one tile.
+
+        :param str chrom: chromosome name
+        :param int start: 0-based region start
+        :param int end: exclusive region end
+        :return (numpy.ndarray, numpy.ndarray, numpy.ndarray): global feature
+            ids, starts and ends
+        """
+        starts, ends = self.chroms[chrom]
+        lo, hi = np.searchsorted(starts, [start, end])
+        return (np.arange(lo, hi) + self.offsets[chrom],
+                starts[lo:hi], ends[lo:hi])
+
+    def write_bed(self, filename):
+        with open(filename, "w") as f:
+            for chrom in sorted(self.offsets, key=self.offsets.get):
+                starts, ends = self.chroms[chrom]
+                for s, e in zip(starts, ends):
+                    f.write("{}\t{}\t{}\n".format(chrom, s, e))
+
+
+def count_by_feature(cuts, codes, starts, ends):
+    """
+    Count cuts by feature and barcode.
+
+    :param numpy.ndarray cuts: 1-based cut positions
+    :param numpy.ndarray codes: barcode code of each cut; negative for cuts
+        without a barcode, which are ignored
+    :param numpy.ndarray starts: 0-based feature starts
+    :param numpy.ndarray ends: exclusive feature ends
+    :return (numpy.ndarray, numpy.ndarray, numpy.ndarray): feature index
+        (into starts), barcode code and count of each nonzero entry, sorted
+        by feature, then code
+    """
+    keep = codes >= 0
+    order = np.argsort(cuts[keep], kind="mergesort")
+    cuts, codes = cuts[keep][order], codes[keep][order]
+    # A cut at 1-based position p falls in [start, end) if start < p <= end.
+    lo = np.searchsorted(cuts, starts, side="right")
+    hi = np.searchsorted(cuts, ends, side="right")
+    lengths = hi - lo
+    total = int(lengths.sum())
+    if not total:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    features = np.repeat(np.arange(len(starts)), lengths)
+    first = np.cumsum(lengths) - lengths
+    index = np.arange(total) - np.repeat(first, lengths) + np.repeat(lo, lengths)
+    n_codes = int(codes.max()) + 1
+    keys, counts = np.unique(features * n_codes + codes[index],
+                             return_counts=True)
+    return keys // n_codes, keys % n_codes, counts
+
+
+def write_matrix(prefix, count_files, features):
+    """
+    Merge per-task count files into a sparse matrix, keeping only the
+    barcode index in memory.
+
+    :param str prefix: output prefix
+    :param list[str] count_files: per-task files of "feature, barcode,
+        count" lines, in genomic order
+    :param FeatureSet features: the features counted over
+    :return (int, int): number of barcodes and of nonzero entries
+    """
+    barcodes = {}
+    nnz = 0
+    body = prefix + "_matrix.mtx.tmp"
+    with open(body, "w") as out:
+        for count_file in count_files:
+            if not os.path.exists(count_file):
+                continue
+            with open(count_file) as f:
+                for line in f:
+                    feature, barcode, count = line.rstrip("\n").split("\t")
+                    column = barcodes.setdefault(barcode, len(barcodes)) + 1
+                    out.write("{} {} {}\n".format(int(feature) + 1, column,
+                                                  count))
+                    nnz += 1
+    with open(prefix + "_matrix.mtx", "w") as out:
+        out.write("%%MatrixMarket matrix coordinate integer general\n")
+        out.write("{} {} {}\n".format(features.n_features, len(barcodes), nnz))
+        with open(body) as f:
+            for line in f:
+                out.write(line)
+    os.remove(body)
+    with open(prefix + "_barcodes.tsv", "w") as f:
+        for barcode in sorted(barcodes, key=barcodes.get):
+            f.write(barcode + "\n")
+    features.write_bed(prefix + "_features.bed")
+    return len(barcodes), nnz
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# complexity.py
+#
+# Function: Library complexity curve from bamQC.py's duplicate histogram
+#           (how many distinct fragments were seen k times): the expected
+#           number of distinct fragments as sequencing depth changes, to
+#           judge whether a library is worth sequencing deeper.
+#
+# Up to the observed depth the curve is interpolated exactly, by
+# subsampling the histogram. Beyond it, fragment copy numbers are modeled
+# as a zero-truncated negative binomial fit to the histogram, which also
+# gives the estimated number of distinct molecules in the library.
+
+import math
+
+import numpy as np
+
+
+def _nb_zero(mu, r):
+    """ Probability that a fragment of mean copy number mu is never seen. """
+    return math.exp(r * (math.log(r) - math.log(r + mu)))
+
+
+def _fit_mean(mean, r):
+    """ Untruncated mean whose zero-truncated mean is the observed one. """
+    lo, hi = 1e-12, mean
+    for _ in range(200):
+        mid = (lo + hi) / 2
+        if mid / (1 - _nb_zero(mid, r)) < mean:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+def _log_likelihood(histogram, mu, r):
+    k = np.arange(len(histogram))[1:]
+    h = histogram[1:]
+    lgamma = np.vectorize(math.lgamma)
+    terms = (lgamma(k + r) - math.lgamma(r) - lgamma(k + 1) +
+             r * math.log(r / (r + mu)) + k * math.log(mu / (r + mu)))
+    return float((h * terms).sum() - h.sum() * math.log(1 - _nb_zero(mu, r)))
+
+
+def fit_ztnb(histogram):
+    """
+    Fit a zero-truncated negative binomial to a duplicate histogram.
+
+    :param Sequence[int] histogram: element k is the number of distinct
+        fragments seen k times
+    :return (float, float): mean copy number at the observed depth and the
+        size (dispersion) parameter, or None if nothing was seen more than
+        once, so that no saturation can be estimated
+    """
+    histogram = np.asarray(histogram, dtype=np.float64)
+    k = np.arange(len(histogram))
+    distinct = histogram[1:].sum()
+    if not distinct or not histogram[2:].any():
+        return None
+    mean = (k * histogram).sum() / distinct
+    # Golden section search for the size on a log scale; the mean follows
+    # from the size through the truncated mean.
+    def score(log_r):
+        r = math.exp(log_r)
+        return _log_likelihood(histogram, _fit_mean(mean, r), r)
+    a, b = -6.0, 8.0
+    g = (math.sqrt(5) - 1) / 2
+    c, d = b - g * (b - a), a + g * (b - a)
+    fc, fd = score(c), score(d)
+    for _ in range(60):
+        if fc > fd:
+            b, d, fd = d, c, fc
+            c = b - g * (b - a)
+            fc = score(c)
+        else:
+            a, c, fc = c, d, fd
+            d = a + g * (b - a)
+            fd = score(d)
+    r = math.exp((a + b) / 2)
+    return _fit_mean(mean, r), r
+
+
+def complexity_curve(histogram, max_fold=10, points=100):
+    """
+    Expected distinct fragments against sequencing depth.
+
+    :param Sequence[int] histogram: element k is the number of distinct
+        fragments seen k times
+    :param float max_fold: extrapolate to this multiple of the observed
+        depth
+    :param int points: number of depths in the curve
+    :return (numpy.ndarray, numpy.ndarray, float): depths (fragments
+        sequenced), expected distinct fragments at each, and the estimated
+        number of distinct molecules in the library (inf if the histogram
+        shows no saturation)
+    """
+    histogram = np.asarray(histogram, dtype=np.float64)
+    k = np.arange(len(histogram))
+    total = (k * histogram).sum()
+    distinct = histogram[1:].sum()
+    folds = np.linspace(0, max_fold, points + 1)[1:]
+    fit = fit_ztnb(histogram)
+    expected = np.empty(len(folds))
+    for i, t in enumerate(folds):
+        if t <= 1:
+            # Each copy of a fragment is kept with probability t.
+            expected[i] = (histogram * (1 - (1 - t) ** k)).sum()
+        elif fit is None:
+            expected[i] = t * distinct
+        else:
+            mu, r = fit
+            p0 = _nb_zero(mu, r)
+            expected[i] = distinct / (1 - p0) * (1 - _nb_zero(t * mu, r))
+    library = distinct / (1 - _nb_zero(*fit)) if fit else float("inf")
+    return folds * total, expected, library
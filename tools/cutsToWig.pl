@@ -23,12 +23,38 @@
 # It's also useful to pipe this to the ucsc tool for bigwig compression:
 # cat cuts.txt | cutsToWig.pl CHROMSIZE | wigToBigWig -clip stdin chrom_sizes.txt out.bw
 
+# If the first line is a variableStep header instead of fixedStep, the output
+# is sparse: one "position<TAB>count" line per cut site, with no 0s for the
+# bases in between.
+
 # Setup
 $chrSize = shift;  # Size of chromosome is the first argument
 $countIndex = 1;
 $currentCount = 1;
 $header =  <>; # Discard the first line (fixedstep)
 print $header;
+
+if ($header =~ /^variableStep/) {
+	$previousCut = <>;
+	exit unless defined $previousCut;
+	chomp($previousCut);
+	while($cutSite = <>) {
+		chomp($cutSite);
+		if ($cutSite == $previousCut) {
+			$currentCount++;
+			next;
+		}
+		if ($previousCut >= 1 && $previousCut <= $chrSize) {
+			print $previousCut."\t".$currentCount."\n";
+		}
+		$currentCount = 1;
+		$previousCut = $cutSite;
+	}
+	if ($previousCut >= 1 && $previousCut <= $chrSize) {
+		print $previousCut."\t".$currentCount."\n";
+	}
+	exit;
+}
 $cutSite = <>;  # Grab the first cut
 
 # Print out 0s until the first cut
@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+# cutstore.py
+#
+# Function: A per-base store of insertion (cut) counts: one memory-mapped
+#           array per chromosome plus a small JSON index. bamSitesToWig.py
+#           writes it with --store; TSS enrichment, FRiP, peak coverage and
+#           notebooks can then answer region queries by slicing arrays
+#           instead of seeking through the BAM.
+#
+# Layout: <store>/index.json and <store>/<chrom>.cuts, where position i of a
+#         chromosome's array holds the cuts at 0-based base i.
+#
+# Usage:
+#   from cutstore import CutStore
+#   store = CutStore("sample_cuts")
+#   store.counts("chr1", 10000, 10100)            # per-base counts
+#   store.sums(chroms, starts, ends)              # one total per region
+#   store.profiles(chroms, centers, 2000, strands)  # regions x 4000 matrix
+
+import json
+import os
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+STORE_VERSION = 1
+DTYPES = ["uint8", "uint16", "uint32"]
+
+
+def _chrom_file(chrom):
+    return chrom.replace(os.sep, "_") + ".cuts"
+
+
+def create_store(path, chrom_sizes, dtype="uint16", meta=None):
+    """
+    Lay out an empty store: a zero-filled array per chromosome and the index.
+
+    The arrays are created as sparse files, so chromosomes, or stretches of
+    them, without cuts take little space on disk.
+
+    :param str path: directory for the store; created if needed
+    :param Iterable[(str, int)] chrom_sizes: chromosome names and lengths
+    :param str dtype: count type, one of DTYPES; larger counts are clipped
+    :param dict meta: extra information to keep in the index, such as the
+        shift factor used
+    """
+    if dtype not in DTYPES:
+        raise ValueError("Unsupported store dtype: '{}'".format(dtype))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    chroms = {}
+    for chrom, size in chrom_sizes:
+        filename = _chrom_file(chrom)
+        with open(os.path.join(path, filename), "wb") as f:
+            f.truncate(size * np.dtype(dtype).itemsize)
+        chroms[chrom] = {"file": filename, "length": size}
+    index = {"version": STORE_VERSION, "dtype": dtype, "chroms": chroms,
+             "meta": meta or {}}
+    with open(os.path.join(path, INDEX_FILE), "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+
+
+def write_counts(path, chrom, positions, counts):
+    """
+    Record cut counts for part of a chromosome.
+
+    Different processes may write disjoint parts of the same chromosome at
+    the same time.
+
+    :param str path: store directory, laid out by create_store
+    :param str chrom: chromosome name
+    :param numpy.ndarray positions: 1-based positions with cuts
+    :param numpy.ndarray counts: number of cuts at each of those positions
+    :return int: number of positions whose count had to be clipped
+    """
+    store = CutStore(path)
+    arr = store._open(chrom, "r+")
+    limit = np.iinfo(arr.dtype).max
+    clipped = int(np.count_nonzero(counts > limit))
+    arr[np.asarray(positions, dtype=np.int64) - 1] = np.minimum(counts, limit)
+    arr.flush()
+    del arr
+    return clipped
+
+
+class CutStore(object):
+    """
+    Read-only access to a cut count store.
+
+    Coordinates are 0-based and half-open, as in BED files. Arrays are
+    memory-mapped, so only the parts touched by a query are read from disk.
+    """
+    def __init__(self, path):
+        """
+        :param str path: store directory
+        :raise IOError: if the directory holds no store index
+        :raise ValueError: if the store was written by an unknown version
+        """
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE)) as f:
+            self.index = json.load(f)
+        if self.index.get("version") != STORE_VERSION:
+            raise ValueError("Unsupported cut store version: {}".
+                             format(self.index.get("version")))
+        self.dtype = np.dtype(self.index["dtype"])
+        self._arrays = {}
+
+    @property
+    def chroms(self):
+        """ Chromosome lengths, by name. """
+        return dict((c, v["length"]) for c, v in self.index["chroms"].items())
+
+    @property
+    def meta(self):
+        return self.index.get("meta", {})
+
+    def _open(self, chrom, mode="r"):
+        entry = self.index["chroms"][chrom]
+        return np.memmap(os.path.join(self.path, entry["file"]),
+                         dtype=self.dtype, mode=mode,
+                         shape=(entry["length"],))
+
+    def chrom_counts(self, chrom):
+        """
+        :param str chrom: chromosome name
+        :return numpy.memmap: per-base counts over the whole chromosome
+        """
+        if chrom not in self._arrays:
+            self._arrays[chrom] = self._open(chrom)
+        return self._arrays[chrom]
+
+    def counts(self, chrom, start=0, end=None):
+        """
+        Per-base counts over one region.
+
+        :param str chrom: chromosome name
+        :param int start: 0-based start
+        :param int end: exclusive end; the chromosome end by default
+        :return numpy.ndarray: counts, as a view on the store
+        """
+        return self.chrom_counts(chrom)[start:end]
+
+    def sums(self, chroms, starts, ends):
+        """
+        Total cuts in each of many regions.
+
+        Regions on chromosomes the store does not know sum to 0.
+
+        :param Sequence[str] chroms: chromosome of each region
+        :param Sequence[int] starts: 0-based starts
+        :param Sequence[int] ends: exclusive ends
+        :return numpy.ndarray: one total per region, in input order
+        """
+        chroms = np.asarray(chroms)
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        totals = np.zeros(len(chroms), dtype=np.int64)
+        known = self.index["chroms"]
+        for chrom in np.unique(chroms):
+            if chrom not in known:
+                continue
+            arr = self.chrom_counts(chrom)
+            which = np.flatnonzero(chroms == chrom)
+            lo = np.clip(starts[which], 0, len(arr))
+            hi = np.clip(ends[which], lo, len(arr))
+            # One running total over the bases the regions span, so that
+            # every region is a difference of two of its entries.
+            first, last = int(lo.min()), int(hi.max())
+            cumulative = np.zeros(last - first + 1, dtype=np.int64)
+            np.cumsum(arr[first:last], dtype=np.int64, out=cumulative[1:])
+            totals[which] = cumulative[hi - first] - cumulative[lo - first]
+        return totals
+
+    def profiles(self, chroms, centers, flank, strands=None):
+        """
+        Per-base counts in equal-width windows around many sites.
+
+        Windows run from center - flank to center + flank. Parts of a window
+        past a chromosome end, or on an unknown chromosome, count 0. Windows
+        on the '-' strand are reversed, so every row reads 5' to 3'.
+
+        :param Sequence[str] chroms: chromosome of each site
+        :param Sequence[int] centers: 0-based site positions
+        :param int flank: bases on either side of each site
+        :param Sequence[str] strands: '+' or '-' for each site; all '+' by
+            default
+        :return numpy.ndarray: sites x (2 * flank) matrix of counts
+        """
+        chroms = np.asarray(chroms)
+        centers = np.asarray(centers, dtype=np.int64)
+        width = 2 * flank
+        mat = np.zeros((len(chroms), width), dtype=np.int64)
+        known = self.index["chroms"]
+        for chrom in np.unique(chroms):
+            if chrom not in known:
+                continue
+            arr = self.chrom_counts(chrom)
+            for i in np.flatnonzero(chroms == chrom):
+                lo = centers[i] - flank
+                hi = lo + width
+                window = arr[max(lo, 0):max(min(hi, len(arr)), 0)]
+                offset = max(lo, 0) - lo
+                mat[i, offset:offset + len(window)] = window
+        if strands is not None:
+            minus = np.asarray(strands) == "-"
+            mat[minus] = mat[minus, ::-1]
+        return mat
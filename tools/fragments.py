@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# fragments.py
+#
+# Function: The compact fragment file written once per sample by
+#           bamToFragments.py, and a reader that streams its fragments as
+#           NumPy columns, so downstream tools need not decode the BAM again.
+#
+# Format: bgzip-compressed, tabix-indexed BED with one line per properly
+#         paired fragment: chrom, start, end, MAPQ. Start and end are 0-based,
+#         half-open and already Tn5-shifted, so the two cut sites of a
+#         fragment are at 1-based positions start + 1 and end, the same
+#         positions bamSitesToWig.py counts.
+#
+# Usage:
+#   from fragments import FragmentFile
+#   frags = FragmentFile("sample_fragments.tsv.gz")
+#   for chunk in frags.fetch("chr1"):
+#       lengths = chunk["end"] - chunk["start"]
+
+import numpy as np
+import pysam
+
+COLUMNS = ["start", "end", "mapq"]
+
+
+def fragment_from_read(read, shift_factor):
+    """
+    Derive the shifted fragment of a read pair from its leftmost mate.
+
+    Only the mate with a positive template length yields a fragment, so each
+    pair is reported once, by the read that starts first. The MAPQ is the
+    lower of the two mates' when the MQ tag records the mate's.
+
+    :param pysam.AlignedSegment read: aligned read
+    :param dict shift_factor: shifts for the "+" and "-" strand cut sites
+    :return (int, int, int): 0-based start, end and MAPQ, or None if the
+        read does not start a usable fragment
+    """
+    if not read.is_proper_pair or read.is_unmapped or read.mate_is_unmapped \
+            or read.template_length <= 0 \
+            or read.next_reference_id != read.reference_id:
+        return None
+    start = read.reference_start + shift_factor["+"] - 1
+    end = read.reference_start + read.template_length + shift_factor["-"]
+    if end <= start:
+        return None
+    mapq = read.mapping_quality
+    if read.has_tag("MQ"):
+        mapq = min(mapq, read.get_tag("MQ"))
+    return start, end, mapq
+
+
+def _parse(chrom, lines):
+    skip = len(chrom) + 1
+    values = np.array([line[skip:].split("\t") for line in lines],
+                      dtype=np.int64).reshape(-1, len(COLUMNS))
+    return dict((name, values[:, i]) for i, name in enumerate(COLUMNS))
+
+
+class FragmentFile(object):
+    """
+    Reader for a fragment file written by bamToFragments.py.
+    """
+    def __init__(self, filename):
+        """
+        :param str filename: bgzipped fragment file, with its .tbi index
+        """
+        self.filename = filename
+        self.tabix = pysam.TabixFile(filename)
+
+    @property
+    def chroms(self):
+        """ Chromosomes with at least one fragment. """
+        return list(self.tabix.contigs)
+
+    def fetch(self, chrom, start=None, end=None, chunk_size=1000000):
+        """
+        Stream the fragments overlapping a region in chunks of columns.
+
+        :param str chrom: chromosome name
+        :param int start: 0-based region start; the whole chromosome if unset
+        :param int end: exclusive region end
+        :param int chunk_size: maximum number of fragments per chunk
+        :return Iterable[dict]: chunks mapping "start", "end" and "mapq" to
+            int64 arrays, in coordinate order
+        """
+        if chrom not in self.tabix.contigs:
+            return
+        lines = []
+        for line in self.tabix.fetch(chrom, start, end):
+            lines.append(line)
+            if len(lines) == chunk_size:
+                yield _parse(chrom, lines)
+                lines = []
+        if lines:
+            yield _parse(chrom, lines)
+
+    def read(self, chrom, start=None, end=None):
+        """
+        Load the fragments overlapping a region at once.
+
+        :param str chrom: chromosome name
+        :param int start: 0-based region start; the whole chromosome if unset
+        :param int end: exclusive region end
+        :return dict: "start", "end" and "mapq" int64 arrays
+        """
+        chunks = list(self.fetch(chrom, start, end))
+        if not chunks:
+            return dict((name, np.zeros(0, dtype=np.int64)) for name in COLUMNS)
+        return dict((name, np.concatenate([c[name] for c in chunks]))
+                    for name in COLUMNS)
+
+    def close(self):
+        self.tabix.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# metrics.py
+#
+# Function: Per-task instrumentation for the TiledProcessor tools
+#           (bamSitesToWig.py, bamQC.py): reads processed, time in each
+#           phase of the work, peak memory and bytes written, saved by each
+#           worker next to its temporary files and merged by the parent into
+#           a per-task table and a run summary.
+#
+# A task's bytes written are those of the files it leaves itself; the
+# summary adds the sizes of the final outputs, which for bamSitesToWig's
+# numpy engine only the parent writes.
+#
+# Peak memory is per task on Linux, where a process's high-water mark can be
+# reset; elsewhere it is the peak of the worker process so far.
+
+from contextlib import contextmanager
+import json
+import os
+import resource
+import sys
+import time
+
+
+def reset_peak_rss():
+    """
+    Restart the current process's peak resident set size, where the system
+    allows it.
+
+    :return bool: whether it was reset
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def peak_rss():
+    """
+    :return int: peak resident set size of the current process, in bytes
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in kilobytes, except on macOS.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class TaskMetrics(object):
+    """
+    Timings and counts for one task.
+    """
+    def __init__(self, task):
+        """
+        :param str task: task key
+        """
+        self.task = task
+        self.phases = {}
+        self.counts = {"reads": 0}
+        self.order = []
+        reset_peak_rss()
+        self.started = time.time()
+
+    def add(self, name, seconds):
+        """ Add time to a phase. """
+        if name not in self.phases:
+            self.phases[name] = 0.0
+            self.order.append(name)
+        self.phases[name] += seconds
+
+    @contextmanager
+    def phase(self, name):
+        """ Time the enclosed block as part of a phase. """
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, time.time() - started)
+
+    def seconds(self, name):
+        """ Time spent in a phase so far. """
+        return self.phases.get(name, 0.0)
+
+    def timed(self, name, iterable):
+        """
+        Iterate, timing only the production of each item as a phase, e.g.
+        decoding reads but not what is done with them.
+        """
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(name, time.time() - started)
+                return
+            self.add(name, time.time() - started)
+            yield item
+
+    def count(self, name, n=1):
+        """ Add to a counter, such as reads. """
+        self.counts[name] = self.counts.get(name, 0) + int(n)
+
+    def finish(self, files=()):
+        """
+        Close the record of the task.
+
+        :param Iterable[str] files: files the task wrote, to count their bytes
+        :return dict: the task's metrics
+        """
+        seconds = time.time() - self.started
+        written = [os.path.getsize(f) for f in files if os.path.isfile(f)]
+        counts = dict(self.counts)
+        # Tasks that hand their results to the parent, such as those of
+        # bamSitesToWig's numpy engine, may write no files of their own.
+        if written:
+            counts["bytes_written"] = sum(written)
+        return {"task": self.task, "seconds": seconds,
+                "reads_per_second": counts["reads"] / seconds if seconds else 0.0,
+                "peak_rss": peak_rss(), "counts": counts,
+                "phases": [[name, self.phases[name]] for name in self.order]}
+
+
+class NullMetrics(object):
+    """ Stands in for TaskMetrics when nothing is being measured. """
+    def add(self, name, seconds):
+        pass
+
+    @contextmanager
+    def phase(self, name):
+        yield
+
+    def seconds(self, name):
+        return 0.0
+
+    def timed(self, name, iterable):
+        return iterable
+
+    def count(self, name, n=1):
+        pass
+
+
+def save_metrics(filename, record):
+    with open(filename, "w") as f:
+        json.dump(record, f)
+
+
+def load_metrics(filename):
+    """
+    :return dict: a record written by save_metrics, or None if there is none
+    """
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def write_metrics(prefix, records, summary):
+    """
+    Write the per-task table and the run summary.
+
+    :param str prefix: output path prefix; writes prefix + '_metrics.tsv'
+        and prefix + '_metrics_summary.json'
+    :param list[dict] records: task metrics, as from TaskMetrics.finish,
+        with any parent-side phases added
+    :param dict summary: run-level values (wall time, cores, ...), to which
+        totals over the tasks are added; bytes_written also counts the
+        output_bytes it lists by file
+    :return (str, str): the table and summary file names
+    """
+    phases, counts = [], []
+    for record in records:
+        for name, _ in record["phases"]:
+            if name not in phases:
+                phases.append(name)
+        for name in sorted(record["counts"]):
+            if name not in counts:
+                counts.append(name)
+    table = prefix + "_metrics.tsv"
+    with open(table, "w") as f:
+        f.write("\t".join(["task", "seconds", "reads_per_second",
+                           "peak_rss_mb"] + counts +
+                          ["phase_" + p for p in phases]) + "\n")
+        for record in records:
+            times = dict(record["phases"])
+            f.write("\t".join(
+                [record["task"], "{:.3f}".format(record["seconds"]),
+                 "{:.1f}".format(record["reads_per_second"]),
+                 "{:.1f}".format(record["peak_rss"] / 1e6)] +
+                [str(record["counts"].get(c, 0)) for c in counts] +
+                ["{:.3f}".format(times.get(p, 0.0)) for p in phases]) + "\n")
+
+    summary = dict(summary)
+    reads = sum(r["counts"]["reads"] for r in records)
+    summary.update({
+        "tasks": len(records),
+        "reads": reads,
+        "task_seconds": sum(r["seconds"] for r in records),
+        "reads_per_second": reads / summary["run_seconds"]
+            if summary.get("run_seconds") else 0.0,
+        "peak_rss_mb": max([r["peak_rss"] for r in records] or [0]) / 1e6,
+        "bytes_written": sum(r["counts"].get("bytes_written", 0)
+                             for r in records) +
+            sum(summary.get("output_bytes", {}).values()),
+        "phases": dict((p, sum(dict(r["phases"]).get(p, 0.0)
+                               for r in records)) for p in phases),
+        "slowest_tasks": [[r["task"], r["seconds"], r["counts"]["reads"]]
+                          for r in sorted(records, key=lambda r: r["seconds"],
+                                          reverse=True)[:5]],
+    })
+    summary_file = prefix + "_metrics_summary.json"
+    with open(summary_file, "w") as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    return table, summary_file
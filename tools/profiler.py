@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# profiler.py
+#
+# Function: A low-overhead sampling profiler for the PEPATAC Python tools.
+#           A background thread records the main thread's call stack every
+#           few milliseconds, in the parent and in each forked worker; the
+#           parent merges every process's samples into one file of
+#           collapsed stacks ("frame;frame;frame count" lines), the input
+#           of flamegraph.pl, speedscope and similar viewers.
+#
+# Usage, in a tool:
+#   profiler.start(args.profile)           # in the parent, if requested
+#   pool.map(profiler.profiled(work), ...) # workers sample themselves
+#   profiler.finish()                      # merge, at the very end
+#
+# Workers started with fork inherit the profile path and start their own
+# sampler on their first task. They save their samples after every task,
+# because pool workers exit without running exit handlers. Stacks are
+# rooted at "main" for the parent and at "worker" for the workers.
+
+import glob
+import os
+import socket
+import sys
+import threading
+
+DEFAULT_INTERVAL = 0.005
+
+_STATE = {"path": None, "interval": DEFAULT_INTERVAL, "sampler": None}
+
+
+def frame_label(frame):
+    """ Name a stack frame as 'file.py:function'. """
+    code = frame.f_code
+    return "{}:{}".format(os.path.basename(code.co_filename), code.co_name)
+
+
+class StackSampler(threading.Thread):
+    """
+    Thread that counts the distinct call stacks of another thread.
+    """
+    def __init__(self, role, interval=DEFAULT_INTERVAL, target=None):
+        """
+        :param str role: root frame of every stack, e.g. 'main' or 'worker'
+        :param float interval: seconds between samples
+        :param int target: ident of the thread to sample; the calling
+            thread's, if unset
+        """
+        super(StackSampler, self).__init__(name="StackSampler")
+        self.daemon = True
+        self.role = role
+        self.interval = interval
+        self.target = target or threading.current_thread().ident
+        self.pid = os.getpid()
+        self.counts = {}
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame))
+                frame = frame.f_back
+            key = ";".join([self.role] + stack[::-1])
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+    def save(self, filename):
+        """ Write the stacks counted so far, in collapsed format. """
+        counts = dict(self.counts)
+        with open(filename, "w") as f:
+            for stack in sorted(counts):
+                f.write("{} {}\n".format(stack, counts[stack]))
+
+
+def _part_file():
+    return "{}.{}.{}.part".format(_STATE["path"], socket.gethostname(),
+                                  os.getpid())
+
+
+def _start_sampler(role):
+    sampler = StackSampler(role, _STATE["interval"])
+    sampler.start()
+    _STATE["sampler"] = sampler
+
+
+def start(path, interval=DEFAULT_INTERVAL):
+    """
+    Start profiling this process, and any workers forked from it.
+
+    :param str path: collapsed-stack file to write at finish(); a false
+        value leaves profiling off
+    :param float interval: seconds between samples
+    """
+    if not path:
+        return
+    _STATE["path"] = path
+    _STATE["interval"] = interval
+    _start_sampler("main")
+
+
+def worker():
+    """
+    In a worker, start sampling if the parent is profiling and this process
+    isn't sampled yet.
+    """
+    sampler = _STATE["sampler"]
+    if _STATE["path"] and (sampler is None or sampler.pid != os.getpid()):
+        _start_sampler("worker")
+
+
+def dump():
+    """ Save this process's samples so far, for finish() to merge. """
+    sampler = _STATE["sampler"]
+    if sampler is not None and sampler.pid == os.getpid():
+        sampler.save(_part_file())
+
+
+class profiled(object):
+    """
+    Wrap a function run by pool workers so that each worker is sampled.
+    The function must be picklable, e.g. defined at module level.
+    """
+    def __init__(self, func):
+        self.func = func
+
+    def __call__(self, *args):
+        worker()
+        try:
+            return self.func(*args)
+        finally:
+            dump()
+
+
+def merge(path, parts):
+    """
+    Sum collapsed-stack files.
+
+    :param str path: merged file to write
+    :param Iterable[str] parts: files to merge
+    :return int: number of samples
+    """
+    counts = {}
+    for part in parts:
+        with open(part) as f:
+            for line in f:
+                stack, _, n = line.rstrip("\n").rpartition(" ")
+                if stack:
+                    counts[stack] = counts.get(stack, 0) + int(n)
+    with open(path, "w") as f:
+        for stack in sorted(counts):
+            f.write("{} {}\n".format(stack, counts[stack]))
+    return sum(counts.values())
+
+
+def finish(merge_parts=True):
+    """
+    Stop profiling, and merge the samples of this process and its workers
+    into the profile file.
+
+    :param bool merge_parts: merge; otherwise only save this process's
+        samples, e.g. in a queue worker whose coordinator merges
+    :return str: the profile file, or None if not profiling
+    """
+    path = _STATE["path"]
+    if not path:
+        return None
+    sampler = _STATE["sampler"]
+    if sampler is not None and sampler.pid == os.getpid():
+        sampler.stop()
+        dump()
+    if not merge_parts:
+        return None
+    parts = glob.glob(glob.escape(path) + ".*.part") \
+        if hasattr(glob, "escape") else glob.glob(path + ".*.part")
+    merge(path, parts)
+    for part in parts:
+        os.remove(part)
+    _STATE["path"] = None
+    return path
@@ -4,29 +4,33 @@
 #
 # Last updated 6/22/17: Ryan Corces
 #
-# Dependencies: Script requires ATAC_Rscript_TSSenrichmentPlot_pyPiper.R to be in the same directory
-#				For pyPiper, these two scripts would be in the tools directory
+# Dependencies: --plot and --render require matplotlib
 #
 # Function: Script takes as input a BAM file and a bed file of single base positions and plots the enrichment of signal around those regions
 #			This enrichment is calculated as the cummulative insertions per base divided by the average number of insertions in the first 100 bases of the window
 #
 # Parameters: This version of the script expects a certain set or parameters in order to properly interface with ATAC_Rscript_TSSenrichmentPlot_pyPiper.R
 #			  Those parameters are: -p ends -e 2000 -u -v -s 4 -o <someFile.TssEnrichment>
+#
+# The matrix is counted by siteprofile.py, which reads the reads around all
+# sites in one pass and sums the workers' counts in shared memory. Positions
+# and fragment sizes can be binned (--position-bin, --size-bin), and with
+# --compact the matrix is saved as a compressed integer .npz with optional
+# coarser --zoom levels (see vplot.py). Plotting is a separate, optional
+# step: --plot renders the matrix just counted, and --render re-plots a
+# saved .npz without reading the BAM.
 
 
 ##### IMPORT MODULES #####
 # import necessary for python
 import os
 import sys
-import subprocess
 import numpy as np
-import pysam
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-from multiprocessing import Pool
 from optparse import OptionParser
-import random
+
+import profiler
+from siteprofile import read_sites, SiteProfile, MODES, ROWS, HALVES
+from vplot import save_vplot, load_vplot
 
 #### OPTIONS ####
 # read options from command line
@@ -44,139 +48,110 @@ opts.add_option("-u", action="store_true", default=False, help="Print uncompress
 opts.add_option("-v", action="store_true", default=False, help="Print profile around bed file")
 opts.add_option("-i", action="store_true", default=False, help="Print insert sizes across intervals")
 opts.add_option("--window",default='20',help="window size for ploting")
-options, arguments = opts.parse_args()
+opts.add_option("--position-bin",default="1",help="bases per position bin, default=1")
+opts.add_option("--size-bin",default="1",help="fragment sizes per size bin, default=1")
+opts.add_option("--compact", action="store_true", default=False, help="Save the matrix as a compressed integer .npz (see vplot.py)")
+opts.add_option("--zoom",default="",help="with --compact, comma-separated coarser levels to store too, each summing this many bins along both axes, e.g. 4,16")
+opts.add_option("--plot",default=None,help="render the result to this image file (.png or .pdf); needs matplotlib")
+opts.add_option("--render",default=None,help="render this .npz saved with --compact to --plot, instead of counting")
+opts.add_option("--profile",default=None,help="write sampled call stacks of this process and its workers to this file, for a flame graph")
+opts.add_option("--level",default="1",help="with --render, the stored zoom level to render, default=1")
 
-# return usage information if no argvs given
-if len(sys.argv)==1:
-    os.system(sys.argv[0]+" --help")
-    sys.exit()
 
 ##### DEFINE FUNCTIONS #####
-# assign mat
-def asn_mat(val,mat,s_int,e_int,t,i,weight):
-    if float(val)>=s_int and float(val)<e_int-1 and t<rows:  # -1 correct?
-        base = val-s_int
-        if len(p1_ints[0]) == 3:
-            mat[t][base] += weight
-        elif p1_ints[i][int(options.s)-1] == "-":
-            mat[t][len(mat[0])-base-1] += weight	
-        else:
-            mat[t][base] += weight
-    return mat
-
-#compute Vplot Matrix for a particular chunk
-def sub_Mat(start):
-    # initialize data matrix
-    mat = np.zeros([rows,cols])
-    # loop through the intervals and get relevent info
-    bamfile = pysam.Samfile(options.a, "rb")
-    end=min(start+chunksize,len(p1_ints))
-    for i in range(start,end):
-        # get interval as num
-        center = int(p1_ints[i][1])+(int(p1_ints[i][2])-int(p1_ints[i][1]))/2
-        s_int=center-int(options.e)
-        e_int=center+int(options.e)
-        # loop through rds
-        for p2_rds in bamfile.fetch(str(p1_ints[i][0]), max(0,s_int-2000), e_int+2000):
-            #check mapping quality
-            if p2_rds.mapq<30:# or p2_rds.is_proper_pair==False:
-                continue
-            # get read positions
-            if p2_rds.is_reverse:
-		continue
-            else:
-		l_pos = p2_rds.pos+4
-                # calculate center point
-		ilen = abs(p2_rds.tlen)-9
-                #ilen = 1
-		r_pos=l_pos+ilen
-		c_pos=l_pos+ilen/2
-		if ilen%2==1 and options.p=='center':
-			mat=asn_mat(c_pos,mat,s_int,e_int,ilen,i,0.5)
-			mat=asn_mat(c_pos+1,mat,s_int,e_int,ilen,i,0.5)
-		elif ilen%2!=1 and options.p=='center':
-			mat=asn_mat(c_pos,mat,s_int,e_int,ilen,i,1)
-		# save ends or read centers to v-plot
-		elif options.p == 'ends':
-			mat = asn_mat(l_pos,mat,s_int,e_int,ilen,i,1)
-			mat = asn_mat(r_pos,mat,s_int,e_int,ilen,i,1)
-		else:
-			sys.exit('Error, check parameters')
-    return mat
-
-##### INPUTS AND OUTPUTS #####
-# get intervals
-p1_ints = np.loadtxt(options.b,'str')
-
-##### SCRIPT #####
-# open and read BAM file
-#bamfile = pysam.Samfile(options.a, "rb")  # messes with file handle, add into func instead
-
-# determine number of rows and columns for matrix
-rows = 1000
-cols = int(options.e)*2
-#cols = int(p1_ints[0][2])-int(p1_ints[0][1])+int(options.e)*2
+def render(mat, extend, position_bin, size_bin, filename):
+    """ Plot a profile (-v), size distribution (-i) or V-plot to a file. """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig=plt.figure(figsize=(8.0, 5.0))
+    if options.v == True:
+        x = np.arange(len(mat))*position_bin-extend
+        #plt.plot(mat/np.median(mat[1:200]))
+        plt.plot(x,mat/np.mean(mat[1:200]),'k.')
+        plt.plot(x,np.convolve(mat,np.ones(int(options.window)),'same')/int(options.window)/np.mean(mat[1:200]),'r')
+        plt.xlabel('Position relative to center')
+        plt.ylabel('Insertions')
+    elif options.i == True:
+        x = np.arange(len(mat))*size_bin
+        plt.plot(x[x<990],mat[x<990])
+        plt.xlabel('Insert size (bp)')
+        plt.ylabel('Count')
+    else:
+        xran=min(500,extend)
+        yran=min(500,ROWS)
+        left=(extend-xran)//position_bin
+        right=-(-(extend+xran+1)//position_bin)
+        top=-(-yran//size_bin)
+        plt.imshow(mat[0:top,left:right],origin='lower',aspect='auto',extent=[left*position_bin-extend,right*position_bin-extend,1,top*size_bin+1])
+        plt.xlabel('Position relative to center')
+        plt.ylabel('Insert size')
+
+    # save figure
+    fig.savefig(filename)
+    plt.close(fig)
 
-# split bedfile into chunks
-maxi=len(p1_ints)
-chunksize=maxi/int(options.c)
-chunks=maxi/chunksize
-starts=range(0,maxi,chunksize)
 
-# parallel processed computation of matrix for each chunk
+##### SCRIPT #####
 if __name__ == "__main__":
-    pool = Pool(processes=int(options.c))
-    sub_mats=pool.map(sub_Mat, starts,1)
-
-# sum up matrices for each chunk into matrix for all
-mat = np.zeros([rows,cols])
-for i in range(len(starts)):
-    mat=mat+sub_mats[i]
-#asf
-# get column vector
-if options.v == True:
-    mat = np.sum(mat,0)
-if options.i == True:
-    mat = np.sum(mat,1)
-
-# save matrix
-if not options.o:
-    n1=os.path.basename(options.a)
-    n2=os.path.basename(options.b)
-    if options.v == True: options.o=n1+'.'+n2+'.vect'
-    elif options.i == True: options.o=n1+'.'+n2+'.iSize'
-    else: options.o=n1+'.'+n2+'.vplot'
-if options.u == True:
-    np.savetxt(options.o,mat,delimiter='\t',fmt='%s')
-else:
-    np.save(options.o,mat)
-
-# plot
-fig=plt.figure(figsize=(8.0, 5.0))
-xran=min(500,int(options.e))
-yran=min(500,rows)
-if options.v == True:
-    #plt.plot(mat/np.median(mat[1:200]))
-    plt.plot(mat/np.mean(mat[1:200]),'k.')
-    plt.plot(np.convolve(mat,np.ones(int(options.window)),'same')/int(options.window)/np.mean(mat[1:200]),'r')
-    plt.xlabel('Position relative to center')
-    plt.ylabel('Insertions')
-elif options.i == True:
-    plt.plot(mat[0:990])
-    plt.xlabel('Insert size (bp)')
-    plt.ylabel('Count')
-else:
-    plt.imshow(mat[0:yran,(int(options.e)-xran):(int(options.e)+xran+1)],origin='lower',aspect='equal',extent=[-xran,xran,1,yran+1])
-    plt.xlabel('Position relative to center')
-    plt.ylabel('Insert size')
-
-# save figure
-#fig.savefig(options.o+'.png')
-#fig.savefig(options.o+'.pdf', format='pdf')
-#plt.close(fig)
-
-#Call ATAC_Rscript_TSSenrichmentPlot_pyPiper.R to make TSS plot
-cmd = "Rscript "
-cmd += os.path.dirname(os.path.realpath(sys.argv[0])) + "/ATAC_Rscript_TSSenrichmentPlot_pyPiper.R"
-cmd += " --TSSfile " + options.o + " --outputType pdf"
-subprocess.call(cmd, shell=True)
\ No newline at end of file
+    options, arguments = opts.parse_args()
+
+    # return usage information if no argvs given
+    if len(sys.argv)==1:
+        os.system(sys.argv[0]+" --help")
+        sys.exit()
+    if options.p not in MODES:
+        sys.exit('Error, check parameters')
+    zoom_factors = [int(f) for f in options.zoom.split(",") if f]
+    if zoom_factors and not options.compact:
+        opts.error("--zoom requires --compact")
+    if (options.compact or options.render) and (options.v or options.i or options.u):
+        opts.error("--compact and --render work on the full matrix; drop -v, -i and -u")
+
+    # re-plot a saved matrix
+    if options.render:
+        if not options.plot:
+            opts.error("--render requires --plot")
+        mat, info = load_vplot(options.render, int(options.level))
+        render(mat, info["extend"], info["position_bin"], info["size_bin"],
+               options.plot)
+        sys.exit()
+
+    profiler.start(options.profile)
+
+    # number of rows (fragment sizes) of the matrix
+    rows = ROWS
+    position_bin = int(options.position_bin)
+    size_bin = int(options.size_bin)
+
+    # insertions summed over all sites: by position (-v), by fragment size
+    # (-i), or the matrix of fragment size (rows) by position (columns)
+    if options.v == True: summary = "positions"
+    elif options.i == True: summary = "sizes"
+    else: summary = "matrix"
+    sites = read_sites(options.b, int(options.s))
+    counts = SiteProfile(options.a, [sites], int(options.e), mode=options.p,
+                         summary=summary, position_bin=position_bin,
+                         size_bin=size_bin, cores=int(options.c)).count()[0]
+    mat = counts/float(HALVES)
+
+    # save matrix
+    if not options.o:
+        n1=os.path.basename(options.a)
+        n2=os.path.basename(options.b)
+        if options.v == True: options.o=n1+'.'+n2+'.vect'
+        elif options.i == True: options.o=n1+'.'+n2+'.iSize'
+        else: options.o=n1+'.'+n2+'.vplot'
+    if options.compact == True:
+        save_vplot(options.o, counts, HALVES, int(options.e), position_bin,
+                   size_bin, zoom_factors)
+    elif options.u == True:
+        np.savetxt(options.o,mat,delimiter='\t',fmt='%s')
+    else:
+        np.save(options.o,mat)
+
+    # plot
+    if options.plot:
+        render(mat, int(options.e), position_bin, size_bin, options.plot)
+    profiler.finish()
@@ -12,10 +12,15 @@
 #
 # Parameters: This version of the script expects a certain set or parameters in order to properly interface with ATAC_Rscript_TSSenrichmentPlot_pyPiper.R
 #			  Those parameters are: -p ends -e 2000 -u -v -s 4 -o <someFile.TssEnrichment>
+#
+# Sites are sorted per chromosome and the reads around them are read in one
+# pass (see siteprofile.py), rather than fetched again for every site.
+# Further named site sets (--sites CTCF=ctcf.bed) are profiled in the same
+# pass, each into its own output next to -o, and --scores writes the
+# enrichment score of every set.
 
 
 import os
-from multiprocessing import Pool
 from optparse import OptionParser
 import subprocess
 import sys
@@ -26,7 +31,9 @@ import sys
 #import matplotlib.pyplot as plt
 
 import numpy as np
-import pysam
+
+import profiler
+from siteprofile import read_sites, SiteProfile, MODES, enrichment_score
 
 
 #### OPTIONS ####
@@ -44,116 +51,79 @@ opts.add_option("-u", action="store_true", default=False, help="Print uncompress
 opts.add_option("-v", action="store_true", default=False, help="Print profile around bed file")
 opts.add_option("-i", action="store_true", default=False, help="Print insert sizes across intervals")
 opts.add_option("--window",default='20',help="window size for ploting")
-options, arguments = opts.parse_args()
+opts.add_option("--profile",default=None,help="write sampled call stacks of this process and its workers to this file, for a flame graph")
+opts.add_option("--name",default="TSS",help="name of the -b sites in the scores file, default=TSS")
+opts.add_option("--sites",action="append",default=[],metavar="NAME=BED",help="another named bed file of sites, profiled in the same pass; written to the -o file name with _NAME before its extension (may be repeated)")
+opts.add_option("--scores",default=None,help="with -v, write the enrichment score (mean insertions in the central 100 bases over the first 200 bases of the window) of each set of sites to this file")
 
-# return usage information if no argvs given
-if len(sys.argv)==1:
-    os.system(sys.argv[0]+" --help")
-    sys.exit()
 
 ##### DEFINE FUNCTIONS #####
-# assign mat
-def asn_mat(val,mat,s_int,e_int,t,i,weight):
-    if float(val)>=s_int and float(val)<e_int-1 and t<rows:  # -1 correct?
-        base = val-s_int
-        if len(p1_ints[0]) == 3:
-            mat[t][base] += weight
-        elif p1_ints[i][int(options.s)-1] == "-":
-            mat[t][len(mat[0])-base-1] += weight	
-        else:
-            mat[t][base] += weight
-    return mat
-
-#compute Vplot Matrix for a particular chunk
-def sub_Mat(start):
-    # initialize data matrix
-    mat = np.zeros([rows,cols])
-    # loop through the intervals and get relevent info
-    bamfile = pysam.Samfile(options.a, "rb")
-    end=min(start+chunksize,len(p1_ints))
-    for i in range(start,end):
-        # get interval as num
-        center = int(p1_ints[i][1])+(int(p1_ints[i][2])-int(p1_ints[i][1]))/2
-        s_int=center-int(options.e)
-        e_int=center+int(options.e)
-        # Loop over reads.
-        try:
-            p2_reads = bamfile.fetch(str(p1_ints[i][0]), max(0, s_int - 2000), e_int + 2000)
-        except ValueError:
-            # Could print speculation about cause, but that may get wordy.
-            # This is likely due to no reads for first argument to the fetch()
-            # call; that is, the current "reference" value.
-            continue
-        for p2_rds in p2_reads:
-            #check mapping quality
-            if p2_rds.mapq<30:# or p2_rds.is_proper_pair==False:
-                continue
-            # get read positions
-            if p2_rds.is_reverse:
-		continue
-            else:
-		l_pos = p2_rds.pos+4
-                # calculate center point
-		ilen = abs(p2_rds.tlen)-9
-                #ilen = 1
-		r_pos=l_pos+ilen
-		c_pos=l_pos+ilen/2
-		if ilen%2==1 and options.p=='center':
-			mat=asn_mat(c_pos,mat,s_int,e_int,ilen,i,0.5)
-			mat=asn_mat(c_pos+1,mat,s_int,e_int,ilen,i,0.5)
-		elif ilen%2!=1 and options.p=='center':
-			mat=asn_mat(c_pos,mat,s_int,e_int,ilen,i,1)
-		# save ends or read centers to v-plot
-		elif options.p == 'ends':
-			mat = asn_mat(l_pos,mat,s_int,e_int,ilen,i,1)
-			mat = asn_mat(r_pos,mat,s_int,e_int,ilen,i,1)
-		else:
-			sys.exit('Error, check parameters')
-    return mat
-
-##### INPUTS AND OUTPUTS #####
-# get intervals
-p1_ints = np.loadtxt(options.b,'str')
-
-##### SCRIPT #####
-
-# determine number of rows and columns for matrix
-rows = 1000
-cols = int(options.e)*2
+def output_name(name, bed):
+    """ Output file for a set of sites; the -b set writes to -o. """
+    if options.o:
+        if name == options.name and bed == options.b:
+            return options.o
+        root, ext = os.path.splitext(options.o)
+        return root+'_'+name+ext
+    n1=os.path.basename(options.a)
+    n2=os.path.basename(bed)
+    if options.v == True: return n1+'.'+n2+'.vect'
+    elif options.i == True: return n1+'.'+n2+'.iSize'
+    else: return n1+'.'+n2+'.vplot'
 
-# split bedfile into chunks
-maxi=len(p1_ints)
-chunksize=maxi/int(options.c)
-chunks=maxi/chunksize
-starts=range(0,maxi,chunksize)
 
-# parallel processed computation of matrix for each chunk
+##### SCRIPT #####
 if __name__ == "__main__":
-    pool = Pool(processes=int(options.c))
-    sub_mats=pool.map_async(sub_Mat, starts,1).get(9999999)
-
-# sum up matrices for each chunk into matrix for all
-mat = np.zeros([rows,cols])
-for i in range(len(starts)):
-    mat=mat+sub_mats[i]
-#asf
-# get column vector
-if options.v == True:
-    mat = np.sum(mat,0)
-if options.i == True:
-    mat = np.sum(mat,1)
-
-# save matrix
-if not options.o:
-    n1=os.path.basename(options.a)
-    n2=os.path.basename(options.b)
-    if options.v == True: options.o=n1+'.'+n2+'.vect'
-    elif options.i == True: options.o=n1+'.'+n2+'.iSize'
-    else: options.o=n1+'.'+n2+'.vplot'
-if options.u == True:
-    np.savetxt(options.o,mat,delimiter='\t',fmt='%s')
-else:
-    np.save(options.o,mat)
+    options, arguments = opts.parse_args()
+
+    # return usage information if no argvs given
+    if len(sys.argv)==1:
+        os.system(sys.argv[0]+" --help")
+        sys.exit()
+    if options.p not in MODES:
+        sys.exit('Error, check parameters')
+    if options.scores and not options.v:
+        opts.error("--scores requires -v")
+
+    # named sets of sites, -b first
+    site_sets = [(options.name, options.b)] if options.b else []
+    for spec in options.sites:
+        name, sep, bed = spec.partition("=")
+        if not sep or not name or not bed:
+            opts.error("--sites expects NAME=BED, got '{}'".format(spec))
+        site_sets.append((name, bed))
+    if not site_sets:
+        opts.error("give a bed file of sites with -b or --sites")
+    if len(set(name for name, _ in site_sets)) < len(site_sets):
+        opts.error("site set names must be unique")
+
+    profiler.start(options.profile)
+
+    # insertions summed over all sites: by position (-v), by fragment size
+    # (-i), or the matrix of fragment size (rows) by position (columns)
+    if options.v == True: summary = "positions"
+    elif options.i == True: summary = "sizes"
+    else: summary = "matrix"
+    sites = [read_sites(bed, int(options.s)) for _, bed in site_sets]
+    mats = SiteProfile(options.a, sites, int(options.e), mode=options.p,
+                       summary=summary, cores=int(options.c)).run()
+
+    # save matrix of each set
+    for (name, bed), mat in zip(site_sets, mats):
+        outfile = output_name(name, bed)
+        if options.u == True:
+            np.savetxt(outfile,mat,delimiter='\t',fmt='%s')
+        else:
+            np.save(outfile,mat)
+
+    # save enrichment scores, NA where there is no background
+    if options.scores:
+        with open(options.scores, "w") as f:
+            for (name, _), mat in zip(site_sets, mats):
+                score = enrichment_score(mat)
+                f.write("{}\t{}\n".format(
+                    name, "NA" if score is None else score))
+    profiler.finish()
 
 
 #UNUSED PLOTTING FEATURES BELOW
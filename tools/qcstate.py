@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+# qcstate.py
+#
+# Function: The mergeable state behind bamQC.py's NRF, PBC1 and PBC2: a
+#           fixed set of integer counters plus the duplicate histogram (how
+#           many distinct fragments were seen k times). States add up, so
+#           chromosomes, lanes or technical replicates can be combined
+#           without reading their BAMs again.
+#
+# File layout (little-endian): 8-byte magic "PEPATQC\0", uint32 version,
+# uint32 number of counters, int64 counters in FIELDS order, uint32
+# histogram length, int64 histogram; from version 2, uint32 number of
+# sketch registers (0 for exact states) and the uint8 registers.
+#
+# Merging is exact across chromosomes and tiles. Across lanes or
+# replicates it treats the parts' fragments as distinct, as a duplicate of
+# a fragment in another lane cannot be recognized without its reads. States
+# from bamQC.py --sketch-error instead carry a HyperLogLog sketch of the
+# duplicate keys, whose merge does recognize fragments shared by parts.
+#
+# A sketch only estimates how many distinct keys there are, not how many
+# were seen once or twice, so sketched reports give NA for NRF, PBC1, PBC2
+# and the one- and two-pair counts. They add Distinct_rate (estimated
+# distinct fragments / total), which is not NRF: NRF counts only the
+# fragments seen once. Duplicate_rate is the flagged duplicates / total in
+# both reports.
+
+import struct
+
+import numpy as np
+
+from sketch import HyperLogLog
+
+MAGIC = b"PEPATQC\0"
+VERSION = 2
+FIELDS = [
+    "num_reads",          # reads seen
+    "paired_reads",       # reads flagged as paired
+    "dups",               # reads flagged as duplicates
+    "unmap",              # unmapped reads
+    "unmap_mate",         # reads with an unmapped mate
+    "prop_pair",          # reads in a proper pair
+    "qcfail",             # reads failing QC
+    "mito_paired_reads",  # paired reads on the mitochondrial genome
+    "pe_paired_reads",    # paired reads in paired-end tasks
+    "se_reads",           # reads in single-end tasks
+    "dup_reads",          # keyed reads whose key was seen more than once
+    "M2",                 # positions whose duplicates hold exactly 2 reads
+]
+HEADER = ["Total_read_pairs", "Distinct_read_pairs", "One_read_pair",
+          "Two_read_pairs", "Duplicate_rate", "Mitochondria_reads",
+          "Mitochondria_rate", "NRF", "PBC1", "PBC2"]
+# Sketched reports add the estimated distinct fragments / total, and the
+# relative half-width of the 95% confidence interval of the distinct count
+# and Distinct_rate.
+SKETCH_HEADER = HEADER + ["Distinct_rate", "Confidence"]
+
+
+class QCState(object):
+    """
+    Counters and duplicate histogram for part of a library.
+    """
+    def __init__(self, counters=None, histogram=None, sketch=None):
+        """
+        :param dict counters: values for any of FIELDS; others are 0
+        :param Sequence[int] histogram: histogram[k] is the number of
+            distinct duplicate keys seen k times
+        :param sketch.HyperLogLog sketch: sketch of the duplicate keys, in
+            place of the histogram, for approximate metrics
+        """
+        self.counters = np.zeros(len(FIELDS), dtype=np.int64)
+        for name, value in (counters or {}).items():
+            self.counters[FIELDS.index(name)] = value
+        self.histogram = np.array(histogram if histogram is not None else [0],
+                                  dtype=np.int64)
+        self.sketch = sketch
+
+    def __getitem__(self, name):
+        return int(self.counters[FIELDS.index(name)])
+
+    def __add__(self, other):
+        """
+        Merge two states; the operation is associative and commutative.
+
+        :raise ValueError: if one state is sketched and the other has exact
+            duplicate counts
+        """
+        n = max(len(self.histogram), len(other.histogram))
+        histogram = np.zeros(n, dtype=np.int64)
+        histogram[:len(self.histogram)] += self.histogram
+        histogram[:len(other.histogram)] += other.histogram
+        if self.sketch is not None and other.sketch is not None:
+            sketch = self.sketch + other.sketch
+        else:
+            sketch = self.sketch if self.sketch is not None else other.sketch
+            if sketch is not None and histogram.any():
+                raise ValueError("Cannot merge exact and sketched QC states")
+        merged = QCState(histogram=histogram, sketch=sketch)
+        merged.counters = self.counters + other.counters
+        return merged
+
+    @property
+    def distinct(self):
+        """ Number of distinct duplicate keys (M_DISTINCT). """
+        return int(self.histogram.sum())
+
+    def save(self, filename):
+        with open(filename, "wb") as f:
+            f.write(MAGIC)
+            f.write(struct.pack("<II", VERSION, len(FIELDS)))
+            f.write(self.counters.astype("<i8").tobytes())
+            f.write(struct.pack("<I", len(self.histogram)))
+            f.write(self.histogram.astype("<i8").tobytes())
+            registers = self.sketch.registers if self.sketch is not None \
+                else np.zeros(0, dtype=np.uint8)
+            f.write(struct.pack("<I", len(registers)))
+            f.write(registers.tobytes())
+
+    @classmethod
+    def load(cls, filename):
+        """
+        :param str filename: file written by save()
+        :return QCState: the stored state
+        :raise ValueError: if the file is not a QC state of a known version
+        """
+        with open(filename, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("Not a QC state file: '{}'".format(filename))
+            version, n_fields = struct.unpack("<II", f.read(8))
+            if version not in (1, VERSION) or n_fields != len(FIELDS):
+                raise ValueError("Unsupported QC state version {} in '{}'".
+                                 format(version, filename))
+            state = cls()
+            state.counters = np.frombuffer(f.read(8 * n_fields),
+                                           dtype="<i8").astype(np.int64)
+            n_hist, = struct.unpack("<I", f.read(4))
+            state.histogram = np.frombuffer(f.read(8 * n_hist),
+                                            dtype="<i8").astype(np.int64)
+            if version > 1:
+                n_registers, = struct.unpack("<I", f.read(4))
+                if n_registers:
+                    state.sketch = HyperLogLog(registers=np.frombuffer(
+                        f.read(n_registers), dtype=np.uint8).copy())
+        return state
+
+    @classmethod
+    def merge(cls, states):
+        """
+        :param Iterable[QCState] states: states to merge
+        :return QCState: their sum
+        """
+        total = cls()
+        for state in states:
+            total = total + state
+        return total
+
+    def header(self):
+        """ Column names of the bamQC report for this state. """
+        return SKETCH_HEADER if self.sketch is not None else HEADER
+
+    def metrics(self):
+        """
+        Values of the bamQC report.
+
+        A sketched state cannot tell keys seen once or twice apart, so it
+        reports NA for those counts and for NRF, PBC1 and PBC2, and adds the
+        estimated distinct / total as Distinct_rate.
+
+        :return list: the report values, in header() order
+        """
+        num_pairs = self["paired_reads"] / 2.0
+        if num_pairs == 0:
+            total = max(1, float(self["num_reads"]))
+        else:
+            total = max(1, num_pairs)
+        M1 = (self["pe_paired_reads"] / 2.0 + self["se_reads"] -
+              self["dup_reads"])
+        M2 = max(1, float(self["M2"]))
+        mitoReads = self["mito_paired_reads"] / 2.0
+        if self.sketch is not None:
+            distinct = self.sketch.estimate()
+            return [total, distinct, "NA", "NA", float(self["dups"]) / total,
+                    mitoReads, mitoReads / total, "NA", "NA", "NA",
+                    distinct / total, 1.96 * self.sketch.error]
+        return [total, float(self.distinct), M1, M2,
+                float(self["dups"]) / total, mitoReads, mitoReads / total,
+                M1 / total, M1 / max(1, float(self.distinct)), M1 / M2]
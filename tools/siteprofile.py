@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+# siteprofile.py
+#
+# Function: Aggregate the Tn5 insertions around sets of sites (e.g. TSSs,
+#           CTCF motifs, enhancers) by position relative to the site, by
+#           fragment size, or as the full matrix of both (a V-plot), as
+#           pyTssEnrichment.py reports them. Any number of site sets are
+#           profiled in the same pass over the reads.
+#
+# The sites of all sets are sorted together per chromosome, and sites whose windows are near each
+# other form spans whose reads are read once, in coordinate order. Each
+# insertion is added to every window it falls in, found by binary search in
+# the sorted window starts; reading the reads of each site separately would
+# decode the reads of dense promoter clusters once per overlapping window.
+#
+# Only the requested summary is accumulated: a TSS enrichment profile is a
+# vector of 2 * extend integers, and the full rows x (2 * extend) matrix is
+# only built for V-plots. Counts are kept in half insertions, so that the
+# centers of odd-sized fragments, split between two bases, stay integers.
+# Positions and fragment sizes can be binned, which shrinks wide V-plots.
+#
+# Worker processes add their counts into their own slot of one shared-memory
+# array and return nothing, so no matrix is pickled back to the parent,
+# which sums the slots in place once all tasks are done.
+#
+# Usage:
+#   from siteprofile import read_sites, SiteProfile, enrichment_score
+#   profile = SiteProfile("sample.bam",
+#                         [read_sites("TSS.bed"), read_sites("CTCF.bed")],
+#                         extend=2000, mode="ends", summary="positions",
+#                         cores=8)
+#   tss_profile, ctcf_profile = profile.run()
+#   tss_score = enrichment_score(tss_profile)
+
+import ctypes
+from multiprocessing import Pool, RawArray, Value
+
+import numpy as np
+
+from bamcolumns import BamColumns
+import profiler
+
+# Fragment sizes counted; each is a row of the matrix.
+ROWS = 1000
+MIN_MAPQ = 30
+# Spans of sites are read separately when the reads they need are further
+# apart than this; closer ones are read together.
+SPAN_GAP = 100000
+MODES = ["center", "ends"]
+# Insertions by position, by fragment size, or by both.
+SUMMARIES = ["positions", "sizes", "matrix"]
+# Weights are counted in half insertions.
+HALVES = 2
+# Tasks per worker process, so that workers finishing early take more.
+TASKS_PER_CORE = 4
+# Bases around the site, and at the start of the window, compared by
+# enrichment_score().
+SCORE_CENTER = 100
+SCORE_BACKGROUND = 200
+
+# The shared-memory slot of the current worker process.
+_WORKER = {}
+
+
+def read_sites(filename, strand_column=4):
+    """
+    Read site positions from a BED file.
+
+    :param str filename: BED file; the center of each interval is the site
+    :param int strand_column: 1-based column holding the strand, used when
+        the file has more than three columns
+    :return dict: chromosome -> (array of site positions, array of whether
+        each site is on the reverse strand)
+    """
+    sites = {}
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if not fields:
+                continue
+            start, end = int(fields[1]), int(fields[2])
+            reverse = len(fields) > 3 and fields[strand_column - 1] == "-"
+            positions, strands = sites.setdefault(fields[0], ([], []))
+            positions.append(start + (end - start) // 2)
+            strands.append(reverse)
+    return dict((chrom, (np.array(positions, dtype=np.int64),
+                         np.array(strands, dtype=bool)))
+                for chrom, (positions, strands) in sites.items())
+
+
+def enrichment_score(profile, center=SCORE_CENTER,
+                     background=SCORE_BACKGROUND):
+    """
+    Enrichment of insertions at the sites: the mean per base over the
+    central bases of the profile, divided by the mean over the first bases
+    of the window. With a 4 kb window, these are bases 1950-2050 and 1-200,
+    the TSS score pepatac.py reports.
+
+    :param numpy.ndarray profile: insertions by position, as from
+        SiteProfile.run with summary 'positions'
+    :param int center: central bases
+    :param int background: bases at the start of the window; as the score
+        was first defined, the first base is left out of the sum but not of
+        the count
+    :return float: the score, or None if there are no background insertions
+    """
+    middle = len(profile) // 2
+    background_mean = float(np.sum(profile[1:background])) / background
+    if not background_mean:
+        return None
+    return (float(np.sum(profile[middle - center // 2:middle + center // 2]))
+            / center) / background_mean
+
+
+def insertions(batch, mode, rows=ROWS):
+    """
+    Insertions recorded for a batch of forward-strand reads: both Tn5-shifted
+    ends of each fragment ('ends'), or its center, split between two bases
+    when the fragment size is odd ('center').
+
+    :param dict batch: read columns, as from BamColumns.fetch
+    :param str mode: 'ends' or 'center'
+    :param int rows: fragment sizes counted; larger fragments are skipped
+    :return (numpy.ndarray, numpy.ndarray, numpy.ndarray): position,
+        fragment size and weight, in half insertions, of each insertion
+    """
+    start = batch["pos"] + 4
+    size = np.abs(batch["tlen"]) - 9
+    keep = size < rows
+    start, size = start[keep], size[keep]
+    if mode == "ends":
+        return (np.concatenate([start, start + size]),
+                np.concatenate([size, size]),
+                np.full(2 * len(size), HALVES, dtype=np.int64))
+    center = start + size // 2
+    odd = size % 2 == 1
+    weight = np.where(odd, 1, HALVES)
+    return (np.concatenate([center, center[odd] + 1]),
+            np.concatenate([size, size[odd]]),
+            np.concatenate([weight, weight[odd]]))
+
+
+def _init_worker(shared, shape, next_slot):
+    """ Give a new pool worker the next slot of the shared counts. """
+    with next_slot.get_lock():
+        slot = next_slot.value
+        next_slot.value += 1
+    _WORKER["counts"] = np.frombuffer(shared, dtype=np.int64).reshape(
+        (-1, ) + shape)[slot]
+
+
+class _SpanRunner(object):
+    """
+    Picklable callable that profiles one group of spans into the worker's
+    shared slot, for the pool.
+    """
+    def __init__(self, profile):
+        self.profile = profile
+
+    def __call__(self, spans):
+        profiler.worker()
+        try:
+            self.profile.process(spans, _WORKER["counts"])
+        finally:
+            profiler.dump()
+
+
+class SiteProfile(object):
+    """
+    Insertions around sets of sites, summed over the sites of each set.
+    """
+    def __init__(self, bam, site_sets, extend, mode="center", summary="matrix",
+                 rows=ROWS, position_bin=1, size_bin=1, cores=1,
+                 io_threads=1):
+        """
+        :param str bam: coordinate-sorted, indexed BAM file
+        :param list[dict] site_sets: sites of each set, each mapping
+            chromosome -> (positions, reverse), as from read_sites;
+            chromosomes missing from the BAM are skipped
+        :param int extend: bases on each side of a site
+        :param str mode: insertions to count; see insertions()
+        :param str summary: 'positions' (a vector of 2 * extend), 'sizes'
+            (a vector of rows) or 'matrix' (rows x (2 * extend))
+        :param int rows: fragment sizes counted
+        :param int position_bin: bases per position bin, from the start of
+            the window
+        :param int size_bin: fragment sizes per size bin, from 0
+        :param int cores: worker processes
+        :param int io_threads: threads inflating BAM blocks, per worker
+        """
+        if mode not in MODES:
+            raise ValueError("Unknown mode '{}'; choose from {}".
+                             format(mode, ", ".join(MODES)))
+        if summary not in SUMMARIES:
+            raise ValueError("Unknown summary '{}'; choose from {}".
+                             format(summary, ", ".join(SUMMARIES)))
+        self.bam = bam
+        self.extend = extend
+        self.width = 2 * extend
+        self.mode = mode
+        self.summary = summary
+        self.rows = rows
+        if position_bin < 1 or size_bin < 1:
+            raise ValueError("Bins must hold at least one position and size")
+        self.position_bin = position_bin
+        self.size_bin = size_bin
+        self.position_bins = -(-self.width // position_bin)
+        self.size_bins = -(-rows // size_bin)
+        self.cores = cores
+        self.io_threads = io_threads
+        self.n_sets = len(site_sets)
+        reads = BamColumns(bam)
+        self.lengths = dict(zip(reads.references, reads.lengths))
+        # Window starts of all sets, sorted, whether each window is read
+        # backwards, and the set it belongs to.
+        self.sites = {}
+        for chrom in reads.references:
+            found = [(i, sites[chrom]) for i, sites in enumerate(site_sets)
+                     if chrom in sites]
+            if not found:
+                continue
+            positions = np.concatenate([p for _, (p, _) in found])
+            reverse = np.concatenate([r for _, (_, r) in found])
+            sets = np.concatenate([np.full(len(p), i, dtype=np.int64)
+                                   for i, (p, _) in found])
+            order = np.argsort(positions, kind="mergesort")
+            self.sites[chrom] = (positions[order] - extend, reverse[order],
+                                 sets[order])
+        self.chroms = [c for c in reads.references if c in self.sites]
+
+    def spans(self):
+        """
+        Group each chromosome's sites into spans of nearby windows.
+
+        :return list[(str, int, int, int, int)]: chromosome, range of the
+            span's sites in the sorted window starts, and the region whose
+            reads it needs
+        """
+        # A read's insertions lie from 5 bases before its start to rows + 3
+        # bases after it, so reads starting further out add nothing.
+        reach = self.rows + 10
+        spans = []
+        for chrom in self.chroms:
+            starts = self.sites[chrom][0]
+            first, last = starts - reach, starts + self.width + reach
+            breaks = list(np.flatnonzero(first[1:] > last[:-1] + SPAN_GAP) + 1)
+            for lo, hi in zip([0] + breaks, breaks + [len(starts)]):
+                spans.append((chrom, lo, hi, max(0, int(first[lo])),
+                              min(self.lengths[chrom], int(last[hi - 1]))))
+        return spans
+
+    def tasks(self):
+        """
+        Split the spans into TASKS_PER_CORE groups per core, with similar
+        site counts.
+
+        :return list[list]: groups of spans
+        """
+        spans = self.spans()
+        total = sum(hi - lo for _, lo, hi, _, _ in spans)
+        n_tasks = self.cores * TASKS_PER_CORE if self.cores > 1 else 1
+        groups, group, count = [], [], 0
+        for span in spans:
+            group.append(span)
+            count += span[2] - span[1]
+            if count * n_tasks >= total * (len(groups) + 1):
+                groups.append(group)
+                group = []
+        if group:
+            groups.append(group)
+        return groups
+
+    def shape(self):
+        """ Shape of the summaries: one per set, then the summary's. """
+        return (self.n_sets, ) + {
+            "positions": (self.position_bins, ),
+            "sizes": (self.size_bins, ),
+            "matrix": (self.size_bins, self.position_bins)}[self.summary]
+
+    def process(self, spans, counts):
+        """
+        Count the insertions around the sites of some spans.
+
+        :param list spans: spans, as from spans()
+        :param numpy.ndarray counts: summaries to add to, in half
+            insertions; see shape()
+        """
+        reads = BamColumns(self.bam, self.io_threads)
+        for chrom, lo, hi, start, end in spans:
+            starts, reverse, sets = [a[lo:hi] for a in self.sites[chrom]]
+            for batch in reads.fetch(chrom, start, end, min_mapq=MIN_MAPQ,
+                                     exclude_flags=0x10):
+                # Insertions only count towards this span's own sites, so
+                # reads shared with a neighbouring span are not counted
+                # twice.
+                self._add(counts, starts, reverse, sets,
+                          *insertions(batch, self.mode, self.rows))
+
+    def _add(self, counts, starts, reverse, sets, positions, sizes,
+             weights):
+        width = self.width
+        # A window covers [start, start + width - 1); like the original
+        # per-site loop, its last base is never counted.
+        lo = np.searchsorted(starts, positions - width + 2)
+        hi = np.searchsorted(starts, positions, side="right")
+        n = hi - lo
+        # Unpaired reads (template length 0) have size -9; as in the
+        # original scripts, negative sizes count in the last rows.
+        rows = sizes % self.rows // self.size_bin
+        if self.summary == "sizes" and self.n_sets == 1:
+            # An insertion adds the same to each window it falls in.
+            counts[0] += np.bincount(rows, weights * n,
+                                     minlength=self.size_bins).astype(
+                                         np.int64)
+            return
+        total = int(n.sum())
+        if not total:
+            return
+        which = np.repeat(np.arange(len(positions)), n)
+        site = np.repeat(lo, n) + np.arange(total) - \
+            np.repeat(np.cumsum(n) - n, n)
+        if self.summary == "sizes":
+            index, length = rows[which], self.size_bins
+        else:
+            base = positions[which] - starts[site]
+            index = np.where(reverse[site], width - 1 - base, base) // \
+                self.position_bin
+            length = self.position_bins
+        if self.summary == "matrix":
+            np.add.at(counts, (sets[site], rows[which], index),
+                      weights[which])
+        else:
+            counts += np.bincount(
+                sets[site] * length + index, weights[which],
+                minlength=self.n_sets * length).astype(np.int64).reshape(
+                    counts.shape)
+
+    def run(self):
+        """
+        Count the insertions around all sites.
+
+        :return numpy.ndarray: insertions summed over the sites of each
+            set, by position, fragment size or both; see shape()
+        """
+        return self.count() / float(HALVES)
+
+    def count(self):
+        """
+        Count the insertions around all sites, as integers.
+
+        :return numpy.ndarray: half insertions summed over the sites of each
+            set; see shape()
+        """
+        tasks = self.tasks()
+        shape = self.shape()
+        if self.cores > 1 and len(tasks) > 1:
+            n_workers = min(self.cores, len(tasks))
+            shared = RawArray(ctypes.c_int64, n_workers * int(np.prod(shape)))
+            workers = Pool(n_workers, _init_worker,
+                           (shared, shape, Value("i", 0)))
+            for _ in workers.imap_unordered(_SpanRunner(self), tasks):
+                pass
+            workers.close()
+            workers.join()
+            slots = np.frombuffer(shared, dtype=np.int64).reshape(
+                (n_workers, ) + shape)
+            counts = slots[0]
+            for slot in slots[1:]:
+                counts += slot
+        else:
+            counts = np.zeros(shape, dtype=np.int64)
+            for spans in tasks:
+                self.process(spans, counts)
+        return counts
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# sketch.py
+#
+# Function: A HyperLogLog cardinality sketch in NumPy, used by bamQC.py to
+#           estimate the number of distinct fragments in constant memory.
+#           Sketches of different chromosomes, lanes or replicates merge by
+#           taking the larger register, so the merged estimate counts a
+#           fragment seen in several parts once.
+
+import math
+import zlib
+
+import numpy as np
+
+MIN_PRECISION = 4
+MAX_PRECISION = 18
+
+_MASK = np.uint64(0xFFFFFFFFFFFFFFFF)
+
+
+def mix64(x):
+    """
+    Scramble 64-bit integers (the splitmix64 finalizer).
+
+    :param numpy.ndarray x: integers, any width
+    :return numpy.ndarray: uint64 hashes
+    """
+    x = np.asarray(x).astype(np.uint64)
+    with np.errstate(over="ignore"):
+        x = (x + np.uint64(0x9E3779B97F4A7C15)) & _MASK
+        x = ((x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)) & _MASK
+        x = ((x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)) & _MASK
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_keys(chrom, columns):
+    """
+    Hash the duplicate keys of one chromosome; the same key hashes the
+    same way in every process and run.
+
+    :param str chrom: chromosome name
+    :param list[numpy.ndarray] columns: key fields, e.g. positions and
+        template lengths
+    :return numpy.ndarray: one uint64 hash per key
+    """
+    h = mix64(np.full(len(columns[0]), zlib.crc32(chrom.encode()),
+                      dtype=np.uint64))
+    for column in columns:
+        h = mix64(h ^ mix64(np.asarray(column, dtype=np.int64)
+                            .view(np.uint64)))
+    return h
+
+
+def precision_for_error(error):
+    """
+    Smallest precision whose standard error, 1.04 / sqrt(2 ** p), is at most
+    the given relative error.
+
+    :param float error: target relative standard error, e.g. 0.01
+    :return int: precision, clamped to [MIN_PRECISION, MAX_PRECISION]
+    """
+    p = int(math.ceil(math.log((1.04 / error) ** 2, 2)))
+    return min(max(p, MIN_PRECISION), MAX_PRECISION)
+
+
+class HyperLogLog(object):
+    """
+    Distinct count estimator over 64-bit hashes.
+    """
+    def __init__(self, precision=14, registers=None):
+        """
+        :param int precision: log2 of the number of registers
+        :param numpy.ndarray registers: existing registers, e.g. loaded
+            from a file; their length sets the precision
+        """
+        if registers is not None:
+            registers = np.asarray(registers, dtype=np.uint8)
+            precision = int(math.log(len(registers), 2))
+        else:
+            registers = np.zeros(2 ** precision, dtype=np.uint8)
+        self.precision = precision
+        self.registers = registers
+
+    @property
+    def error(self):
+        """ Relative standard error of the estimate. """
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def add(self, hashes):
+        """
+        :param numpy.ndarray hashes: uint64 hashes, e.g. from hash_keys
+        """
+        if not len(hashes):
+            return
+        p = np.uint64(self.precision)
+        index = (hashes >> (np.uint64(64) - p)).astype(np.int64)
+        # Rank: position of the first 1 bit among the remaining 64 - p bits.
+        rest = (hashes << p) & _MASK
+        rank = np.full(len(hashes), 64 - self.precision + 1, dtype=np.uint8)
+        nonzero = rest != 0
+        rank[nonzero] = (64 - np.floor(np.log2(
+            rest[nonzero].astype(np.float64)))).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+
+    def __add__(self, other):
+        if self.precision != other.precision:
+            raise ValueError("Cannot merge sketches of precision {} and {}".
+                             format(self.precision, other.precision))
+        return HyperLogLog(registers=np.maximum(self.registers,
+                                                other.registers))
+
+    def estimate(self):
+        """
+        :return float: estimated number of distinct hashes added
+        """
+        m = float(len(self.registers))
+        alpha = 0.7213 / (1 + 1.079 / m)
+        raw = alpha * m * m / np.sum(2.0 ** -self.registers.astype(np.float64))
+        zeros = np.count_nonzero(self.registers == 0)
+        if raw <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities.
+            return m * math.log(m / zeros)
+        return float(raw)
@@ -23,6 +23,10 @@
 # It's also useful to pipe this to the ucsc tool for bigwig compression:
 # cat cuts.txt | cutsToWig.pl CHROMSIZE | wigToBigWig -clip stdin chrom_sizes.txt out.bw
 
+# If the first line is a variableStep header instead of fixedStep, the output
+# is sparse: "position<TAB>value" lines for the non-zero steps only, at the
+# positions the same steps have in the fixedStep output (start=1 step=N).
+
 # Setup
 my $chrSize = shift;  # Size of chromosome is the first argument
 my $smoothSize = shift; # Smooth size is 2nd argument
@@ -32,6 +36,19 @@ $countIndex = 1;
 $currentCount = 0;
 $header =  <>; # Discard the first line (fixedstep)
 print $header;
+my $sparse = ($header =~ /^variableStep/);
+my $steps = 0; # Steps output so far; the next one is at 1 + $steps*$stepSize
+
+# Print the value for the next step, in whichever format the header asked for
+sub emit {
+	my ($count) = @_;
+	if (!$sparse) {
+		print "$count\n";
+	} elsif ($count != 0) {
+		print 1 + $steps*$stepSize, "\t$count\n";
+	}
+	$steps++;
+}
 
 
 # The strategy here is to make a smoothed signal track (bigwig file) given the
@@ -57,7 +74,7 @@ $endSite = $cutSite + $smoothSize*2;
 
 # Print out 0s until the first cut
 while ($countIndex < $cutSite) {
-	print "0\n";
+	emit(0);
 	$countIndex += $stepSize;	
 }
 $previousCut = $cutSite;
@@ -88,7 +105,7 @@ while($cutSite = <>) {
 			$endSite = shift @closers;
 		}
 		if ($countIndex % $stepSize == 0) {
-			print "$currentCount\n";
+			emit($currentCount);
 		}
 		$countIndex++;	
 	}
@@ -105,7 +122,7 @@ while($countIndex <= $chrSize) {
 		$endSite = shift @closers;
 	}
 	if ($countIndex % $stepSize == 0) {
-		print "$currentCount\n";
+		emit($currentCount);
 	}
 	$countIndex++;	
 }
@@ -0,0 +1,645 @@
+#!/usr/bin/env python
+# tiling.py
+#
+# Function: Split chromosomes into fixed-size genomic tiles for the
+#           ParaReadProcessor tools (bamSitesToWig.py, bamQC.py), and hand
+#           the resulting tasks to the worker pool busiest chromosome first,
+#           so that one or two big chromosomes no longer set the wall time.
+#           A chromosome's tiles go out in genomic order, so results that
+#           must be written in order come back nearly in order.
+#
+# A task is identified by a string: either a bare chromosome name (the whole
+# chromosome) or a region "chrom:start-end" with 0-based, half-open
+# coordinates. Because the keys are plain strings, they work unchanged with
+# ParaReadProcessor._tempf() and with combine().
+#
+# With a checkpoint folder, temporary files go there instead, and each
+# finished task is recorded in a manifest with the size and MD5 checksum of
+# its files. A run restarted with the same inputs and settings, e.g. after
+# a preemptible node is reclaimed, skips the tasks whose files are intact.
+#
+# With a work queue folder on shared storage, the run coordinates instead:
+# it publishes its tasks there, and worker processes started with the same
+# arguments on any node (see work()) claim and process them, saving their
+# results next to the queue for the coordinator to collect and combine.
+#
+# With metrics on, each task also leaves a record of its reads, phase
+# timings, peak memory and bytes written, which the parent merges; see
+# metrics.py.
+
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import time
+
+from pararead.processor import PARA_READ_FILES, READS_FILE_KEY
+
+from bamcolumns import BamColumns
+import profiler
+from metrics import (NullMetrics, TaskMetrics, load_metrics, peak_rss,
+                     save_metrics, write_metrics)
+from workqueue import WorkQueue, worker_id, POLL_SECONDS
+
+_LOGGER = logging.getLogger(__name__)
+
+TILE_PATTERN = re.compile(r"^(.+):(\d+)-(\d+)$")
+
+MANIFEST = "manifest.jsonl"
+
+
+def make_tasks(chrom_sizes, tile_size=None):
+    """
+    Build task keys covering the given chromosomes.
+
+    :param Iterable[(str, int)] chrom_sizes: chromosome names and lengths
+    :param int tile_size: maximum tile length; chromosomes no longer than
+        this (or all of them, if unset) become a single task
+    :return list[str]: task keys, in genomic order
+    """
+    tasks = []
+    for chrom, size in chrom_sizes:
+        if not tile_size or size <= tile_size:
+            tasks.append(chrom)
+            continue
+        for start in range(0, size, tile_size):
+            tasks.append("{}:{}-{}".format(chrom, start,
+                                           min(start + tile_size, size)))
+    return tasks
+
+
+def dispatch_order(chrom_sizes, reads_by_chrom, tile_size=None):
+    """
+    Order the tasks for dispatch: the chromosomes with the most reads first,
+    and each chromosome's tiles in genomic order.
+
+    :param Iterable[(str, int)] chrom_sizes: chromosome names and lengths
+    :param Mapping[str, int] reads_by_chrom: mapped reads per chromosome
+    :param int tile_size: maximum tile length, as for make_tasks
+    :return list[str]: task keys, in dispatch order
+    """
+    ranked = sorted(chrom_sizes, key=lambda c: reads_by_chrom.get(c[0], 0),
+                    reverse=True)
+    return make_tasks(ranked, tile_size)
+
+
+def parse_task(task, size_by_chrom):
+    """
+    Resolve a task key into the region it covers.
+
+    :param str task: task key, as produced by make_tasks
+    :param Mapping[str, int] size_by_chrom: chromosome lengths
+    :return (str, int, int): chromosome, 0-based start and exclusive end
+    :raise ValueError: if the key names neither a known chromosome nor a
+        region on one
+    """
+    if task in size_by_chrom:
+        return task, 0, size_by_chrom[task]
+    match = TILE_PATTERN.match(task)
+    if not match or match.group(1) not in size_by_chrom:
+        raise ValueError("Unknown task: '{}'".format(task))
+    return match.group(1), int(match.group(2)), int(match.group(3))
+
+
+def file_checksum(filename):
+    """ MD5 hex digest of a file's contents. """
+    md5 = hashlib.md5()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class Checkpoint(object):
+    """
+    Manifest of the tasks finished in a folder that outlives the run.
+
+    The first line of the manifest identifies the run; each further line
+    holds one task and the name, size and checksum of each of its files.
+    Lines are flushed to disk as tasks finish, so a killed run loses at most
+    the tasks still in progress.
+    """
+    def __init__(self, folder, fingerprint):
+        """
+        :param str folder: checkpoint folder, created if missing
+        :param dict fingerprint: inputs and settings of the run; a manifest
+            written by a run with a different one is discarded
+        """
+        self.folder = folder
+        self.manifest = os.path.join(folder, MANIFEST)
+        self.done = {}
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        fingerprint = json.dumps(fingerprint, sort_keys=True)
+        if os.path.exists(self.manifest):
+            with open(self.manifest) as f:
+                lines = f.read().splitlines()
+            if lines and lines[0] == fingerprint:
+                kept = [fingerprint]
+                for line in lines[1:]:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line of a killed run may be incomplete.
+                        continue
+                    self.done[entry["task"]] = entry["files"]
+                    kept.append(line)
+                if len(kept) < len(lines):
+                    # Drop it, or the next record would be appended to it.
+                    temp = self.manifest + ".tmp"
+                    with open(temp, "w") as f:
+                        f.write("".join(line + "\n" for line in kept))
+                    os.rename(temp, self.manifest)
+                return
+            _LOGGER.warning("Inputs or settings changed since the checkpoint "
+                            "in '{}' was written; starting over.".format(folder))
+        with open(self.manifest, "w") as f:
+            f.write(fingerprint + "\n")
+
+    def is_complete(self, task):
+        """
+        Whether a task was recorded and its files are unchanged since.
+
+        :param str task: task key
+        :return bool: True if the task needn't run again
+        """
+        if task not in self.done:
+            return False
+        for name, size, checksum in self.done[task]:
+            filename = os.path.join(self.folder, name)
+            if not os.path.isfile(filename) or \
+                    os.path.getsize(filename) != size or \
+                    file_checksum(filename) != checksum:
+                _LOGGER.info("Checkpoint file changed or missing: '{}'; "
+                             "rerunning {}".format(filename, task))
+                return False
+        return True
+
+    def record(self, task, files):
+        """
+        Add a finished task to the manifest.
+
+        :param str task: task key
+        :param Iterable[str] files: paths of the files the task produced,
+            inside the checkpoint folder
+        """
+        entries = [[os.path.basename(f), os.path.getsize(f), file_checksum(f)]
+                   for f in files if os.path.isfile(f)]
+        self.done[task] = entries
+        with open(self.manifest, "a") as f:
+            f.write(json.dumps({"task": task, "files": entries}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+class _TaskRunner(object):
+    """
+    Picklable callable that runs one task of a processor, for the pool.
+    """
+    def __init__(self, processor):
+        self.processor = processor
+
+    def __call__(self, task):
+        return self.processor.run_task(task)
+
+
+class TiledProcessor(object):
+    """
+    Mixin for ParaReadProcessor subclasses whose __call__ accepts a task key
+    rather than a chromosome name.
+
+    It must precede ParaReadProcessor among the base classes, and the class
+    should set tile_size (None keeps one task per chromosome). A task owns
+    the reads that start inside its region; processors that need reads from
+    just beyond the edges can fetch with padding and filter on their own
+    output coordinates instead.
+
+    Subclasses that want to consume results in the parent as they arrive,
+    rather than through files in combine(), can override prepare() and
+    collect(). Those that only need a few fields per read can fetch them
+    as NumPy columns with fetch_columns(), using io_threads threads per
+    task to inflate the BAM.
+
+    Setting checkpoint to a folder makes runs resumable. Subclasses then
+    list the files each task leaves in _tempf() paths in task_files(), and
+    those that return results to collect() instead of writing files save
+    and reload them with save_result() and load_result(). The same hooks
+    carry results from the workers of a work_queue folder to its
+    coordinator.
+
+    With metrics set, tasks are measured, and write_metrics() reports on
+    them after combine(). Subclasses time their phases with
+    task_metrics.phase(name); fetch_columns() times decoding and counts
+    reads on its own.
+    """
+    tile_size = None
+    io_threads = 1
+    checkpoint = None
+    work_queue = None
+    metrics = False
+    task_metrics = NullMetrics()
+
+    def prepare(self, queue):
+        """
+        Hook called in the parent just before tasks are dispatched.
+
+        :param list[str] queue: task keys, in dispatch order
+        """
+        pass
+
+    def collect(self, task, result):
+        """
+        Hook called in the parent with each task's result, in dispatch order,
+        as soon as it is available.
+
+        :param str task: task key
+        :param object result: what __call__ returned for the task
+        """
+        pass
+
+    def checkpoint_params(self):
+        """
+        Settings that change what tasks produce, so a checkpoint written
+        with other values is not reused.
+
+        :return dict: JSON-serializable settings
+        """
+        return {}
+
+    def task_files(self, task):
+        """
+        Files a finished task leaves behind, to record in the checkpoint.
+
+        :param str task: task key
+        :return list[str]: file paths
+        """
+        return []
+
+    def save_result(self, task, result):
+        """
+        Hook called in the parent to persist a task's result before it is
+        recorded in the checkpoint; its file should be among task_files().
+
+        :param str task: task key
+        :param object result: what __call__ returned for the task
+        """
+        pass
+
+    def load_result(self, task):
+        """
+        Recreate the result of a task finished by an earlier run, for
+        collect().
+
+        :param str task: task key
+        :return object: the task's result
+        """
+        return task
+
+    def output_files(self):
+        """
+        Files combine() writes, whose sizes the metrics summary reports.
+
+        :return list[str]: output paths
+        """
+        return [self.outfile]
+
+    def clear_checkpoint(self):
+        """
+        Remove the checkpoint or work queue folder, once the output is
+        complete.
+        """
+        for folder in [self.checkpoint, self.work_queue]:
+            if folder and os.path.isdir(folder):
+                shutil.rmtree(folder)
+
+    def _fingerprint(self):
+        # Not the absolute path: workers on other nodes may mount the shared
+        # storage elsewhere, and a moved checkpoint should still resume.
+        stat = os.stat(self.path_reads_file)
+        fingerprint = {"reads": os.path.basename(self.path_reads_file),
+                       "size": stat.st_size, "mtime": int(stat.st_mtime),
+                       "tile_size": self.tile_size}
+        fingerprint.update(self.checkpoint_params())
+        # As read back from JSON, so it compares equal to a stored one.
+        return json.loads(json.dumps(fingerprint))
+
+    def task_region(self, task):
+        """
+        :param str task: task key
+        :return (str, int, int): chromosome, 0-based start and exclusive end
+        """
+        return parse_task(task, self._size_by_chromosome)
+
+    def is_whole_chrom(self, task):
+        """ Whether a task spans its whole chromosome. """
+        return task in self._size_by_chromosome
+
+    def fetch_region(self, task, pad=0):
+        """
+        Fetch the reads overlapping a task region, widened by pad bases on
+        each side.
+
+        :param str task: task key
+        :param int pad: number of bases to add on either side of the tile
+        :return Iterable[pysam.AlignedSegment]: reads overlapping the region
+        """
+        if self.is_whole_chrom(task):
+            return self.fetch_chunk(task)
+        chrom, start, end = self.task_region(task)
+        readsfile = PARA_READ_FILES[READS_FILE_KEY]
+        return readsfile.fetch(chrom, max(0, start - pad),
+                               min(self.get_chrom_size(chrom), end + pad),
+                               multiple_iterators=True)
+
+    def fetch_task(self, task):
+        """
+        Fetch the reads owned by a task: those that start inside its region,
+        so that each read is seen by exactly one tile.
+
+        :param str task: task key
+        :return Iterable[pysam.AlignedSegment]: reads starting in the region
+        """
+        if self.is_whole_chrom(task):
+            return self.fetch_chunk(task)
+        _, start, _ = self.task_region(task)
+        return (read for read in self.fetch_region(task)
+                if read.reference_start >= start)
+
+    def fetch_columns(self, task, pad=0, owned=False, **filters):
+        """
+        Fetch batches of read fields for a task region, as NumPy arrays.
+
+        :param str task: task key
+        :param int pad: number of bases to add on either side of the tile
+        :param bool owned: keep only the reads that start inside the tile,
+            as fetch_task() does
+        :param filters: min_mapq, require_flags and exclude_flags, applied
+            as the reads are decoded
+        :return Iterable[dict]: batches of bamcolumns.COLUMNS
+        """
+        chrom, start, end = self.task_region(task)
+        bam = BamColumns(self.path_reads_file, threads=self.io_threads)
+        if self.is_whole_chrom(task):
+            batches = bam.fetch(chrom, **filters)
+        else:
+            batches = bam.fetch(chrom, max(0, start - pad),
+                                min(self.get_chrom_size(chrom), end + pad),
+                                **filters)
+        tiled = not self.is_whole_chrom(task)
+        for batch in self.task_metrics.timed("decode", batches):
+            n_owned = len(batch["pos"])
+            if tiled and (owned or self.metrics):
+                keep = (batch["pos"] >= start) & (batch["pos"] < end)
+                n_owned = int(keep.sum())
+                if owned and n_owned < len(keep):
+                    batch = dict((k, v[keep]) for k, v in batch.items())
+            # Reads in the padding are counted by the tiles they start in.
+            self.task_metrics.count("reads", n_owned)
+            if len(batch["pos"]):
+                yield batch
+
+    def run_task(self, task):
+        """
+        Run one task, measuring it if metrics are on, and sampling its
+        stacks if the run is profiled.
+
+        :param str task: task key
+        :return object: what __call__ returned for the task
+        """
+        # Workers sample themselves if the parent is being profiled.
+        profiler.worker()
+        try:
+            if not self.metrics:
+                return self(task)
+            self.task_metrics = TaskMetrics(task)
+            try:
+                result = self(task)
+                record = self.task_metrics.finish(self.task_files(task))
+            finally:
+                self.task_metrics = NullMetrics()
+            save_metrics(self._tempf(task) + ".metrics", record)
+            return result
+        finally:
+            profiler.dump()
+
+    def _collect_task(self, task, result):
+        """
+        Collect the result of a task run in this run, adding the parent's
+        share to its metrics.
+        """
+        started = time.time()
+        self.collect(task, result)
+        if self.metrics:
+            record = load_metrics(self._tempf(task) + ".metrics")
+            if record is not None:
+                record["phases"].append(["collect", time.time() - started])
+                self._metrics_records.append(record)
+
+    def write_metrics(self, prefix):
+        """
+        Write the metrics of the tasks this run processed, and a summary
+        that includes the reduce step, timed as everything since run().
+
+        :param str prefix: output path prefix, e.g. the output file name
+            without its extension
+        """
+        if not self.metrics:
+            return
+        now = time.time()
+        summary = {"cores": self.cores, "tile_size": self.tile_size,
+                   "resumed_tasks": self._resumed_tasks,
+                   "wall_seconds": now - self._run_started,
+                   "run_seconds": self._run_finished - self._run_started,
+                   "combine_seconds": now - self._run_finished,
+                   "parent_peak_rss_mb": peak_rss() / 1e6,
+                   "output_bytes": dict((f, os.path.getsize(f))
+                                        for f in self.output_files()
+                                        if os.path.isfile(f))}
+        table, summary_file = write_metrics(prefix, self._metrics_records,
+                                            summary)
+        _LOGGER.info("Wrote task metrics to '{}' and '{}'".
+                     format(table, summary_file))
+
+    def run(self):
+        """
+        Process every task, busiest chromosome first, and report the
+        successful ones.
+
+        Chromosomes are ranked by the mapped read counts in the BAM index.
+        Tasks are handed out one at a time so that the long ones start
+        first and the short ones fill in the gaps at the end. A chromosome's
+        tiles go out in genomic order, so collect() gets results nearly in
+        the order they are written, whatever the tile size. With a
+        checkpoint, tasks an earlier run finished are not run again; their
+        results are reloaded instead.
+
+        :return list[str]: keys of tasks with a non-null result, in genomic
+            order
+        """
+        self._run_started = time.time()
+        self._metrics_records = []
+        readsfile = PARA_READ_FILES[READS_FILE_KEY]
+        reads_by_chrom = {istat.contig: istat.mapped
+                          for istat in readsfile.get_index_statistics()}
+        chrom_sizes = [(chrom, size) for chrom, size in
+                       zip(readsfile.references, readsfile.lengths)
+                       if reads_by_chrom.get(chrom)
+                       and (not self.limit or chrom in self.limit)]
+        tasks = make_tasks(chrom_sizes, self.tile_size)
+        queue = dispatch_order(chrom_sizes, reads_by_chrom, self.tile_size)
+
+        if self.checkpoint and self.work_queue:
+            raise ValueError("A work queue keeps its own results; "
+                             "use it without a checkpoint.")
+        checkpoint = None
+        if self.checkpoint:
+            checkpoint = Checkpoint(self.checkpoint, self._fingerprint())
+            self.temp_folder = self.checkpoint
+        if self.work_queue:
+            work_queue = WorkQueue(self.work_queue)
+            self.temp_folder = work_queue.files
+
+        _LOGGER.info("Temporary files will be stored in: '{}'".
+                     format(self.temp_folder))
+
+        self.prepare(queue)
+        if self.work_queue:
+            succeeded = self._coordinate(work_queue, queue)
+        else:
+            succeeded = self._dispatch(queue, checkpoint)
+        self._run_finished = time.time()
+
+        bad_tasks = [t for t in tasks if not succeeded[t]]
+        good_tasks = [t for t in tasks if succeeded[t]]
+        if bad_tasks:
+            _LOGGER.info("Discarding {} task(s): {}".
+                         format(len(bad_tasks), bad_tasks))
+        return good_tasks
+
+    def _dispatch(self, queue, checkpoint):
+        """
+        Run tasks in a local worker pool, collecting results as they come.
+
+        :return dict: whether each task succeeded
+        """
+        succeeded = {}
+        if checkpoint:
+            done = [task for task in queue if checkpoint.is_complete(task)]
+            if done:
+                _LOGGER.info("Resuming: {} of {} tasks already finished".
+                             format(len(done), len(queue)))
+            for task in done:
+                self.collect(task, self.load_result(task))
+                succeeded[task] = True
+            queue = [task for task in queue if task not in succeeded]
+        self._resumed_tasks = len(succeeded)
+
+        _LOGGER.info("Processing {} tasks with {} cores...".
+                     format(len(queue), self.cores))
+        if self.cores == 1:
+            workers = None
+            results = (self.run_task(task) for task in queue)
+        else:
+            workers = multiprocessing.Pool(self.cores)
+            results = workers.imap(_TaskRunner(self), queue, 1)
+
+        # Results are handed over and dropped one by one, so the parent
+        # never holds all of them at once.
+        for task in queue:
+            result = next(results)
+            if checkpoint and result is not None:
+                self.save_result(task, result)
+                checkpoint.record(task, self.task_files(task))
+            self._collect_task(task, result)
+            succeeded[task] = result is not None
+
+        if workers is not None:
+            workers.close()
+            workers.join()
+        return succeeded
+
+    def _coordinate(self, work_queue, queue):
+        """
+        Publish tasks to the work queue and collect them as workers finish
+        them. The coordinator also runs one worker per core, so with no
+        other workers it behaves like a local run; with no cores it only
+        coordinates.
+
+        :return dict: whether each task succeeded
+        """
+        succeeded = {}
+        for task in work_queue.publish(queue, self._fingerprint()):
+            self.collect(task, self.load_result(task))
+            succeeded[task] = True
+        self._resumed_tasks = len(succeeded)
+        if succeeded:
+            _LOGGER.info("Resuming: {} of {} tasks already finished".
+                         format(len(succeeded), len(queue)))
+        _LOGGER.info("Published {} tasks to '{}'; working on them with {} "
+                     "local cores".format(len(queue) - len(succeeded),
+                                          self.work_queue, self.cores))
+        workers = [multiprocessing.Process(target=self._work_loop,
+                                           args=(work_queue,))
+                   for _ in range(self.cores)]
+        for worker in workers:
+            worker.start()
+        for task, ok in work_queue.wait(queue, seen=succeeded):
+            self._collect_task(task, self.load_result(task) if ok else None)
+            succeeded[task] = ok
+        for worker in workers:
+            worker.join()
+        return succeeded
+
+    def work(self):
+        """
+        Process tasks from the work queue until none are left, with one
+        worker per core, e.g. on another node with the coordinator's
+        arguments. The coordinator must have published its tasks first.
+
+        :raise ValueError: if no run is published in the work queue, or it
+            has other inputs or settings
+        """
+        work_queue = WorkQueue(self.work_queue, create=False)
+        if work_queue.fingerprint() != self._fingerprint():
+            raise ValueError("The run queued in '{}' has other inputs or "
+                             "settings than this worker".
+                             format(self.work_queue))
+        self.temp_folder = work_queue.files
+        if self.cores == 1:
+            self._work_loop(work_queue)
+            return
+        workers = [multiprocessing.Process(target=self._work_loop,
+                                           args=(work_queue,))
+                   for _ in range(self.cores)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    def _work_loop(self, work_queue):
+        me = worker_id()
+        while True:
+            claim = work_queue.claim()
+            if claim is None:
+                # Others' claims may still go stale and come back.
+                if work_queue.idle():
+                    return
+                work_queue.requeue_stale()
+                time.sleep(POLL_SECONDS)
+                continue
+            name, task = claim
+            _LOGGER.info("Worker {} took {}".format(me, task))
+            stop = work_queue.heartbeat(name)
+            try:
+                result = self.run_task(task)
+                if result is not None:
+                    self.save_result(task, result)
+            except Exception:
+                work_queue.finish(name, False)
+                raise
+            finally:
+                stop.set()
+            work_queue.finish(name, result is not None)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# vplot.py
+#
+# Function: Store V-plots (insertions around sites by fragment size and
+#           position, as counted by siteprofile.py) compactly: as a
+#           compressed .npz of the smallest integer type that holds the
+#           counts, with coarser zoom levels next to the full-resolution
+#           matrix, so that viewers and cohort summaries need not re-bin it.
+#
+# Usage:
+#   from vplot import save_vplot, load_vplot
+#   save_vplot("sample_vplot.npz", counts, halves=2, extend=5000,
+#              position_bin=10, size_bin=5, zoom_factors=[4, 16])
+#   matrix, info = load_vplot("sample_vplot.npz", level=4)
+
+import numpy as np
+
+# Bin sizes and other settings stored with the counts.
+_SETTINGS = ["extend", "position_bin", "size_bin", "halves"]
+
+
+def zoom(counts, factor):
+    """
+    Sum a matrix over blocks of factor x factor bins; the last blocks of
+    each axis may be partial.
+
+    :param numpy.ndarray counts: fragment size by position matrix
+    :param int factor: bins per block along each axis
+    :return numpy.ndarray: the coarser matrix
+    """
+    rows = -(-counts.shape[0] // factor)
+    cols = -(-counts.shape[1] // factor)
+    padded = np.zeros((rows * factor, cols * factor), dtype=counts.dtype)
+    padded[:counts.shape[0], :counts.shape[1]] = counts
+    return padded.reshape(rows, factor, cols, factor).sum(axis=(1, 3))
+
+
+def _smallest_type(counts):
+    for dtype in [np.uint8, np.uint16, np.uint32]:
+        if counts.max() <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+def save_vplot(filename, counts, halves, extend, position_bin=1, size_bin=1,
+               zoom_factors=()):
+    """
+    Write a V-plot and its zoom levels.
+
+    :param str filename: .npz file to write
+    :param numpy.ndarray counts: integer fragment size by position matrix
+    :param int halves: parts each insertion is counted in, e.g. 2 for
+        SiteProfile.count, whose centers of odd-sized fragments are split
+        between two bases
+    :param int extend: bases on each side of the sites
+    :param int position_bin: bases per position bin
+    :param int size_bin: fragment sizes per size bin
+    :param Iterable[int] zoom_factors: coarser levels to store, each summing
+        factor x factor bins of the full matrix
+    """
+    counts = np.asarray(counts)
+    if counts.size and counts.min() < 0:
+        raise ValueError("V-plot counts must not be negative")
+    # Store whole insertions when nothing was split.
+    if halves > 1 and not np.any(counts % halves):
+        counts, halves = counts // halves, 1
+    levels = {"counts": counts}
+    for factor in zoom_factors:
+        if factor > 1:
+            levels["zoom_{}".format(factor)] = zoom(counts, factor)
+    arrays = dict((name, level.astype(_smallest_type(level)) if level.size
+                   else level) for name, level in levels.items())
+    for name, value in zip(_SETTINGS,
+                           [extend, position_bin, size_bin, halves]):
+        arrays[name] = np.array(value)
+    np.savez_compressed(filename, **arrays)
+
+
+def load_vplot(filename, level=1):
+    """
+    Read a V-plot written by save_vplot.
+
+    :param str filename: .npz file
+    :param int level: stored zoom factor to read, or 1 for the full matrix
+    :return (numpy.ndarray, dict): insertions by fragment size and
+        position, and the settings; position_bin and size_bin are those of
+        the level read
+    """
+    with np.load(filename) as data:
+        info = dict((name, int(data[name])) for name in _SETTINGS)
+        name = "counts" if level == 1 else "zoom_{}".format(level)
+        if name not in data.files:
+            raise ValueError("No zoom level {} in '{}'; stored: {}".format(
+                level, filename, ", ".join(
+                    n for n in data.files if n.startswith("zoom_"))))
+        matrix = data[name] / float(info["halves"])
+    info["position_bin"] *= level
+    info["size_bin"] *= level
+    return matrix, info
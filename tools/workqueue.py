@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+# workqueue.py
+#
+# Function: A task queue kept as files in a folder on shared storage, so
+#           that the tasks of one TiledProcessor run (bamSitesToWig.py,
+#           bamQC.py) can be processed by worker processes on any number of
+#           nodes.
+#
+# Each task is a small file that moves between subfolders:
+#
+#   pending/  published by the coordinator, waiting for a worker
+#   claimed/  being processed; a worker claims a task by renaming it here,
+#             which is atomic, so no two workers get the same task
+#   done/     finished; its output files are in files/
+#   failed/   the task produced no result
+#
+# settings.json holds the fingerprint of the run and its task list, so
+# workers started with other inputs or settings refuse to take part. Only
+# the coordinator creates the queue; workers open a published one.
+# Workers refresh the modification time of their claims while they work;
+# claims left alone for STALE_SECONDS (by default), e.g. by a node that was
+# lost, go back to pending.
+
+import json
+import logging
+import os
+import shutil
+import socket
+import threading
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+PENDING, CLAIMED, DONE, FAILED = "pending", "claimed", "done", "failed"
+SETTINGS = "settings.json"
+HEARTBEAT_SECONDS = 30
+STALE_SECONDS = 300
+POLL_SECONDS = 1
+
+
+def worker_id():
+    """ Name identifying this process across nodes. """
+    return "{}.{}".format(socket.gethostname(), os.getpid())
+
+
+def _write_atomic(filename, text):
+    temp = "{}.{}.tmp".format(filename, worker_id())
+    with open(temp, "w") as f:
+        f.write(text)
+    os.rename(temp, filename)
+
+
+class WorkQueue(object):
+    """
+    A queue of task keys in a shared folder.
+    """
+    def __init__(self, folder, create=True, stale_seconds=STALE_SECONDS):
+        """
+        :param str folder: queue folder
+        :param bool create: create the folder if missing, as the coordinator
+            does; otherwise a run must already be published in it
+        :param float stale_seconds: age at which a claim nobody refreshes
+            goes back to pending
+        :raise ValueError: if not creating and no run is published in the
+            folder
+        """
+        self.folder = folder
+        self.files = os.path.join(folder, "files")
+        self.settings = os.path.join(folder, SETTINGS)
+        self.stale_seconds = stale_seconds
+        if not create:
+            if not os.path.isfile(self.settings):
+                raise ValueError("No run is published in the work queue "
+                                 "'{}'; start its coordinator first".
+                                 format(folder))
+            return
+        for sub in [PENDING, CLAIMED, DONE, FAILED, "files"]:
+            path = os.path.join(folder, sub)
+            if not os.path.isdir(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # Another process may have created it meanwhile.
+                    if not os.path.isdir(path):
+                        raise
+
+    def _path(self, state, name=""):
+        return os.path.join(self.folder, state, name)
+
+    def _names(self, state):
+        try:
+            names = os.listdir(self._path(state))
+        except OSError:
+            # Removed by the coordinator once the run is combined.
+            return []
+        return sorted(n for n in names if not n.endswith(".tmp"))
+
+    def _settings(self):
+        try:
+            with open(self.settings) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def fingerprint(self):
+        """
+        :return dict: fingerprint of the published run, or None if nothing
+            has been published yet
+        """
+        settings = self._settings()
+        return settings["fingerprint"] if settings else None
+
+    def idle(self):
+        """ Whether no task is pending or being processed. """
+        return not self._names(PENDING) and not self._names(CLAIMED)
+
+    def publish(self, tasks, fingerprint):
+        """
+        Queue the tasks of a run. Tasks a previous coordinator of the same
+        run already saw finish are kept; any other queue content is
+        discarded.
+
+        :param list[str] tasks: task keys; workers take them in this order
+        :param dict fingerprint: inputs and settings of the run
+        :return list[str]: the tasks already done
+        """
+        settings = {"fingerprint": fingerprint, "tasks": tasks}
+        if self._settings() != settings:
+            if os.path.exists(self.settings):
+                _LOGGER.warning("Inputs or settings changed since the queue "
+                                "in '{}' was published; starting over.".
+                                format(self.folder))
+                os.remove(self.settings)
+            for sub in [PENDING, CLAIMED, DONE, FAILED, "files"]:
+                shutil.rmtree(self._path(sub))
+                os.makedirs(self._path(sub))
+        done = set(self._names(DONE))
+        # Claims held when the last coordinator stopped are handed out again.
+        for sub in [PENDING, CLAIMED, FAILED]:
+            for name in self._names(sub):
+                os.remove(self._path(sub, name))
+        finished = []
+        for i, task in enumerate(tasks):
+            name = "{:06d}".format(i)
+            if name in done:
+                finished.append(task)
+            else:
+                _write_atomic(self._path(PENDING, name), task)
+        # Workers wait for the settings, so they appear once tasks are in.
+        _write_atomic(self.settings, json.dumps(settings))
+        return finished
+
+    def claim(self):
+        """
+        Take the first pending task.
+
+        :return (str, str): the task's queue name and key, or None if no
+            task is pending
+        """
+        for name in self._names(PENDING):
+            try:
+                os.rename(self._path(PENDING, name), self._path(CLAIMED, name))
+                # The claim is fresh, however long the task was pending.
+                os.utime(self._path(CLAIMED, name), None)
+                with open(self._path(CLAIMED, name)) as f:
+                    return name, f.read()
+            except (IOError, OSError):
+                # Claimed by another worker first.
+                continue
+        return None
+
+    def heartbeat(self, name):
+        """
+        Keep a claim fresh until the returned event is set.
+
+        :param str name: queue name of the claimed task
+        :return threading.Event: set it once the task is finished
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(HEARTBEAT_SECONDS):
+                try:
+                    os.utime(self._path(CLAIMED, name), None)
+                except OSError:
+                    return
+        thread = threading.Thread(target=beat)
+        thread.daemon = True
+        thread.start()
+        return stop
+
+    def finish(self, name, ok):
+        """
+        Move a claimed task to done or failed.
+
+        :param str name: queue name of the claimed task
+        :param bool ok: whether the task produced a result
+        """
+        try:
+            os.rename(self._path(CLAIMED, name),
+                      self._path(DONE if ok else FAILED, name))
+        except OSError:
+            _LOGGER.warning("Task {} was requeued while it ran".format(name))
+
+    def requeue_stale(self):
+        """ Return claims nobody has refreshed in a while to pending. """
+        now = time.time()
+        for name in self._names(CLAIMED):
+            try:
+                if now - os.path.getmtime(self._path(CLAIMED, name)) > \
+                        self.stale_seconds:
+                    os.rename(self._path(CLAIMED, name),
+                              self._path(PENDING, name))
+                    _LOGGER.warning("Requeued stale task {}".format(name))
+            except OSError:
+                continue
+
+    def wait(self, tasks, seen=()):
+        """
+        Follow the queue until every task is done or failed.
+
+        :param list[str] tasks: task keys, in the order they were published
+        :param Iterable[str] seen: tasks not to report again
+        :return Iterable[(str, bool)]: each newly finished task, and whether
+            it produced a result, as soon as it is finished
+        """
+        by_name = dict(("{:06d}".format(i), t) for i, t in enumerate(tasks))
+        reported = set(seen)
+        while len(reported) < len(tasks):
+            found = False
+            for state in [DONE, FAILED]:
+                for name in self._names(state):
+                    task = by_name[name]
+                    if task not in reported:
+                        reported.add(task)
+                        found = True
+                        yield task, state == DONE
+            if not found:
+                self.requeue_stale()
+                time.sleep(POLL_SECONDS)